@@ -8,4 +8,7 @@ app = Dash(__name__,
             title=APP_TITLE,
             update_title='Loading...',
             suppress_callback_exceptions=True,
-            external_stylesheets=[dbc.themes.FLATLY])
\ No newline at end of file
+            external_stylesheets=[dbc.themes.FLATLY])
+
+# Flask server exposed to WSGI servers (e.g. `gunicorn index:server`)
+server = app.server
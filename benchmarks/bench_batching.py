@@ -0,0 +1,96 @@
+"""
+Load test of the micro-batching scheduler: concurrent clients send prompts to a
+text-generation pipeline on CPU, called directly (batch size 1) or through
+BatchedPipeline. Reports throughput, latency and the batch size histogram. With
+--stream, the answers are streamed token by token as in the chat.
+
+    python -m benchmarks.bench_batching --model distilgpt2 --clients 1 4 8 16 [--stream]
+"""
+import argparse
+import threading
+import time
+
+from benchmarks.common import load_questions, summarize, write_results
+from pages.chatbot.chatbot_batching import BatchedPipeline
+from pages.chatbot.chatbot_config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+
+
+def load_pipeline(model_name):
+    import transformers
+
+    return transformers.pipeline("text-generation", model=model_name, device="cpu")
+
+
+def run_load(pipeline, prompts, clients, requests_per_client, max_new_tokens, stream=False):
+    """
+    @brief Runs `clients` threads, each sending `requests_per_client` prompts back to back.
+
+    @param stream: Stream each answer through `stream_pipeline` instead of waiting for it.
+
+    @return: dict - Requests per second, generated tokens per second and latency summary.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        for i in range(requests_per_client):
+            prompt = prompts[(index * requests_per_client + i) % len(prompts)]
+            started = time.perf_counter()
+            kwargs = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False}
+            if stream:
+                from pages.chatbot.chatbot_model import stream_pipeline
+                for _ in stream_pipeline(pipeline, prompt, **kwargs):
+                    pass
+            else:
+                pipeline(prompt, return_full_text=False, **kwargs)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return {
+        "requests_per_second": round(len(latencies) / wall, 3),
+        "tokens_per_second": round(len(latencies) * max_new_tokens / wall, 2),
+        "latency_seconds": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the LLM micro-batching scheduler.")
+    parser.add_argument("--model", default="distilgpt2", help="HuggingFace causal LM to serve.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 8, 16], help="Concurrent clients.")
+    parser.add_argument("--requests", type=int, default=4, help="Requests per client.")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=BATCH_MAX_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=BATCH_MAX_WAIT_MS)
+    parser.add_argument("--stream", action="store_true", help="Stream the answers token by token.")
+    parser.add_argument("--output", default="results/batching.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    pipeline = load_pipeline(args.model)
+    prompts = [f"Question: {q['question']}\nAnswer:" for q in load_questions()]
+    pipeline(prompts[0], max_new_tokens=4)  # Warm-up
+
+    results = {"model": args.model, "max_new_tokens": args.max_new_tokens, "stream": args.stream, "runs": []}
+    for clients in args.clients:
+        direct = run_load(pipeline, prompts, clients, args.requests, args.max_new_tokens, args.stream)
+        batched_pipeline = BatchedPipeline(pipeline, args.max_batch_size, args.max_wait_ms)
+        batched = run_load(batched_pipeline, prompts, clients, args.requests, args.max_new_tokens, args.stream)
+        batched["batching"] = batched_pipeline.stats()
+        speedup = batched["requests_per_second"] / max(direct["requests_per_second"], 1e-9)
+        results["runs"].append({"clients": clients, "direct": direct, "batched": batched,
+                                "speedup": round(speedup, 2)})
+        print(f"{clients:>3} clients: direct {direct['requests_per_second']} req/s, "
+              f"batched {batched['requests_per_second']} req/s (x{speedup:.2f}, "
+              f"mean batch {batched['batching']['mean_batch_size']})")
+
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares the chain strategies of local models (stuff, refine, map_reduce) on the
+labelled questions: latency, number of LLM calls, prompt size and answer quality.
+
+    python -m benchmarks.bench_chain_strategies --model LLAMA2 --output results/strategies.json
+"""
+import argparse
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from benchmarks.common import load_questions, token_f1, figure_hit, summarize, write_results
+from pages.chatbot.chatbot_config import MODEL_NAME, CHAIN_STRATEGIES
+from pages.chatbot.chatbot_registry import registry
+
+
+class CallCounter(BaseCallbackHandler):
+    """
+    @brief Counts the LLM generations of a chain run.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls += len(prompts)
+
+
+def answer(model, strategy, question, docs):
+    """
+    @brief Answers one question without streaming.
+
+    @param model: The model lent by the pool (see `ModelPool.use`).
+
+    @return: Tuple[str, int, int] - Answer, LLM calls and prompt tokens of the context.
+    """
+    from pages.chatbot.chatbot_context import merge_overlapping
+    from pages.chatbot.chatbot_model import build_stuffed_prompt, run_pipeline, token_counter
+
+    llm = model.llm
+    chain = model.chains[strategy]
+    count_tokens = token_counter(llm.pipeline.tokenizer)
+    if strategy == "stuff":
+        prompt, _ = build_stuffed_prompt(chain, llm.pipeline, docs, question)
+        return run_pipeline(llm.pipeline, prompt), 1, count_tokens(prompt)
+
+    docs = merge_overlapping(docs)
+    counter = CallCounter()
+    output = chain.run({"input_documents": docs, "question": question}, callbacks=[counter])
+    return output, counter.calls, sum(count_tokens(doc.page_content) for doc in docs)
+
+
+def run_strategy(model, strategy, questions, contexts):
+    """
+    @brief Answers every question with one strategy.
+
+    @return: dict - Latency, LLM calls, context tokens, answer quality and the answers.
+    """
+    latencies, calls, tokens, f1s, hits, answers = [], [], [], [], [], []
+    for q, docs in zip(questions, contexts):
+        start = time.perf_counter()
+        output, n_calls, n_tokens = answer(model, strategy, q["question"], docs)
+        latencies.append(time.perf_counter() - start)
+        calls.append(n_calls)
+        tokens.append(n_tokens)
+        f1s.append(token_f1(output, q["answer"]))
+        hits.append(figure_hit(output, q["figures"]))
+        answers.append({"question": q["question"], "answer": output})
+
+    return {
+        "latency_seconds": summarize(latencies),
+        "llm_calls": summarize(calls),
+        "context_tokens": summarize(tokens),
+        "token_f1": round(sum(f1s) / len(f1s), 4),
+        "figure_accuracy": round(sum(hits) / len(hits), 4),
+        "answers": answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chain strategies of local models.")
+    parser.add_argument("--model", default=MODEL_NAME, help="Local model: LLAMA2 or FLANT5.")
+    parser.add_argument("--strategies", nargs="+", default=list(CHAIN_STRATEGIES), choices=CHAIN_STRATEGIES)
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of questions.")
+    parser.add_argument("--output", default="results/chain_strategies.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    if args.model == "GPT":
+        parser.error("Chain strategies only apply to local models: use --model LLAMA2 or FLANT5.")
+
+    questions = load_questions(limit=args.limit)
+    embeddings, retriever = registry.get("embeddings"), registry.get("retriever")
+
+    # Retrieve once: every strategy answers from the same documents
+    contexts = [retriever.search(q["question"], embeddings.embed_query(q["question"])) for q in questions]
+
+    results = {"model": args.model, "questions": len(questions), "strategies": {}}
+    with registry.get("models").use(args.model) as model:
+        for strategy in args.strategies:
+            results["strategies"][strategy] = run_strategy(model, strategy, questions, contexts)
+            print(f"{strategy:>10}: p50 {results['strategies'][strategy]['latency_seconds']['p50']}s, "
+                  f"F1 {results['strategies'][strategy]['token_f1']}, "
+                  f"figures {results['strategies'][strategy]['figure_accuracy']}")
+
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
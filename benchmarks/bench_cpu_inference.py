@@ -0,0 +1,162 @@
+"""
+Compares CPU inference paths: the PyTorch embedder against ONNX Runtime, and a
+float32 generator against its int8 dynamically quantized version. Each variant
+runs in a fresh process, so its memory figures are its own.
+
+    python -m benchmarks.bench_cpu_inference --output results/cpu_inference.json
+    python -m benchmarks.bench_cpu_inference --model meta-llama/Llama-2-7b-chat-hf --skip-embeddings
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+from benchmarks.common import load_questions, summarize, write_results
+
+try:
+    import resource  # Unix only, fallback for the memory figures
+except ImportError:
+    resource = None
+
+
+def rss_mb():
+    """
+    @return: float - Resident memory of the process in MB.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else 0.0
+
+
+def corpus_texts(limit):
+    """
+    @return: List[str] - Up to `limit` chunks of the filings of data/ (questions if there are none).
+    """
+    from pages.chatbot.chatbot_ingest import discover_filings, parse_filing
+
+    texts = []
+    for source in discover_filings():
+        texts += [text for text, _ in parse_filing(source)[2]]
+        if len(texts) >= limit:
+            break
+    return texts[:limit] or [q["question"] for q in load_questions()]
+
+
+def measure_embeddings(backend, texts, queries):
+    """
+    @brief Loads one embedding backend and times chunk batches and single queries.
+    """
+    baseline = rss_mb()
+    started = time.perf_counter()
+    if backend == "onnx":
+        from pages.chatbot.chatbot_onnx import OnnxEmbeddings
+        embeddings = OnnxEmbeddings()
+    else:
+        from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+        from pages.chatbot.chatbot_config import EMBEDDING_MODEL_NAME
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs={"device": "cpu"})
+    load_seconds = time.perf_counter() - started
+    embeddings.embed_query(queries[0])  # Warm-up
+
+    started = time.perf_counter()
+    embeddings.embed_documents(texts)
+    batch_seconds = time.perf_counter() - started
+
+    latencies, vectors = [], []
+    for query in queries:
+        started = time.perf_counter()
+        vectors.append(embeddings.embed_query(query))
+        latencies.append(time.perf_counter() - started)
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "memory_mb": round(rss_mb() - baseline, 1),
+        "chunks_per_second": round(len(texts) / batch_seconds, 2),
+        "query_latency_seconds": summarize(latencies),
+        "vectors": vectors,
+    }
+
+
+def measure_generator(model_name, quantize, prompts, max_new_tokens):
+    """
+    @brief Loads a causal LM on CPU (optionally int8 quantized) and times answers.
+    """
+    baseline = rss_mb()
+    started = time.perf_counter()
+    import transformers
+    from pages.chatbot.chatbot_model import load_kwargs, quantize_dynamic
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+    model = transformers.AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs())
+    if quantize:
+        model = quantize_dynamic(model)
+    pipeline = transformers.pipeline("text-generation", model=model, tokenizer=tokenizer, device="cpu")
+    load_seconds = time.perf_counter() - started
+    pipeline(prompts[0], max_new_tokens=4)  # Warm-up
+
+    latencies = []
+    for prompt in prompts:
+        started = time.perf_counter()
+        pipeline(prompt, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                 do_sample=False, return_full_text=False)
+        latencies.append(time.perf_counter() - started)
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "memory_mb": round(rss_mb() - baseline, 1),
+        "answer_latency_seconds": summarize(latencies),
+        "tokens_per_second": round(len(prompts) * max_new_tokens / sum(latencies), 2),
+    }
+
+
+def isolated(function, *args):
+    """
+    @brief Runs a measurement in a fresh process.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    return dot / ((sum(x * x for x in a) * sum(y * y for y in b)) ** 0.5 or 1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU inference mode.")
+    parser.add_argument("--model", default="distilgpt2", help="Causal LM compared in float32 and int8.")
+    parser.add_argument("--chunks", type=int, default=256, help="Filing chunks embedded in one batch.")
+    parser.add_argument("--prompts", type=int, default=5, help="Questions answered per generator.")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--skip-embeddings", action="store_true")
+    parser.add_argument("--skip-generator", action="store_true")
+    parser.add_argument("--output", default="results/cpu_inference.json", help="JSON results file.")
+    args = parser.parse_args()
+    os.environ["INFERENCE_MODE"] = "cpu"  # Inherited by the measuring processes
+
+    questions = [q["question"] for q in load_questions()]
+    results = {"model": args.model, "max_new_tokens": args.max_new_tokens}
+
+    if not args.skip_embeddings:
+        texts = corpus_texts(args.chunks)
+        embeddings = {backend: isolated(measure_embeddings, backend, texts, questions)
+                      for backend in ("torch", "onnx")}
+        torch_vectors, onnx_vectors = embeddings["torch"].pop("vectors"), embeddings["onnx"].pop("vectors")
+        embeddings["min_cosine_similarity"] = round(min(map(cosine, torch_vectors, onnx_vectors)), 6)
+        embeddings["chunks"] = len(texts)
+        results["embeddings"] = embeddings
+        print(f"embeddings: {embeddings}")
+
+    if not args.skip_generator:
+        prompts = [f"Question: {question}\nAnswer:" for question in questions[:args.prompts]]
+        results["generator"] = {
+            name: isolated(measure_generator, args.model, quantize, prompts, args.max_new_tokens)
+            for name, quantize in (("float32", False), ("int8", True))
+        }
+        print(f"generator: {results['generator']}")
+
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
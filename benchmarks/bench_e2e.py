@@ -0,0 +1,366 @@
+"""
+End-to-end benchmark of the chatbot, offline: the real ingestion, embedding and
+retrieval path runs on the filings of data/ in a fresh persist directory, while
+GPT is replaced by a deterministic extractive stand-in (no API key, no network).
+Reports ingest time, index size, retrieval latency percentiles, recall@k on the
+labelled questions and end-to-end throughput under concurrent clients.
+
+    python -m benchmarks.bench_e2e --output results/e2e.json
+    python -m benchmarks.bench_e2e --baseline results/e2e.json   # Flags regressions, exit code 1
+    python -m benchmarks.bench_e2e --fake-embeddings             # Smoke run without the embedding model
+    python -m benchmarks.bench_e2e --rerank                      # With the cross-encoder (downloads it)
+
+The chatbot settings are read from the environment when its modules are imported,
+so they are set (persist directory, caches, model) before the first import.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import load_questions, figure_hit, summarize, write_results
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\\n|\n")
+
+# (metric path, direction): the metrics compared against a baseline run
+TRACKED_METRICS = [
+    (("ingest", "wall_seconds"), "lower"),
+    (("index_bytes",), "lower"),
+    (("retrieval", "latency_seconds", "p95"), "lower"),
+    (("retrieval", "recall_at_k"), "higher"),
+    (("answers", "figure_hit_rate"), "higher"),
+]
+
+
+# -------------------------------------------------------------------------
+# Stand-in Language Model
+# -------------------------------------------------------------------------
+
+def build_stub_llm(latency):
+    """
+    @brief Creates a deterministic chat model standing in for the hosted GPT model.
+
+    @details The model answers with the context sentence sharing the most words with
+             the question, so answers depend on retrieval only, and streams it word
+             by word after `latency` seconds (the API round trip).
+
+    @param latency: Seconds waited before the first token.
+    @return: BaseChatModel
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+    from benchmarks.common import _words
+
+    def extract(prompt):
+        question, _, context = prompt.partition("Context:")
+        question = question.rpartition("Question:")[2]
+        context = context.rpartition("Answer:")[0]
+        words = set(_words(question))
+        sentences = [s.strip() for s in SENTENCE_PATTERN.split(context) if s.strip()]
+        if not sentences:
+            return "I don't know."
+        return max(sentences, key=lambda s: len(words.intersection(_words(s))))
+
+    class ExtractiveChatModel(BaseChatModel):
+        delay: float = 0.0
+
+        @property
+        def _llm_type(self):
+            return "extractive-stub"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.delay)
+            answer = extract(messages[-1].content)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.delay)
+            for word in re.split(r"(\s+)", extract(messages[-1].content)):
+                if word:
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    return ExtractiveChatModel(delay=latency)
+
+
+# -------------------------------------------------------------------------
+# Benchmark Stages
+# -------------------------------------------------------------------------
+
+def configure(directory, data_dir, rerank=False):
+    """
+    @brief Points the chatbot settings at a fresh persist directory, before its modules load.
+
+    @details The semantic answer cache and the embedding cache are disabled so every
+             question runs the full path and the embedding time is measured cold.
+             The cross-encoder reranker only runs with `rerank`, as it needs its model.
+    """
+    imported = [name for name in sys.modules if name.startswith("pages.chatbot")]
+    if imported:
+        raise RuntimeError(f"{imported[0]} was imported before the benchmark settings were applied")
+    os.environ.update({
+        "PERSIST_DIRECTORY": directory,
+        "DATA_DIR": data_dir,
+        "MODEL_NAME": "GPT",
+        "MODELS": "GPT",
+        "SEMANTIC_CACHE": "0",
+        "EMBEDDING_CACHE": "0",
+        "STREAMING": "1",
+        "RERANK": "1" if rerank else "0",
+    })
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def ingest(registry, embeddings):
+    """
+    @brief Embeds the corpus into the persist directory and installs the vector store.
+
+    @return: dict - Ingestion counters and throughput.
+    """
+    from pages.chatbot.chatbot_config import PERSIST_DIRECTORY, index_settings
+    from pages.chatbot.chatbot_index import IngestManifest
+    from pages.chatbot.chatbot_ingest import ingest_corpus
+    from pages.chatbot.chatbot_model import build_vectordb
+
+    registry.provide("embeddings", embeddings)
+    vectordb = build_vectordb(embeddings, ingest=False)
+    stats = ingest_corpus(vectordb, embeddings, IngestManifest(PERSIST_DIRECTORY, index_settings()))
+    print(stats.report())
+    registry.provide("vectordb", vectordb)
+    return stats.as_dict()
+
+
+def measure_retrieval(retriever, embeddings, questions, k, repeats, reranker=None, candidates=None):
+    """
+    @brief Times query embedding plus retrieval (and reranking) and scores recall@k.
+
+    @details A question is recalled when one of its top-k chunks states an expected figure.
+             With a reranker, `candidates` chunks are retrieved and the best k kept; the
+             score cache is cleared before each pass so every pass pays the model.
+
+    @return: dict - Latency summary, recall@k and the questions missed.
+    """
+    latencies, missed = [], []
+    for repeat in range(repeats):
+        if reranker is not None:
+            reranker.clear()
+        for q in questions:
+            started = time.perf_counter()
+            docs = retriever.search(q["question"], embeddings.embed_query(q["question"]),
+                                    k=candidates if reranker is not None else k)
+            if reranker is not None:
+                docs = reranker.rerank(q["question"], docs, top_k=k)
+            latencies.append(time.perf_counter() - started)
+            if not repeat and not any(figure_hit(doc.page_content, q["figures"]) for doc in docs):
+                missed.append(q["question"])
+    return {
+        "k": k,
+        "latency_seconds": summarize(latencies),
+        "recall_at_k": round(1 - len(missed) / len(questions), 4),
+        "missed": missed,
+    }
+
+
+def run_load(questions, clients, requests_per_client):
+    """
+    @brief Runs `clients` threads, each asking `requests_per_client` questions back to back
+           through the chatbot pipeline.
+
+    @return: dict - Questions per second, latency and time to first token summaries, answers
+                    stating an expected figure and errors.
+    """
+    from pages.chatbot.chatbot_pipeline import answer_question
+
+    latencies, first_tokens, answers, errors = [], [], [], []
+    lock = threading.Lock()
+
+    def client(index):
+        for i in range(requests_per_client):
+            q = questions[(index * requests_per_client + i) % len(questions)]
+            first = []  # Time of the first streamed piece
+
+            def emit(piece):
+                if not first:
+                    first.append(time.perf_counter())
+
+            started = time.perf_counter()
+            try:
+                answer = answer_question(q["question"], "GPT", emit=emit)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                first_tokens.extend(t - started for t in first)
+                answers.append(figure_hit(answer or "", q["figures"]))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return {
+        "clients": clients,
+        "questions_per_second": round(len(latencies) / wall, 3),
+        "latency_seconds": summarize(latencies),
+        "first_token_seconds": summarize(first_tokens),
+        "answers": len(answers),
+        "figure_hits": sum(answers),
+        "errors": len(errors),
+    }
+
+
+# -------------------------------------------------------------------------
+# Regression Check
+# -------------------------------------------------------------------------
+
+def _lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    @brief Lists the tracked metrics that got worse than the baseline by more than `tolerance`.
+
+    @details Timings, sizes and throughput are compared relatively; rates (recall, figure
+             hits) in absolute points, since a small drop already matters.
+
+    @return: List[str] - One line per regression.
+    """
+    tracked = list(TRACKED_METRICS)
+    for run in baseline.get("load", []):
+        tracked.append((("load", run["clients"], "questions_per_second"), "higher"))
+        tracked.append((("load", run["clients"], "latency_seconds", "p95"), "lower"))
+    current = {**results, "load": {run["clients"]: run for run in results.get("load", [])}}
+    previous = {**baseline, "load": {run["clients"]: run for run in baseline.get("load", [])}}
+
+    regressions = []
+    for path, direction in tracked:
+        new, old = _lookup(current, path), _lookup(previous, path)
+        if new is None or old is None:
+            continue
+        is_rate = path[-1] in ("recall_at_k", "figure_hit_rate")
+        change = (new - old) if is_rate else (new - old) / max(abs(old), 1e-9)
+        worse = -change if direction == "higher" else change
+        if worse > (0.01 if is_rate else tolerance):
+            regressions.append(f"{'.'.join(map(str, path))}: {old} -> {new}")
+    return regressions
+
+
+# -------------------------------------------------------------------------
+# Entry Point
+# -------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark with a stand-in LLM.")
+    parser.add_argument("--data-dir", default="data", help="Directory walked for PDF filings.")
+    parser.add_argument("--k", type=int, default=None, help="Chunks kept per question (RETRIEVAL_K, or RERANK_TOP_K with --rerank).")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed passes over the questions.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 8, 16], help="Concurrent clients.")
+    parser.add_argument("--requests", type=int, default=8, help="Questions per client.")
+    parser.add_argument("--llm-latency-ms", type=float, default=300,
+                        help="Simulated API latency of the stand-in model before its first token.")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Hash-based embeddings instead of the model: dense recall is meaningless.")
+    parser.add_argument("--rerank", action="store_true",
+                        help="Rerank RERANK_CANDIDATES chunks with the cross-encoder (RERANK=1).")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown (or size increase) reported as a regression.")
+    parser.add_argument("--output", default="results/e2e.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench-e2e-")
+    configure(directory, args.data_dir, rerank=args.rerank)
+    try:
+        from pages.chatbot.chatbot_config import (
+            RETRIEVAL_K, RETRIEVAL_MODE, EMBEDDING_MODEL_NAME, RERANK_TOP_K, RERANK_CANDIDATES
+        )
+        from pages.chatbot.chatbot_pool import ModelPool
+        from pages.chatbot.chatbot_registry import registry
+
+        if args.fake_embeddings:
+            from langchain_core.embeddings import DeterministicFakeEmbedding
+            embeddings = DeterministicFakeEmbedding(size=768)
+        else:
+            from pages.chatbot.chatbot_model import build_embeddings
+            embeddings = build_embeddings()
+
+        # GPT is served by the stand-in; the chains are the application's own
+        def load_stub(name):
+            from pages.chatbot.chatbot_model import build_chains
+            llm = build_stub_llm(args.llm_latency_ms / 1000)
+            return llm, build_chains(name, llm)
+
+        pool = ModelPool()
+        pool.register("GPT", load_stub, memory_mb=0)
+        pool.load("GPT")
+        registry.provide("models", pool)
+
+        questions = load_questions()
+        results = {
+            "embedding_model": "fake" if args.fake_embeddings else EMBEDDING_MODEL_NAME,
+            "retrieval_mode": RETRIEVAL_MODE,
+            "rerank": args.rerank,
+            "llm_latency_ms": args.llm_latency_ms,
+            "questions": len(questions),
+            "ingest": ingest(registry, embeddings),
+        }
+        results["index_bytes"] = directory_size(directory)
+
+        started = time.perf_counter()
+        retriever = registry.get("retriever")
+        results["lexical_index_seconds"] = round(time.perf_counter() - started, 3)
+
+        reranker = registry.get("reranker")
+        k = args.k or (RERANK_TOP_K if reranker is not None else RETRIEVAL_K)
+        results["retrieval"] = measure_retrieval(retriever, embeddings, questions, k, args.repeats,
+                                                 reranker, RERANK_CANDIDATES)
+        print(f"Retrieval: recall@{results['retrieval']['k']} {results['retrieval']['recall_at_k']}, "
+              f"p95 {results['retrieval']['latency_seconds']['p95']}s")
+
+        results["load"] = []
+        for clients in args.clients:
+            run = run_load(questions, clients, args.requests)
+            results["load"].append(run)
+            print(f"{clients:>3} clients: {run['questions_per_second']} questions/s, "
+                  f"p95 {run['latency_seconds']['p95']}s, {run['errors']} errors")
+        # Share of answers stating an expected figure: retrieval and prompt quality, end to end
+        answered = sum(run["answers"] for run in results["load"])
+        hits = sum(run["figure_hits"] for run in results["load"])
+        results["answers"] = {"answered": answered, "figure_hit_rate": round(hits / answered, 4) if answered else None}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["baseline"] = args.baseline
+        results["regressions"] = regressions
+        print("\n".join(["Regressions against the baseline:"] + regressions) if regressions
+              else "No regression against the baseline.")
+
+    write_results(args.output, results)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures the numeric answer path on the filings of data/: facts extracted per filing
+and extraction time, then, on the labelled questions, the share answered from the
+facts (coverage), the share of those stating an expected figure (precision) and the
+lookup latency. Questions not answered here go through retrieval and the LLM; those
+labelled "fallback" must be, and count as wrong answers otherwise.
+
+    python -m benchmarks.bench_facts --output results/facts.json
+"""
+import argparse
+import time
+
+from benchmarks.common import load_questions, figure_hit, summarize, write_results
+from pages.chatbot.chatbot_config import DATA_DIR
+from pages.chatbot.chatbot_facts import FactStore
+from pages.chatbot.chatbot_ingest import discover_filings, parse_facts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the answers from extracted facts.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Directory walked for PDF filings.")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed passes over the questions.")
+    parser.add_argument("--output", default="results/facts.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    stores, extraction = [], {}
+    for source in discover_filings(args.data_dir):
+        started = time.perf_counter()
+        stores.append(parse_facts(source))
+        extraction[source] = {"facts": len(stores[-1]), "seconds": round(time.perf_counter() - started, 3)}
+        print(f"{source}: {extraction[source]['facts']} facts in {extraction[source]['seconds']}s")
+    store = FactStore.concat(stores)
+
+    questions = load_questions()
+    latencies, answered = [], []
+    for repeat in range(args.repeats):
+        for q in questions:
+            started = time.perf_counter()
+            answer = store.answer(q["question"])
+            latencies.append(time.perf_counter() - started)
+            if not repeat and answer is not None:
+                answered.append({"question": q["question"], "answer": answer, "fallback": q.get("fallback", False),
+                                 "correct": not q.get("fallback") and figure_hit(answer, q["figures"])})
+
+    correct = sum(entry["correct"] for entry in answered)
+    missed_fallbacks = sum(entry["fallback"] for entry in answered)
+    results = {
+        "filings": extraction,
+        "facts": len(store),
+        "questions": len(questions),
+        "coverage": round(len(answered) / len(questions), 4) if questions else None,
+        "precision": round(correct / len(answered), 4) if answered else None,
+        "fallbacks": sum(bool(q.get("fallback")) for q in questions),
+        "missed_fallbacks": missed_fallbacks,
+        "latency_seconds": summarize(latencies),
+        "answered": answered,
+    }
+    print(f"Answered {len(answered)}/{len(questions)} questions from {len(store)} facts, "
+          f"{correct} stating an expected figure, {missed_fallbacks} answered instead of falling back, p95 {results['latency_seconds']['p95'] * 1000:.2f} ms")
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Load test of the LLM gateway against the mock OpenAI server (benchmarks/mock_openai.py,
+started in-process unless --base-url is given). Concurrent clients ask the labelled
+questions through the asynchronous API on one event loop (or threads with --api sync),
+a share of them asking the same question at the same time. Each run is repeated with
+and without coalescing, and reports the requests that reached the server, the 429s and
+retries absorbed by the gateway, failures and latency.
+
+    python -m benchmarks.bench_gateway --clients 64 --duplicate-share 0.5 --server-rps 20
+"""
+import argparse
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_questions, summarize, write_results
+from benchmarks.mock_openai import MockState, serve
+from pages.chatbot.chatbot_gateway import LLMGateway
+
+
+def build_prompts(questions, clients, duplicate_share):
+    """
+    @return: List[list] - One chat prompt per client; `duplicate_share` of them repeat
+             the prompt of another client.
+    """
+    distinct = max(1, math.ceil(clients * (1 - duplicate_share)))
+    return [[{"role": "user", "content": f"Question: {questions[i % distinct % len(questions)]['question']}"}]
+            for i in range(clients)]
+
+
+def run_async(gateway, prompts):
+    latencies, first_tokens, failures = [], [], []
+
+    async def client(messages):
+        started = time.perf_counter()
+        try:
+            first = None
+            async for _ in gateway.astream(messages, temperature=0):
+                first = first or time.perf_counter() - started
+            latencies.append(time.perf_counter() - started)
+            first_tokens.append(first or 0.0)
+        except Exception as e:
+            failures.append(str(e))
+
+    async def run():
+        await asyncio.gather(*(client(messages) for messages in prompts))
+
+    asyncio.run(run())
+    return latencies, first_tokens, failures
+
+
+def run_sync(gateway, prompts):
+    latencies, first_tokens, failures = [], [], []
+
+    def client(messages):
+        started = time.perf_counter()
+        try:
+            first = None
+            for _ in gateway.stream(messages, temperature=0):
+                first = first or time.perf_counter() - started
+            latencies.append(time.perf_counter() - started)
+            first_tokens.append(first or 0.0)
+        except Exception as e:
+            failures.append(str(e))
+
+    with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+        list(pool.map(client, prompts))
+    return latencies, first_tokens, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the LLM gateway against a mock OpenAI server.")
+    parser.add_argument("--base-url", default="", help="OpenAI-compatible API (default: in-process mock).")
+    parser.add_argument("--api", choices=["async", "sync"], default="async")
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent questions.")
+    parser.add_argument("--duplicate-share", type=float, default=0.5, help="Share of repeated questions.")
+    parser.add_argument("--requests-per-minute", type=float, default=0, help="Gateway rate limit (0: none).")
+    parser.add_argument("--server-rps", type=float, default=20, help="Mock requests per second before 429.")
+    parser.add_argument("--server-error-rate", type=float, default=0.05, help="Mock share of 500 responses.")
+    parser.add_argument("--latency-ms", type=float, default=200, help="Mock latency before the first token.")
+    parser.add_argument("--output", default="results/gateway.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    state = None
+    base_url = args.base_url
+    if not base_url:
+        state = MockState(args.latency_ms / 1000, 0.005, args.server_rps, args.server_error_rate)
+        _, state, base_url = serve(state=state)
+    prompts = build_prompts(load_questions(), args.clients, args.duplicate_share)
+
+    runs = {}
+    for coalesce in (False, True):
+        if state is not None:
+            state.reset()
+        gateway = LLMGateway(base_url=base_url, api_key="mock", coalesce=coalesce,
+                             requests_per_minute=args.requests_per_minute, tokens_per_minute=0)
+        started = time.perf_counter()
+        latencies, first_tokens, failures = (run_async if args.api == "async" else run_sync)(gateway, prompts)
+        wall = time.perf_counter() - started
+        name = "coalesced" if coalesce else "direct"
+        runs[name] = {
+            "wall_seconds": round(wall, 3),
+            "answered": len(latencies),
+            "failed": len(failures),
+            "server": state.stats() if state is not None else None,
+            "gateway": gateway.stats(),
+            "latency_seconds": summarize(latencies),
+            "time_to_first_token_seconds": summarize(first_tokens),
+            "errors": sorted(set(failures))[:5],
+        }
+        server = runs[name]["server"] or {}
+        print(f"{name}: {len(latencies)}/{len(prompts)} answered in {wall:.2f}s, "
+              f"{server.get('requests', '?')} requests reached the server "
+              f"({server.get('rate_limited', '?')} rate limited), {gateway.retries} retries, "
+              f"{gateway.coalesced} coalesced, p95 {runs[name]['latency_seconds']['p95']}s")
+
+    write_results(args.output, {"api": args.api, "clients": args.clients,
+                                "duplicate_share": args.duplicate_share, "runs": runs})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Compares text splitters on the filings of data/: chunk count, characters, index
+size on disk, embedding time and retrieval recall on the labelled questions (a
+question is recalled when one of its top-k chunks states an expected figure).
+
+    python -m benchmarks.bench_splitter --output results/splitter.json
+    python -m benchmarks.bench_splitter --fake-embeddings   # Sizes and lexical recall only
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import load_questions, figure_hit, write_results
+from pages.chatbot.chatbot_config import DATA_DIR, EMBEDDING_MODEL_NAME, EMBEDDING_BATCH_SIZE, RETRIEVAL_K
+from pages.chatbot.chatbot_ingest import discover_filings, parse_filing
+from pages.chatbot.chatbot_retrieval import BM25Index, HybridRetriever
+
+# (name, splitter, chunk size, chunk overlap); the first one is the baseline
+CONFIGURATIONS = [
+    ("recursive-500-300", "recursive", 500, 300),
+    ("filing-500-50", "filing", 500, 50),
+]
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def build_index(chunks, embeddings, directory):
+    """
+    @brief Embeds the chunks into a fresh Chroma collection.
+
+    @return: Tuple[Chroma, float] - The vector store and the seconds spent embedding.
+    """
+    from langchain_community.vectorstores import Chroma
+
+    vectordb = Chroma(persist_directory=directory, embedding_function=embeddings)
+    embed_seconds = 0.0
+    for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+        batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
+        texts = [text for text, _ in batch]
+        began = time.perf_counter()
+        vectors = embeddings.embed_documents(texts)
+        embed_seconds += time.perf_counter() - began
+        vectordb._collection.upsert(
+            ids=[f"chunk-{start + i:06d}" for i in range(len(batch))],
+            embeddings=vectors, documents=texts, metadatas=[metadata for _, metadata in batch],
+        )
+    return vectordb, embed_seconds
+
+
+def recall(questions, search, k):
+    """
+    @return: float - Share of questions with an expected figure in their top-k chunks.
+    """
+    hits = [
+        any(figure_hit(doc.page_content, q["figures"]) for doc in search(q["question"], k))
+        for q in questions
+    ]
+    return round(sum(hits) / len(hits), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text splitters.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Directory walked for PDF filings.")
+    parser.add_argument("--k", type=int, default=RETRIEVAL_K, help="Chunks retrieved per question.")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Skip the embedding model: report sizes and lexical recall only.")
+    parser.add_argument("--output", default="results/splitter.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    if args.fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        embeddings = DeterministicFakeEmbedding(size=768)
+    else:
+        from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+    questions = load_questions()
+    sources = discover_filings(args.data_dir)
+    results = {"filings": len(sources), "questions": len(questions), "k": args.k, "splitters": {}}
+
+    for name, splitter, chunk_size, chunk_overlap in CONFIGURATIONS:
+        began = time.perf_counter()
+        chunks = [
+            chunk for source in sources
+            for chunk in parse_filing(source, chunk_size, chunk_overlap, splitter)[2]
+        ]
+        split_seconds = time.perf_counter() - began
+
+        directory = tempfile.mkdtemp(prefix=f"bench-{name}-")
+        try:
+            vectordb, embed_seconds = build_index(chunks, embeddings, directory)
+            data = vectordb.get(include=["documents", "metadatas"])
+            lexical = BM25Index.build(data["ids"], data["documents"], data["metadatas"])
+            retriever = HybridRetriever(vectorstore=vectordb, embeddings=embeddings, lexical_index=lexical)
+
+            entry = {
+                "chunks": len(chunks),
+                "characters": sum(len(text) for text, _ in chunks),
+                "index_bytes": directory_size(directory),
+                "split_seconds": round(split_seconds, 3),
+                "embed_seconds": round(embed_seconds, 3),
+                "recall_lexical": recall(
+                    questions, lambda q, k: [lexical.document(i) for i, _ in lexical.search(q, k)], args.k
+                ),
+            }
+            if not args.fake_embeddings:
+                retriever.mode = "dense"
+                entry["recall_dense"] = recall(questions, lambda q, k: retriever.search(q, k=k), args.k)
+                retriever.mode = "hybrid"
+                entry["recall_hybrid"] = recall(questions, lambda q, k: retriever.search(q, k=k), args.k)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        baseline = next(iter(results["splitters"].values()), None)
+        if baseline:
+            for metric in ("chunks", "characters", "index_bytes"):
+                entry[f"{metric}_reduction"] = round(1 - entry[metric] / max(baseline[metric], 1), 4)
+        results["splitters"][name] = entry
+        print(f"{name:>20}: " + ", ".join(f"{key} {value}" for key, value in entry.items()))
+
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
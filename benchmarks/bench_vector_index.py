@@ -0,0 +1,160 @@
+"""
+Recall / latency / memory trade-off of the dense search engines: exact float32 scan,
+Chroma's HNSW graph over a grid of (M, ef_construction, ef_search), and the quantized
+NumPy backend (sq8, pq) with and without exact re-ranking. Recall@k is measured
+against the exact neighbours.
+
+    python -m benchmarks.bench_vector_index --output results/vector_index.json
+    python -m benchmarks.bench_vector_index --synthetic 200000   # Corpus of hundreds of filings
+
+Vectors come from the persisted Chroma collection (or a synthetic clustered corpus);
+queries are corpus vectors with noise added. The HNSW grid runs on hnswlib, the
+library inside Chroma, so ef_search can vary without rebuilding the graph.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import summarize, write_results
+from pages.chatbot.chatbot_config import PERSIST_DIRECTORY, RETRIEVAL_K, HYBRID_FETCH_K
+from pages.chatbot.chatbot_quantized import QuantizedIndex
+
+
+def load_vectors(persist_directory):
+    import chromadb
+
+    client = chromadb.PersistentClient(path=persist_directory)
+    collection = client.get_collection(client.list_collections()[0])
+    return np.asarray(collection.get(include=["embeddings"])["embeddings"], dtype=np.float32)
+
+
+def synthetic_vectors(count, dimension, seed=0):
+    """
+    @return: np.ndarray - Unit vectors around random topics, like sentence embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(max(count // 100, 1), dimension))
+    vectors = topics[rng.integers(0, len(topics), count)] + 0.5 * rng.normal(size=(count, dimension))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors, count, noise, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), count)] + noise * rng.normal(size=(count, vectors.shape[1]))
+    queries = queries.astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def exact_neighbours(vectors, queries, k):
+    norms = (vectors ** 2).sum(axis=1)
+    return [np.argsort(norms - 2 * vectors @ query)[:k] for query in queries]
+
+
+def measure(search, queries, truth, k):
+    """
+    @brief Runs every query through `search(query, k) -> positions`.
+
+    @return: dict - Recall@k against the exact neighbours and latency summary.
+    """
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        found = search(query, k)
+        latencies.append(time.perf_counter() - started)
+        hits += len(set(expected.tolist()) & set(int(p) for p in found))
+    return {"recall": round(hits / (len(queries) * k), 4), "latency_seconds": summarize(latencies)}
+
+
+def hnsw_curve(vectors, queries, truth, k, m_values, ef_construction, ef_search_values):
+    import hnswlib
+
+    for m in m_values:
+        index = hnswlib.Index(space="l2", dim=vectors.shape[1])
+        started = time.perf_counter()
+        index.init_index(max_elements=len(vectors), M=m, ef_construction=ef_construction)
+        index.add_items(vectors, np.arange(len(vectors)))
+        build_seconds = time.perf_counter() - started
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index.bin")
+            index.save_index(path)
+            memory_bytes = os.path.getsize(path)  # float32 vectors plus graph links
+        for ef_search in ef_search_values:
+            index.set_ef(max(ef_search, k))
+            entry = measure(lambda q, n: index.knn_query(q, k=n)[0][0], queries, truth, k)
+            yield {"backend": "chroma-hnsw", "M": m, "ef_construction": ef_construction, "ef_search": ef_search,
+                   "build_seconds": round(build_seconds, 3), "memory_bytes": memory_bytes, **entry}
+
+
+def quantized_curve(vectors, queries, truth, k, pq_subspaces, rerank_values):
+    ids = [str(i) for i in range(len(vectors))]
+    texts = [""] * len(vectors)
+    metadatas = [{}] * len(vectors)
+    configurations = [("sq8", None)] + [("pq", s) for s in pq_subspaces if vectors.shape[1] % s == 0]
+    for method, subspaces in configurations:
+        started = time.perf_counter()
+        index = QuantizedIndex.build(ids, vectors, texts, metadatas, method=method, subspaces=subspaces or 1)
+        build_seconds = time.perf_counter() - started
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(directory)  # Re-ranking reads the memory-mapped vectors, as in the server
+            for rerank in rerank_values:
+                index.rerank = rerank
+                entry = measure(lambda q, n: [p for p, _ in index.search(q, n)], queries, truth, k)
+                yield {"backend": f"quantized-{method}", "subspaces": subspaces, "rerank": rerank,
+                       "build_seconds": round(build_seconds, 3), "memory_bytes": index.memory_bytes, **entry}
+            index.vectors = None  # Release the memory map before the directory is removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dense search engines.")
+    parser.add_argument("--persist-directory", default=PERSIST_DIRECTORY, help="Chroma collection to read.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use N synthetic vectors instead.")
+    parser.add_argument("--dimension", type=int, default=768, help="Dimension of synthetic vectors.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.02, help="Noise added to the query vectors.")
+    parser.add_argument("--k", type=int, default=max(RETRIEVAL_K, HYBRID_FETCH_K),
+                        help="Neighbours per query (the hybrid retriever fetches HYBRID_FETCH_K).")
+    parser.add_argument("--hnsw-m", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int, default=100)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 20, 50, 100, 200])
+    parser.add_argument("--pq-subspaces", type=int, nargs="+", default=[24, 48, 96])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 32, 64, 128, 256])
+    parser.add_argument("--output", default="results/vector_index.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic, args.dimension)
+    else:
+        vectors = load_vectors(args.persist_directory)
+    queries = make_queries(vectors, args.queries, args.noise)
+    k = min(args.k, len(vectors))
+    truth = exact_neighbours(vectors, queries, k)
+
+    results = {"vectors": len(vectors), "dimension": vectors.shape[1], "k": k, "queries": len(queries)}
+    norms = (vectors ** 2).sum(axis=1)
+    results["exact"] = {"memory_bytes": vectors.nbytes,
+                        **measure(lambda q, n: np.argsort(norms - 2 * vectors @ q)[:n], queries, truth, k)}
+    print(f"{'exact':>34}: recall 1.0, p50 {results['exact']['latency_seconds']['p50'] * 1000:.2f} ms, "
+          f"{vectors.nbytes / 2**20:.1f} MB")
+
+    results["curve"] = []
+    curves = (
+        hnsw_curve(vectors, queries, truth, k, args.hnsw_m, args.ef_construction, args.ef_search),
+        quantized_curve(vectors, queries, truth, k, args.pq_subspaces, args.rerank),
+    )
+    for curve in curves:
+        for entry in curve:
+            results["curve"].append(entry)
+            params = ", ".join(f"{key} {entry[key]}" for key in
+                               ("M", "ef_search", "subspaces", "rerank") if entry.get(key) is not None)
+            print(f"{entry['backend'] + ' (' + params + ')':>34}: recall {entry['recall']}, "
+                  f"p50 {entry['latency_seconds']['p50'] * 1000:.2f} ms, {entry['memory_bytes'] / 2**20:.1f} MB")
+
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import json
+import os
+import platform
+import re
+import statistics
+import time
+
+# Labelled questions on the filings of data/ (question, reference answer, key figures,
+# and "fallback" for questions no single reported value answers)
+QUESTIONS_PATH = os.path.join(os.path.dirname(__file__), "questions.json")
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+
+
+def load_questions(path=QUESTIONS_PATH, limit=None):
+    """
+    @brief Loads the labelled benchmark questions.
+
+    @param path: JSON list of {"question", "answer", "figures"}, with "fallback": true on
+                 questions the fact store must leave to retrieval.
+    @param limit: Optional maximum number of questions.
+    @return: List[dict]
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    return questions[:limit] if limit else questions
+
+
+def _words(text):
+    return [word.replace(",", "") for word in WORD_PATTERN.findall(text.lower())]
+
+
+def token_f1(answer, reference):
+    """
+    @brief SQuAD-style token overlap F1 between an answer and the reference answer.
+    """
+    answer_words, reference_words = _words(answer), _words(reference)
+    common = sum(min(answer_words.count(w), reference_words.count(w)) for w in set(answer_words))
+    if not common:
+        return 0.0
+    precision, recall = common / len(answer_words), common / len(reference_words)
+    return 2 * precision * recall / (precision + recall)
+
+
+def figure_hit(answer, figures):
+    """
+    @brief Whether the answer states one of the expected key figures.
+
+    @details Thousands separators are ignored, so "$23,350" matches "23350".
+    """
+    answer = answer.lower().replace(",", "")
+    return any(figure.lower().replace(",", "") in answer for figure in figures)
+
+
+def summarize(values):
+    """
+    @return: dict - Mean, median, 95th and 99th percentiles of a list of measurements.
+    """
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+    return {
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": round(ordered[len(ordered) // 2], 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 4),
+    }
+
+
+def write_results(path, results):
+    """
+    @brief Writes benchmark results, with the run's environment, as JSON.
+    """
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        **results,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {path}")
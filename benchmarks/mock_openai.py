@@ -0,0 +1,205 @@
+"""
+OpenAI-compatible mock of the chat completions API, to run the chatbot and the LLM
+gateway offline. Answers are deterministic, streamed word by word (SSE) or returned
+whole, after a fixed latency. A requests-per-second limit is answered with 429 and
+Retry-After, and a share of the requests fail with 500. GET /stats reports what the
+server received.
+
+    python -m benchmarks.mock_openai --port 8800 --rps 20 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock python index.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockState:
+    """
+    @brief Behaviour and counters of the mock server.
+    """
+
+    def __init__(self, latency=0.2, token_delay=0.01, rps=0, error_rate=0.0, seed=0):
+        """
+        @param latency: Seconds before the first token.
+        @param token_delay: Seconds between two streamed words.
+        @param rps: Requests accepted per second (0: unlimited), 429 beyond.
+        @param error_rate: Share of the accepted requests failing with 500.
+        @param seed: Seed of the error draws.
+        """
+        self.latency = latency
+        self.token_delay = token_delay
+        self.rps = rps
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = deque()  # Times of the requests accepted within the last second
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._window.clear()
+            self.requests = 0
+            self.rate_limited = 0
+            self.errors = 0
+            self.completed = 0
+            self.prompts = set()
+
+    def admit(self, prompt):
+        """
+        @return: Tuple[int, float] - HTTP status (200, 429 or 500) and, for 429, the
+                 seconds until a request is accepted again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.requests += 1
+            self.prompts.add(prompt)
+            while self._window and now - self._window[0] >= 1:
+                self._window.popleft()
+            if self.rps and len(self._window) >= self.rps:
+                self.rate_limited += 1
+                return 429, 1 - (now - self._window[0])
+            self._window.append(now)
+            if self._random.random() < self.error_rate:
+                self.errors += 1
+                return 500, 0.0
+            return 200, 0.0
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "distinct_prompts": len(self.prompts),
+                    "rate_limited": self.rate_limited, "errors": self.errors, "completed": self.completed}
+
+
+def mock_answer(messages, max_tokens=None):
+    """
+    @return: List[str] - Words of the deterministic answer to the last message's question.
+    """
+    content = messages[-1]["content"] if messages else ""
+    question = content.rpartition("Question:")[2].partition("Answer:")[0].strip() or content.strip()
+    words = f"This is a mock answer to: {question[:200]}".split()
+    return words[:max_tokens] if max_tokens else words
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # MockState, set by `serve`
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.state.stats())
+        else:
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        messages = body.get("messages", [])
+        status, retry_after = self.state.admit(json.dumps(messages, sort_keys=True))
+        if status == 429:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                            "code": "rate_limit_exceeded"}},
+                            {"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(max(1, round(retry_after)))})
+            return
+        if status == 500:
+            self._send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+
+        time.sleep(self.state.latency)
+        words = mock_answer(messages, body.get("max_tokens"))
+        completion = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()),
+                      "model": body.get("model", "mock")}
+        if body.get("stream"):
+            self._stream(completion, words)
+        else:
+            self._send_json(200, {
+                **completion, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)},
+            })
+        with self.state._lock:
+            self.state.completed += 1
+
+    def _stream(self, completion, words):
+        # Server-sent events on a connection closed at the end of the answer
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {**completion, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event({"role": "assistant", "content": ""})
+        for i, word in enumerate(words):
+            event({"content": word if not i else f" {word}"})
+            time.sleep(self.state.token_delay)
+        event({}, "stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def serve(host="127.0.0.1", port=0, state=None):
+    """
+    @brief Starts the mock server in a daemon thread.
+
+    @param port: Port to listen on (0: any free port).
+    @param state: MockState (default: a MockState with default behaviour).
+    @return: Tuple[ThreadingHTTPServer, MockState, str] - The server, its state and its
+             OpenAI base URL.
+    """
+    state = state or MockState()
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an OpenAI-compatible mock chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Latency before the first token.")
+    parser.add_argument("--token-delay-ms", type=float, default=10, help="Delay between two streamed words.")
+    parser.add_argument("--rps", type=float, default=0, help="Requests accepted per second (0: unlimited).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 500.")
+    args = parser.parse_args()
+
+    state = MockState(args.latency_ms / 1000, args.token_delay_ms / 1000, args.rps, args.error_rate)
+    server, _, base_url = serve(args.host, args.port, state)
+    print(f"Mock OpenAI API on {base_url} (GET {base_url}/stats)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
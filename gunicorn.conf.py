@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+# -------------------------------------------------------------------------
+# Gunicorn Configuration
+# -------------------------------------------------------------------------
+# Run with: gunicorn -c gunicorn.conf.py
+#
+# With PRELOAD_MODELS=1 the models and the vector index are loaded once in the
+# master process and shared copy-on-write by every forked worker. Only enable it
+# for CPU inference: a CUDA context cannot be inherited across fork. Otherwise the
+# master only ingests new or changed filings (in a subprocess) before forking.
+
+wsgi_app = "index:server"
+bind = os.getenv("BIND", "0.0.0.0:8050")
+# Conversations and questions in progress are only shared by several workers through
+# the SQLite session store
+workers = int(os.getenv("WEB_CONCURRENCY", 2 if os.getenv("SESSION_STORE", "memory") == "sqlite" else 1))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = os.getenv("PRELOAD_MODELS", "0") == "1"
+
+
+def when_ready(server):
+    """
+    @brief Runs in the master process after the app is imported, before workers are forked.
+    """
+    from pages.chatbot.chatbot_registry import registry
+
+    if preload_app:
+        registry.preload()
+        return
+    # Ingest new or changed filings once, in a separate process so the master loads
+    # no model, instead of every worker racing to ingest the same store. Workers
+    # inherit the imported registry, and its flag, when forked.
+    subprocess.run([sys.executable, "-m", "pages.chatbot.chatbot_ingest"], check=True)
+    registry.ingested = True
+
+
+def post_fork(server, worker):
+    """
+    @brief Runs in every worker right after the fork: reopens per-process resources
+           and warms up whatever was not preloaded.
+    """
+    from pages.chatbot.chatbot_registry import registry
+    registry.after_fork()
@@ -1,14 +1,22 @@
+import hmac
+import os
 import sys
+import uuid
 sys.path.append('path/to/langchain_openai')
 from dash.dependencies import Input, Output
 from dash import dcc, html 
+from flask import Response, jsonify, request
 
 # import pages
 from pages.chatbot.chatbot_view import render_chatbot
 from pages.chatbot.chatbot_controller import *
 from pages.page_not_found import page_not_found
 
-from app import app
+from pages.chatbot.chatbot_config import MODEL_NAME, ADMIN_TOKEN
+from pages.chatbot.chatbot_registry import registry
+from pages.chatbot.chatbot_metrics import CONTENT_TYPE, metrics
+
+from app import app, server
 
 
 def serve_content():
@@ -18,16 +26,19 @@ def serve_content():
     @details Includes:
              - A location tracker to monitor the app's current URL path.
              - A content placeholder to render pages dynamically.
-             - A store for the selected model.
+             - A store for the selected model (set by the model selector).
+             - A store for the session id, which identifies the user's conversation on
+               the server. It is kept in the browser tab's session storage, so a reload
+               shows the same conversation; a new tab starts a new one.
     """
     return html.Div([
-        dcc.Store(id="selected-model", data="GPT"),  # Store for the selected model
-        dcc.Store(id="store-conversation", data=""),  # Store for the conversation
+        dcc.Store(id="session-id", data=uuid.uuid4().hex, storage_type="session"),  # Store for the session id
+        dcc.Store(id="selected-model", data=MODEL_NAME),  # Store for the selected model
         dcc.Location(id='url', refresh=False),  # Tracks the current URL
         html.Div(id='page-content'),  # Placeholder for dynamic page rendering
     ])
 
-app.layout = serve_content()
+app.layout = serve_content  # Called on every page load: a new tab gets a new session id
 
 
 @app.callback(Output('page-content', 'children'),
@@ -43,5 +54,70 @@ def display_page(pathname):
     return page_not_found()
 
 
+@server.route('/healthz')
+def healthz():
+    """
+    @brief Liveness probe: the server is up, whether or not the models are loaded.
+    """
+    return jsonify(status="ok")
+
+
+@server.route('/readyz')
+def readyz():
+    """
+    @brief Readiness probe: 200 once every model is loaded, 503 while warming up.
+    """
+    status = registry.status()
+    return jsonify(status), 200 if registry.ready else 503
+
+
+@server.route('/stats')
+def stats():
+    """
+    @brief Runtime statistics: jobs per state, conversations and loaded models (with their batching).
+    """
+    from pages.chatbot.chatbot_jobs import jobs
+    from pages.chatbot.chatbot_sessions import sessions
+
+    models = registry.peek("models")
+    return jsonify(
+        jobs=jobs.stats(),
+        sessions=sessions.stats(),
+        models=models.stats() if models is not None else None,
+    )
+
+
+@server.route('/metrics')
+def prometheus_metrics():
+    """
+    @brief Prometheus scrape endpoint: stage latencies, token counts, jobs, caches and models
+           of this process.
+    """
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@server.route('/admin/ingest', methods=['GET', 'POST'])
+def admin_ingest():
+    """
+    @brief Live corpus update: POST starts applying new, changed and deleted filings
+           (optionally only the JSON "sources" listed) in the background, GET reports
+           the last update. Requires "Authorization: Bearer <ADMIN_TOKEN>".
+    """
+    from pages.chatbot.chatbot_updates import updater
+
+    expected = f"Bearer {ADMIN_TOKEN}"
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        return jsonify(error="not found"), 404
+    if request.method == 'GET':
+        return jsonify(updater.status())
+    sources = (request.get_json(silent=True) or {}).get("sources")
+    started = updater.start(sources)
+    return jsonify(updater.status()), 202 if started else 409
+
+
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    debug = True
+    # With the debug reloader, only the serving child process loads the models
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        registry.warm_up()
+    app.run_server(debug=debug)
\ No newline at end of file
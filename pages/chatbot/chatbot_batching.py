@@ -0,0 +1,281 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+from pages.chatbot.chatbot_config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, BATCH_MAX_LENGTH_RATIO
+
+# Upper bounds of the queue depth histogram buckets
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class BatchRequest:
+    """
+    @brief One prompt waiting for a batched generation.
+    """
+
+    def __init__(self, prompt, kwargs, streamer=None):
+        self.prompt = prompt
+        self.kwargs = kwargs
+        self.streamer = streamer  # Receives the prompt's tokens as they are generated
+        # Requests can only share a batch if they use the same generation arguments
+        self.group = tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class BatchStreamer:
+    """
+    @brief Streamer of a batched `generate` call, forwarding each row of the batch to
+           the streamer of its request.
+
+    @details transformers streamers only accept one sequence: `generate` gives this
+             one the tokens of the whole batch (the prompts, then one new token per
+             row at each step), which it splits by row. Rows without a streamer are
+             skipped.
+    """
+
+    def __init__(self, streamers):
+        """
+        @param streamers: One streamer (or None) per row of the batch.
+        """
+        self.streamers = streamers
+
+    def put(self, value):
+        for row, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[row:row + 1])
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+
+class BatchedPipeline:
+    """
+    @brief Micro-batching proxy in front of a transformers text-generation (or
+           text2text-generation) pipeline.
+
+    @details Callers use it like the pipeline itself (e.g. as the `pipeline` of a
+             LangChain HuggingFacePipeline). Prompts from concurrent callers are
+             collected for up to `max_wait_ms` (or until `max_batch_size` are queued),
+             grouped by generation arguments, sorted by length and cut into batches
+             whose longest prompt is at most `max_length_ratio` times the shortest
+             (bounding padding waste). Each batch runs as one padded `generate`.
+             A streaming call (one prompt with `streamer=...`) is batched like the
+             others, its streamer receiving the tokens of its row (see BatchStreamer).
+    """
+
+    def __init__(self, pipeline, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                 max_length_ratio=BATCH_MAX_LENGTH_RATIO):
+        """
+        @param pipeline: The transformers pipeline to batch.
+        @param max_batch_size: Maximum prompts per generate call.
+        @param max_wait_ms: Milliseconds the first queued prompt may wait for others.
+        @param max_length_ratio: Maximum ratio between the longest and shortest prompt of a batch.
+        """
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_length_ratio = max_length_ratio
+
+        # Batched decoder-only generation pads on the left, with a pad token
+        tokenizer = pipeline.tokenizer
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        if not getattr(pipeline.model.config, "is_encoder_decoder", False):
+            tokenizer.padding_side = "left"
+
+        self._pid = None
+        self._closed = False
+        self._start()
+
+        # Metrics
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = Counter()  # Prompts per generate call -> number of calls
+        self.queue_depths = Counter()  # Queue depth bucket (at enqueue time) -> number of requests
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0  # Total time spent queued by the requests
+        self.generate_seconds = 0.0
+
+    # ---------------------------------------------------------------------
+    # Pipeline Interface
+    # ---------------------------------------------------------------------
+
+    @property
+    def task(self):
+        return self.pipeline.task
+
+    @property
+    def model(self):
+        return self.pipeline.model
+
+    @property
+    def tokenizer(self):
+        return self.pipeline.tokenizer
+
+    def __getattr__(self, name):
+        # Everything else (device, framework, ...) comes from the wrapped pipeline
+        return getattr(self.__dict__["pipeline"], name)
+
+    def __call__(self, prompts, **kwargs):
+        """
+        @brief Generates from one prompt or a list of prompts, like the wrapped pipeline.
+
+        @param prompts: A prompt or a list of prompts.
+        @param kwargs: Generation arguments (max_new_tokens, return_full_text, ...).
+        @return: The pipeline output: a list of generations for one prompt, or one
+                 such list per prompt.
+        """
+        kwargs.pop("batch_size", None)
+        single = isinstance(prompts, str)
+        streamer = kwargs.pop("streamer", None)
+        if streamer is not None and not single:  # A streamer follows a single sequence
+            return self.pipeline(prompts, streamer=streamer, **kwargs)
+        requests = [self.submit(prompt, kwargs, streamer) for prompt in ([prompts] if single else prompts)]
+        results = [request.future.result() for request in requests]
+        return results[0] if single else results
+
+    def submit(self, prompt, kwargs, streamer=None):
+        """
+        @brief Queues a prompt for the next batch.
+
+        @param prompt: The prompt.
+        @param kwargs: Generation arguments.
+        @param streamer: Streamer of the prompt's generated tokens, if any.
+        @return: BatchRequest - Its `future` resolves to the pipeline output for the prompt.
+        """
+        if self._pid != os.getpid():  # Threads do not survive a fork: restart the worker
+            self._start()
+        request = BatchRequest(prompt, kwargs, streamer)
+        with self._ready:
+            if self._closed:
+                raise RuntimeError("The batched pipeline is closed")
+            depth = len(self._queue)
+            self._queue.append(request)
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth + 1)
+            self.queue_depths[next((b for b in QUEUE_DEPTH_BUCKETS if depth <= b), "inf")] += 1
+            self._ready.notify()
+        return request
+
+    def close(self):
+        """
+        @brief Stops the batching thread, which holds the pipeline and its model, and
+               fails the prompts still queued. Called when the model is unloaded.
+        """
+        with self._ready:
+            self._closed = True
+            pending = list(self._queue)
+            self._queue.clear()
+            self._ready.notify_all()
+        for request in pending:
+            request.future.set_exception(RuntimeError("The model was unloaded"))
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    # ---------------------------------------------------------------------
+    # Scheduler
+    # ---------------------------------------------------------------------
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name="llm-batcher", daemon=True)
+        self._thread.start()
+
+    def _collect(self):
+        """
+        @brief Waits for a first prompt, then for more until the batch is full or the window closes.
+
+        @return: List[BatchRequest] - The collected requests (none once closed).
+        """
+        with self._ready:
+            while not self._queue and not self._closed:
+                self._ready.wait()
+            if self._closed:
+                return []
+            deadline = self._queue[0].enqueued + self.max_wait
+            while len(self._queue) < self.max_batch_size and not self._closed:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                self._ready.wait(left)
+            return [self._queue.popleft() for _ in range(min(self.max_batch_size, len(self._queue)))]
+
+    def _buckets(self, requests):
+        """
+        @brief Splits requests into batches of similar prompt length and equal arguments.
+
+        @return: List[List[BatchRequest]]
+        """
+        groups = {}
+        for request in requests:
+            groups.setdefault(request.group, []).append(request)
+        batches = []
+        for group in groups.values():
+            group.sort(key=lambda r: len(r.prompt))
+            batch = []
+            for request in group:
+                if batch and len(request.prompt) > self.max_length_ratio * max(len(batch[0].prompt), 1):
+                    batches.append(batch)
+                    batch = []
+                batch.append(request)
+            batches.append(batch)
+        return batches
+
+    def _loop(self):
+        pid = self._pid
+        while pid == os.getpid() and not self._closed:
+            for batch in self._buckets(self._collect()):
+                self._run(batch)
+
+    def _run(self, batch):
+        started = time.perf_counter()
+        kwargs = dict(batch[0].kwargs)
+        if any(request.streamer is not None for request in batch):
+            kwargs["streamer"] = BatchStreamer([request.streamer for request in batch])
+        try:
+            outputs = self.pipeline(
+                [request.prompt for request in batch], batch_size=len(batch), **kwargs
+            )
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finally:
+            self.generate_seconds += time.perf_counter() - started
+            self.wait_seconds += sum(started - request.enqueued for request in batch)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+        for request, output in zip(batch, outputs):
+            # text2text-generation unwraps the single generation of each prompt of a list
+            request.future.set_result([output] if isinstance(output, dict) else output)
+
+    # ---------------------------------------------------------------------
+    # Metrics
+    # ---------------------------------------------------------------------
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        """
+        @return: dict - Queue depth, batch size and queue depth histograms, mean wait and batch time.
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": round(sum(k * v for k, v in self.batch_sizes.items()) / max(self.batches, 1), 2),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_depths": {str(k): v for k, v in self.queue_depths.items()},
+            "mean_wait_ms": round(1000 * self.wait_seconds / max(self.requests, 1), 2),
+            "mean_batch_ms": round(1000 * self.generate_seconds / max(self.batches, 1), 2),
+        }
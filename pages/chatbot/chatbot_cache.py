@@ -0,0 +1,223 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from pages.chatbot.chatbot_config import (
+    SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_PATH
+)
+
+# Seconds between two writes of the persisted cache
+SAVE_INTERVAL = 30
+
+
+def context_fingerprint(docs, model_name, strategy=""):
+    """
+    @brief Identifies the retrieved context an answer was generated from.
+
+    @details Two questions may only share an answer if they retrieved the same chunks
+             and were answered by the same model with the same chain strategy.
+
+    @param docs: Retrieved LangChain Documents, in rank order.
+    @param model_name: Model answering the question.
+    @param strategy: Chain strategy combining the chunks (see CHAIN_STRATEGIES).
+    @return: str - Hex digest of the model name, strategy and retrieved chunks.
+    """
+    digest = hashlib.sha256(f"{model_name}\0{strategy}".encode("utf-8"))
+    for doc in docs:
+        digest.update(b"\0")
+        digest.update(str(doc.metadata.get("source", "")).encode("utf-8"))
+        digest.update(str(doc.metadata.get("page", "")).encode("utf-8"))
+        digest.update(doc.page_content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    @brief Answer cache keyed by query embedding, in front of the LLM.
+
+    @details A stored answer is returned for a new question when both hold:
+             - the cosine similarity between the two query embeddings reaches `threshold`;
+             - the new question retrieved the same context (see `context_fingerprint`).
+             Entries are evicted least-recently-used beyond `max_entries` and expire
+             `ttl` seconds after being stored. The whole cache is dropped when the
+             indexed corpus changes, and can optionally be persisted as JSON.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE,
+                 ttl=SEMANTIC_CACHE_TTL, persist_path=SEMANTIC_CACHE_PATH, corpus_version=""):
+        """
+        @param threshold: Minimum cosine similarity between two questions.
+        @param max_entries: Maximum number of cached answers.
+        @param ttl: Seconds an answer stays valid.
+        @param persist_path: JSON file the cache is saved to ("" keeps it in memory only).
+        @param corpus_version: Fingerprint of the indexed corpus the answers come from.
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.corpus_version = corpus_version
+        self._entries = OrderedDict()  # entry id -> entry, least recently used first
+        self._by_context = {}  # context fingerprint -> set of entry ids
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    # ---------------------------------------------------------------------
+    # Lookup and Storage
+    # ---------------------------------------------------------------------
+
+    def lookup(self, query_vector, fingerprint):
+        """
+        @brief Returns a cached answer for a semantically equivalent question, if any.
+
+        @param query_vector: Embedding of the new question.
+        @param fingerprint: Fingerprint of the context retrieved for it.
+        @return: str or None - The cached answer.
+        """
+        vector = _normalize(query_vector)
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_context.get(fingerprint, ())):
+                entry = self._entries[entry_id]
+                if time.time() - entry["created"] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(entry["vector"], vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id]["answer"]
+
+    def store(self, question, query_vector, fingerprint, answer):
+        """
+        @brief Caches the answer to a question.
+
+        @param question: The question (kept for inspection of the persisted cache).
+        @param query_vector: Embedding of the question.
+        @param fingerprint: Fingerprint of the context the answer was generated from.
+        @param answer: The generated answer.
+        """
+        with self._lock:
+            entry_id = uuid.uuid4().hex
+            self._entries[entry_id] = {
+                "question": question,
+                "vector": _normalize(query_vector),
+                "fingerprint": fingerprint,
+                "answer": answer,
+                "created": time.time(),
+            }
+            self._by_context.setdefault(fingerprint, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        if self.persist_path and time.time() - self._last_save > SAVE_INTERVAL:
+            self.save()
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_context[entry["fingerprint"]]
+        ids.discard(entry_id)
+        if not ids:
+            del self._by_context[entry["fingerprint"]]
+
+    # ---------------------------------------------------------------------
+    # Invalidation
+    # ---------------------------------------------------------------------
+
+    def clear(self):
+        """
+        @brief Drops every cached answer.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+
+    def set_corpus_version(self, corpus_version):
+        """
+        @brief Drops every cached answer if the indexed corpus changed.
+
+        @param corpus_version: Fingerprint of the indexed corpus.
+        """
+        if corpus_version != self.corpus_version:
+            self.clear()
+            self.corpus_version = corpus_version
+
+    # ---------------------------------------------------------------------
+    # Persistence
+    # ---------------------------------------------------------------------
+
+    def save(self):
+        """
+        @brief Writes the cache to `persist_path` atomically.
+        """
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [
+                {**entry, "vector": entry["vector"].tolist()} for entry in self._entries.values()
+            ]
+            self._last_save = time.time()
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"corpus_version": self.corpus_version, "entries": entries}, f)
+        os.replace(tmp_path, self.persist_path)
+
+    def load(self):
+        """
+        @brief Restores the cache from `persist_path`, skipping stale or expired entries.
+        """
+        if not os.path.exists(self.persist_path):
+            return
+        with open(self.persist_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("corpus_version") != self.corpus_version:
+            return
+        now = time.time()
+        for entry in data.get("entries", [])[-self.max_entries:]:
+            if now - entry["created"] <= self.ttl:
+                entry_id = uuid.uuid4().hex
+                self._entries[entry_id] = {**entry, "vector": np.asarray(entry["vector"], dtype=np.float32)}
+                self._by_context.setdefault(entry["fingerprint"], set()).add(entry_id)
+
+    # ---------------------------------------------------------------------
+    # Metrics
+    # ---------------------------------------------------------------------
+
+    def stats(self):
+        """
+        @return: dict - Hits, misses, hit rate, evictions and current size.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+        }
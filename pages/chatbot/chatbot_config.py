@@ -0,0 +1,334 @@
+import os
+
+from dotenv import load_dotenv
+load_dotenv()  # Load environment variables (e.g., API keys, overrides below)
+
+# -------------------------------------------------------------------------
+# Language Model
+# -------------------------------------------------------------------------
+
+# Model answering the questions by default: "GPT", "LLAMA2" or "FLANT5"
+MODEL_NAME = os.getenv("MODEL_NAME", "GPT")
+
+# Models offered in the UI (comma separated). MODEL_NAME is loaded at startup, the
+# others when first selected.
+MODELS = [name.strip() for name in os.getenv("MODELS", MODEL_NAME).split(",") if name.strip()]
+if MODEL_NAME not in MODELS:
+    MODELS.insert(0, MODEL_NAME)
+
+# Memory budget of the loaded models in MB (0: unlimited). Loading a model unloads
+# the least recently used idle ones until it fits.
+MODEL_POOL_MEMORY_MB = int(os.getenv("MODEL_POOL_MEMORY_MB", 0))
+
+# Seconds an unused model stays loaded (0: until its memory is needed). The default
+# model (MODEL_NAME) is only unloaded for memory.
+MODEL_POOL_IDLE_TTL = float(os.getenv("MODEL_POOL_IDLE_TTL", 0))
+
+# How local models (LLAMA2, FLANT5) combine the retrieved chunks into an answer:
+# - "stuff": one generation over all chunks packed into a single prompt;
+# - "refine": one generation per chunk, each refining the previous answer;
+# - "map_reduce": one generation per chunk, then one combining them.
+CHAIN_STRATEGIES = ("stuff", "refine", "map_reduce")
+CHAIN_STRATEGY = os.getenv("CHAIN_STRATEGY", "stuff")
+
+# Maximum tokens of retrieved context in a stuffed prompt (0 fills the model's
+# context window, minus the prompt and the answer)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 0))
+
+# Maximum tokens of retrieved context in GPT prompts, counted with tiktoken. The
+# chunks are sent as plain text (page number, no metadata), and with CONTEXT_COMPRESSION
+# reduced to the sentences closest to the question by embedding similarity.
+GPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("GPT_CONTEXT_TOKEN_BUDGET", 800))
+CONTEXT_COMPRESSION = os.getenv("CONTEXT_COMPRESSION", "1") == "1"
+
+# Maximum tokens generated for an answer by local models
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", 256))
+
+# Where local models run: "gpu" (float16, spread over the available GPUs), "cpu"
+# (float32 with int8 dynamic quantization, ONNX Runtime embeddings) or "auto"
+# (gpu when CUDA is available)
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "auto")
+
+# Quantize the linear layers of local models to int8 in cpu mode
+CPU_QUANTIZE = os.getenv("CPU_QUANTIZE", "1") == "1"
+
+# Threads used by CPU inference (0 uses every core available to the process)
+CPU_THREADS = int(os.getenv("CPU_THREADS", 0))
+
+# -------------------------------------------------------------------------
+# Hosted LLM Gateway
+# -------------------------------------------------------------------------
+
+# OpenAI chat model answering as "GPT", and the API it is served from (empty: OpenAI;
+# any OpenAI-compatible server, e.g. benchmarks/mock_openai.py)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
+
+# Client-side rate limits of the API account (0: unlimited). Halved on every 429
+# response and restored gradually as requests succeed.
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", 3500))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", 90000))
+
+# Retries of a request failing with 429, 5xx or a connection error before its first
+# token, with exponential backoff (full jitter) between LLM_BACKOFF_BASE and
+# LLM_BACKOFF_MAX seconds, or the server's Retry-After if longer
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 20))
+
+# Seconds before an API request (connection, or silence while streaming) times out
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+
+# Connections of the HTTP pool shared by every request to the API (and kept alive)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 32))
+
+# Share one API request between identical prompts in flight at the same time
+LLM_COALESCE = os.getenv("LLM_COALESCE", "1") == "1"
+
+# -------------------------------------------------------------------------
+# Corpus and Splitting
+# -------------------------------------------------------------------------
+
+# Directory walked for PDF filings (10-Q/10-K) to ingest into the vector store
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+# "filing" splits along the 10-Q/10-K structure (paragraphs, tables, Items) without
+# headers, footers and near-duplicates; "recursive" is LangChain's character splitter
+SPLITTER = os.getenv("SPLITTER", "filing")
+
+# Text splitter parameters (part of the ingestion key: changing them re-embeds).
+# The filing splitter only overlaps the pieces of paragraphs longer than a chunk.
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 500))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 50))
+
+# Chunks whose SimHash differs from an earlier chunk of the filing by at most this
+# many bits are dropped as near-duplicates (-1 keeps them)
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", 3))
+
+# -------------------------------------------------------------------------
+# Embeddings and Vector Store
+# -------------------------------------------------------------------------
+
+# Embedding model used for chunks and queries (HuggingFace's MPNet)
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-mpnet-base-v2")
+
+# Runtime of the embedding model: "torch" (sentence-transformers), "onnx" (exported
+# once to ONNX_DIR and run with ONNX Runtime) or "auto" (onnx in cpu mode).
+# Both produce the same vectors, so the index and the embedding cache are shared.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "auto")
+
+# Directory of the exported ONNX models
+ONNX_DIR = os.getenv("ONNX_DIR", "onnx_models")
+
+# Directory holding the persisted Chroma collection and the ingestion manifest
+PERSIST_DIRECTORY = os.getenv("PERSIST_DIRECTORY", "chroma_db")
+
+# Cache chunk and query embeddings on disk so repeated texts are embedded once
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") == "1"
+
+# Directory of the memory-mapped embedding cache files
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(PERSIST_DIRECTORY, "embedding_cache"))
+
+# Storage precision of cached vectors: "float32" or "float16" (half the size)
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
+
+# HNSW graph of the Chroma collection (Chroma's defaults): HNSW_M links per node and
+# HNSW_EF_CONSTRUCTION candidates per insertion shape the graph, HNSW_EF_SEARCH is the
+# candidate list explored per query (higher: better recall, slower). Chroma fixes them
+# when the collection is created, so changing any of them rebuilds the collection.
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 100))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 10))
+
+# Engine answering dense queries: "chroma" (HNSW over float32 vectors) or "quantized"
+# (in-process NumPy scan over compressed vectors, re-ranked with the full-precision
+# vectors memory-mapped from disk). Chroma stays the store of record in both cases.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+
+# Compression of the quantized backend: "sq8" (one byte per dimension, 4x smaller)
+# or "pq" (PQ_SUBSPACES bytes per vector, e.g. 48 bytes instead of 3 KB for MPNet)
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "sq8")
+PQ_SUBSPACES = int(os.getenv("PQ_SUBSPACES", 48))
+
+# Best candidates of the quantized scan re-ranked with exact distances (0: no re-rank)
+QUANTIZED_RERANK_CANDIDATES = int(os.getenv("QUANTIZED_RERANK_CANDIDATES", 64))
+
+# Number of chunks retrieved for each question
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 4))
+
+# "hybrid" fuses dense (Chroma) and lexical (BM25) results, "dense" only queries Chroma
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+
+# Candidates fetched from each retriever before reciprocal rank fusion
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", 20))
+
+# Reciprocal rank fusion damping constant
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# BM25 term frequency saturation and length normalisation
+BM25_K1 = float(os.getenv("BM25_K1", 1.5))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+
+# -------------------------------------------------------------------------
+# Reranking
+# -------------------------------------------------------------------------
+
+# Rerank the retrieved chunks with a cross-encoder scoring (question, chunk) pairs
+RERANK = os.getenv("RERANK", "1") == "1"
+
+# Cross-encoder model (sentence-transformers)
+RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL_NAME", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+# Candidates retrieved and scored per question, and chunks kept for the prompt
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 20))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", 3))
+
+# Maximum number of cached (question, chunk) scores (least recently used are evicted first)
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 20000))
+
+# Milliseconds reranking may add to a question. When the expected scoring time (from
+# recent batches and the reranks in flight) exceeds it while other reranks are in flight,
+# the fused ranking is used as is.
+RERANK_LATENCY_BUDGET_MS = float(os.getenv("RERANK_LATENCY_BUDGET_MS", 250))
+
+# -------------------------------------------------------------------------
+# Financial Facts
+# -------------------------------------------------------------------------
+
+# Answer direct numeric questions ("total revenues in Q3 2023") from the line items
+# extracted from the statement tables at ingestion, without calling the LLM
+FACT_ANSWERS = os.getenv("FACT_ANSWERS", "1") == "1"
+
+# Directory of the extracted facts (one file per ingested filing)
+FACTS_DIRECTORY = os.getenv("FACTS_DIRECTORY", os.path.join(PERSIST_DIRECTORY, "facts"))
+
+# -------------------------------------------------------------------------
+# Ingestion
+# -------------------------------------------------------------------------
+
+# Number of processes parsing PDFs in parallel (0 parses in the calling process)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", min(os.cpu_count() or 1, 8)))
+
+# Number of chunks embedded and inserted into Chroma per batch
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+
+# Bearer token of the POST /admin/ingest route, which applies new, changed or deleted
+# filings to the running server without a restart (empty disables the route)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# -------------------------------------------------------------------------
+# Request Handling
+# -------------------------------------------------------------------------
+
+# Threads answering questions off the Dash callback threads
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 8))
+
+# Maximum number of questions accepted at once (queued or running)
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 64))
+
+# Maximum number of workers a single browser session may occupy
+JOB_MAX_PER_SESSION = int(os.getenv("JOB_MAX_PER_SESSION", 2))
+
+# Seconds after which an unanswered question is reported as timed out
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", 120))
+
+# Milliseconds between two polls of a pending answer by the browser
+JOB_POLL_INTERVAL = int(os.getenv("JOB_POLL_INTERVAL", 300))
+
+# Stream answers token by token into the chat instead of waiting for the full answer
+STREAMING = os.getenv("STREAMING", "1") == "1"
+
+# Batch concurrent prompts to local models into one generate call
+BATCHING = os.getenv("BATCHING", "1") == "1"
+
+# Maximum prompts per batched generate call
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))
+
+# Milliseconds a prompt may wait for others to share its batch
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 20))
+
+# Maximum length ratio between the longest and shortest prompt of a batch (bounds padding)
+BATCH_MAX_LENGTH_RATIO = float(os.getenv("BATCH_MAX_LENGTH_RATIO", 2.0))
+
+# -------------------------------------------------------------------------
+# Conversations
+# -------------------------------------------------------------------------
+
+# Where conversations are kept: "memory" (single process) or "sqlite" (shared by
+# every worker process through SESSION_DB_PATH)
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.sqlite3")
+
+# Seconds a conversation is kept after its last message
+SESSION_TTL = float(os.getenv("SESSION_TTL", 7 * 24 * 3600))
+
+# Maximum number of conversations kept by the memory store
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", 1000))
+
+# Messages rendered when a conversation is opened (and per "Show earlier messages")
+RENDER_WINDOW = int(os.getenv("RENDER_WINDOW", 50))
+
+# -------------------------------------------------------------------------
+# Semantic Answer Cache
+# -------------------------------------------------------------------------
+
+# Serve cached answers to questions similar to an already answered one
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "1") == "1"
+
+# Minimum cosine similarity between two questions sharing an answer
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.93))
+
+# Maximum number of cached answers (least recently used are evicted first)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1024))
+
+# Seconds a cached answer stays valid
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 24 * 3600))
+
+# JSON file the cache is persisted to (empty keeps it in memory only)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "")
+
+
+# -------------------------------------------------------------------------
+# Observability
+# -------------------------------------------------------------------------
+
+# Export the per-stage spans with OpenTelemetry: "" (off), "otlp" (gRPC, to
+# OTEL_EXPORTER_OTLP_ENDPOINT) or "console". Metrics are always served on /metrics.
+OTEL_EXPORTER = os.getenv("OTEL_EXPORTER", "")
+
+# Service name attached to the exported spans
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "financial-insights-chatbot")
+
+# Model whose tokenizer counts the tokens of GPT prompts and answers
+GPT_TOKENIZER_MODEL = os.getenv("GPT_TOKENIZER_MODEL", "gpt-3.5-turbo")
+
+
+def hnsw_metadata():
+    """
+    @brief Returns the Chroma collection metadata configuring its HNSW index.
+
+    @return: dict - `hnsw:*` collection metadata.
+    """
+    return {
+        "hnsw:M": HNSW_M,
+        "hnsw:construction_ef": HNSW_EF_CONSTRUCTION,
+        "hnsw:search_ef": HNSW_EF_SEARCH,
+    }
+
+
+def index_settings():
+    """
+    @brief Returns the settings that determine the content of the vector index.
+
+    @details Any change to these values invalidates every stored vector, so they
+             are written to the ingestion manifest and compared on startup.
+
+    @return: dict - Splitter parameters and embedding model name.
+    """
+    return {
+        "splitter": SPLITTER,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "dedup_max_distance": DEDUP_MAX_DISTANCE if SPLITTER == "filing" else None,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+    }
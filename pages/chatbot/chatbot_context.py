@@ -0,0 +1,276 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.documents import Document
+
+from pages.chatbot.chatbot_config import GPT_TOKENIZER_MODEL
+
+# Minimum number of characters two chunks must share to be merged: the splitter
+# overlaps neighbouring chunks by CHUNK_OVERLAP characters, cut on word boundaries
+MIN_OVERLAP = 40
+
+# Separator between two passages of the stuffed context
+PASSAGE_SEPARATOR = "\n\n"
+
+# Characters per token of English text in OpenAI encodings, used to estimate token
+# counts when tiktoken cannot load its encoding (offline)
+CHARS_PER_TOKEN = 4
+
+# End of a sentence: terminal punctuation followed by the start of the next one
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9("$])')
+
+# Figures of a table row ("Total revenues 23,350 21,454"), which ends with one
+FIGURE = re.compile(r"\(?\$?\d[\d,.]*\)?%?")
+
+
+@lru_cache(maxsize=None)
+def tiktoken_counter(model_name=GPT_TOKENIZER_MODEL):
+    """
+    @brief Token counter of an OpenAI model.
+
+    @param model_name: OpenAI model whose encoding counts the tokens.
+    @return: Callable[[str], int] - Counts the tokens of a text.
+    """
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model(model_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def gpt_token_counter(model_name=GPT_TOKENIZER_MODEL):
+    """
+    @return: Callable[[str], int] - `tiktoken_counter`, or an estimate from the text
+             length if tiktoken cannot load the encoding.
+    """
+    try:
+        return tiktoken_counter(model_name)
+    except Exception as e:
+        print(f"tiktoken unavailable ({e}): GPT token counts are estimated from the text length")
+        return lambda text: -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _overlap(left, right):
+    """
+    @brief Length of the longest suffix of `left` that is a prefix of `right`.
+
+    @return: int - Shared characters (0 if they share fewer than MIN_OVERLAP).
+    """
+    if len(left) < MIN_OVERLAP or len(right) < MIN_OVERLAP:
+        return 0
+    probe = right[:MIN_OVERLAP]
+    start = left.find(probe)
+    while start != -1:
+        shared = len(left) - start
+        if right.startswith(left[start:]):
+            return shared
+        start = left.find(probe, start + 1)
+    return 0
+
+
+def merge_overlapping(docs):
+    """
+    @brief Removes the text retrieved twice through overlapping chunks.
+
+    @details Consecutive chunks of a page share up to CHUNK_OVERLAP characters, so
+             the top results often repeat each other. In rank order, a chunk is:
+             - dropped if its text is contained in a kept passage of the same page;
+             - appended to (or prepended to) a kept passage it overlaps;
+             - kept as a new passage otherwise.
+             Passages keep the rank of their best chunk.
+
+    @param docs: Retrieved LangChain Documents, best first.
+    @return: List[Document] - Non-overlapping passages, best first.
+    """
+    passages = []  # [page key, text, metadata]
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        text = doc.page_content
+        for passage in passages:
+            if passage[0] != key:
+                continue
+            if text in passage[1]:
+                break
+            if passage[1] in text:
+                passage[1] = text
+                break
+            shared = _overlap(passage[1], text)
+            if shared:
+                passage[1] += text[shared:]
+                break
+            shared = _overlap(text, passage[1])
+            if shared:
+                passage[1] = text + passage[1][shared:]
+                break
+        else:
+            passages.append([key, text, doc.metadata])
+    return [Document(page_content=text, metadata=metadata) for _, text, metadata in passages]
+
+
+class ContextAssembler:
+    """
+    @brief Packs retrieved passages into a single prompt under a token budget.
+
+    @details Passages are measured with the answering model's tokenizer and added in
+             rank order; a passage that does not fit is skipped in favour of shorter,
+             lower-ranked ones. If not even the best passage fits, it is truncated.
+    """
+
+    def __init__(self, count_tokens, budget):
+        """
+        @param count_tokens: Returns the number of tokens of a text for the model.
+        @param budget: Maximum number of context tokens.
+        """
+        self.count_tokens = count_tokens
+        self.budget = budget
+
+    def assemble(self, docs):
+        """
+        @brief Selects the passages of the context.
+
+        @param docs: Retrieved LangChain Documents, best first.
+        @return: List[Document] - Deduplicated passages fitting the budget, best first.
+        """
+        passages = merge_overlapping(docs)
+        selected, used = [], 0
+        separator = self.count_tokens(PASSAGE_SEPARATOR)
+        for passage in passages:
+            tokens = self.count_tokens(format_passage(passage)) + (separator if selected else 0)
+            if used + tokens <= self.budget:
+                selected.append(passage)
+                used += tokens
+
+        if not selected and passages:
+            selected = [self._truncate(passages[0])]
+        return selected
+
+    def _truncate(self, doc):
+        # Cut proportionally to the token count, then shrink until it fits
+        text = doc.page_content
+        doc = Document(page_content=doc.page_content, metadata=doc.metadata)
+        while doc.page_content and self.count_tokens(format_passage(doc)) > self.budget:
+            text = doc.page_content
+            doc.page_content = text[:int(len(text) * self.budget / self.count_tokens(format_passage(doc)) * 0.95)]
+        return doc
+
+
+def format_passage(doc):
+    """
+    @return: str - The passage text, preceded by its (1-based) page number if known.
+    """
+    if "page" in doc.metadata:
+        return f"[page {doc.metadata['page'] + 1}] {doc.page_content}"
+    return doc.page_content
+
+
+def format_context(passages):
+    """
+    @brief Joins passages into the context of a stuffed prompt.
+
+    @param passages: Documents returned by `ContextAssembler.assemble`.
+    @return: str - The formatted passages, best first.
+    """
+    return PASSAGE_SEPARATOR.join(format_passage(doc) for doc in passages)
+
+
+# -------------------------------------------------------------------------
+# Sentence-level Compression
+# -------------------------------------------------------------------------
+
+def split_sentences(text):
+    """
+    @brief Splits a passage into sentences, and the rows of its tables.
+
+    @details PDF text wraps lines mid-sentence: lines are rejoined before splitting at
+             sentence ends, except table rows (a line ending with a figure and holding
+             at least two), which stand alone.
+
+    @param text: Passage text.
+    @return: List[str] - Sentences and rows in reading order, whitespace collapsed.
+    """
+    units, prose = [], []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line:
+            continue
+        figures = FIGURE.findall(line)
+        if len(figures) >= 2 and line.endswith(figures[-1]):
+            if prose:
+                units.extend(SENTENCE_END.split(" ".join(prose)))
+                prose = []
+            units.append(line)
+        else:
+            prose.append(line)
+    if prose:
+        units.extend(SENTENCE_END.split(" ".join(prose)))
+    return [unit for unit in units if unit]
+
+
+class ContextCompressor:
+    """
+    @brief Reduces the retrieved passages to the sentences closest to the question,
+           under a token budget.
+
+    @details Overlapping chunks are merged and split into sentences (and table rows),
+             which are embedded with the retrieval embeddings (cached per text, so the
+             sentences of chunks retrieved before are free) and ranked by cosine
+             similarity to the question. Sentences are taken in that order while they
+             fit the budget, then put back in reading order within their passage;
+             passages keep their retrieval rank. Repeated sentences are kept once.
+    """
+
+    def __init__(self, embeddings, count_tokens, budget):
+        """
+        @param embeddings: LangChain embeddings of the vector store.
+        @param count_tokens: Returns the number of tokens of a text for the model.
+        @param budget: Maximum number of context tokens.
+        """
+        self.embeddings = embeddings
+        self.count_tokens = count_tokens
+        self.budget = budget
+
+    def compress(self, docs, query_vector):
+        """
+        @brief Selects the sentences of the context.
+
+        @param docs: Retrieved LangChain Documents, best first.
+        @param query_vector: Embedding of the question.
+        @return: List[Document] - Passages holding the selected sentences, best first.
+        """
+        passages = merge_overlapping(docs)
+        units, seen = [], set()  # (passage index, sentence)
+        for index, passage in enumerate(passages):
+            for sentence in split_sentences(passage.page_content):
+                if sentence not in seen:
+                    seen.add(sentence)
+                    units.append((index, sentence))
+        if not units:
+            return []
+
+        texts = [sentence for _, sentence in units]
+        embed_array = getattr(self.embeddings, "embed_array", None)
+        vectors = embed_array(texts) if embed_array else np.asarray(self.embeddings.embed_documents(texts))
+        query = np.asarray(query_vector, dtype=np.float32)
+        scores = vectors @ query / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), 1e-12)
+
+        selected, used = set(), 0
+        opened = set()  # Passages whose separator and page header are counted
+        separator = self.count_tokens(PASSAGE_SEPARATOR)
+        for position in np.argsort(-scores, kind="stable"):
+            index, sentence = units[position]
+            tokens = self.count_tokens(sentence) + 1
+            if index not in opened:
+                tokens += self.count_tokens(format_passage(Document(page_content="", metadata=passages[index].metadata)))
+                tokens += separator if opened else 0
+            if used + tokens <= self.budget:
+                selected.add(position)
+                opened.add(index)
+                used += tokens
+
+        kept = {}
+        for position in sorted(selected):
+            index, sentence = units[position]
+            kept.setdefault(index, []).append(sentence)
+        return [Document(page_content=" ".join(kept[index]), metadata=passages[index].metadata)
+                for index in sorted(kept)]
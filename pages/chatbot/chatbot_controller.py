@@ -1,30 +1,211 @@
+import dash_bootstrap_components as dbc
+from dash import Patch, no_update
 from dash.dependencies import Input, Output, State
 from app import app
 
 from components.textbox import render_textbox
-from pages.chatbot.chatbot_model import conversation_chain, vectordb, MODEL_NAME
+from pages.chatbot.chatbot_config import CHAIN_STRATEGY, RENDER_WINDOW, MODEL_NAME, MODELS
+from pages.chatbot.chatbot_filters import FILING_AUTO
+from pages.chatbot.chatbot_jobs import jobs, JobRejected, JOB_DONE, JOB_TIMEOUT, FINAL_STATES
+from pages.chatbot.chatbot_metrics import span, timed
+from pages.chatbot.chatbot_pipeline import answer_question
+from pages.chatbot.chatbot_registry import registry, STATE_READY, STATE_FAILED
+from pages.chatbot.chatbot_sessions import sessions, ROLE_HUMAN, ROLE_AI
+from pages.chatbot.chatbot_view import FILING_OPTIONS
+
+# Style of the "Show earlier messages" button when there is nothing more to show
+HIDDEN = {"display": "none"}
 
 @app.callback(
-    Output(component_id="display-conversation", component_property="children"),
-    Input(component_id="store-conversation", component_property="data")
+    Output("model-status", "children"),
+    Output("user-input", "disabled"),
+    Output("submit", "disabled"),
+    Output("warmup-interval", "disabled"),
+    Input("warmup-interval", "n_intervals"),
 )
-def update_display(chat_history):
+def update_model_status(n_intervals):
+    """
+    @brief Reports the model warm-up progress and locks the input until models are ready.
+
+    @details Polled by the "warmup-interval" component, which is disabled once the
+             models are loaded (or failed to load).
+
+    @param n_intervals: Number of times the interval has fired.
+    @return: Tuple - Status banner, input/button disabled flags and interval disabled flag.
     """
-    @brief Updates the chat display with the conversation history.
+    status = registry.status()
+    if status["state"] == STATE_READY:
+        return None, False, False, True
+    if status["state"] == STATE_FAILED:
+        banner = dbc.Alert(f"Models failed to load: {status['error']}", color="danger")
+        return banner, True, True, True
+    loaded = ", ".join(status["loaded"]) or "nothing yet"
+    banner = dbc.Alert(f"Warming up models, please wait... (loaded: {loaded})", color="info")
+    return banner, True, True, False
 
-    @details Splits the chat history into individual messages using "<split>" as a delimiter.
-             - Renders human messages on the right and AI messages on the left.
-             - Alternates between human and AI message bubbles.
+@app.callback(
+    Output("filing-select", "options"),
+    Input("warmup-interval", "disabled"),
+)
+def list_filings(warmed_up):
+    """
+    @brief Offers the filings of the corpus in the filing selector once it is loaded.
 
-    @param chat_history: A string containing the entire conversation history.
-    @return: List[html.Div] - A list of Divs, each containing a rendered message bubble.
+    @param warmed_up: Whether the warm-up poller stopped (models ready or failed).
+    @return: List[dict] - Selector options.
     """
-    return [
-        # Render human messages (even indices) and AI messages (odd indices)
-        render_textbox(x, box="human") if i % 2 == 0 else render_textbox(x, box="AI")
-        for i, x in enumerate(chat_history.split("<split>")[:-1])  # Exclude the last empty split
+    retriever = registry.peek("retriever")
+    if retriever is None or retriever.catalog is None:
+        return FILING_OPTIONS
+    catalog = retriever.catalog
+    return FILING_OPTIONS + [
+        {"label": catalog.label(filing), "value": source} for source, filing in catalog.filings.items()
     ]
 
+@app.callback(
+    Output("selected-model", "data"),
+    Input("model-select", "value"),
+)
+def select_model(model_name):
+    """
+    @brief Routes the next questions to the model picked in the selector.
+
+    @param model_name: Value of the model selector.
+    @return: str - The selected model, or the default one if it is not offered.
+    """
+    return model_name if model_name in MODELS else MODEL_NAME
+
+def _render_turns(turns):
+    """
+    @brief Renders conversation turns as message bubbles.
+
+    @param turns: Turns returned by the session store, oldest first.
+    @return: List[html.Div] - Human messages on the right, AI messages on the left.
+    """
+    return [render_textbox(turn["text"], box="human" if turn["role"] == ROLE_HUMAN else "AI") for turn in turns]
+
+def _last_turn_id(session_id):
+    """
+    @return: int or None - Id of the latest turn stored for the session.
+    """
+    turns = sessions.turns(session_id, limit=1)
+    return turns[0]["id"] if turns else None
+
+@app.callback(
+    Output("display-conversation", "children"),
+    Output("store-first-turn", "data"),
+    Output("store-last-turn", "data"),
+    Output("load-earlier", "style"),
+    Output("store-job", "data", allow_duplicate=True),
+    Output("store-partial", "data", allow_duplicate=True),
+    Output("job-poller", "disabled", allow_duplicate=True),
+    Input("session-id", "data"),
+    prevent_initial_call="initial_duplicate",
+)
+@timed("render_conversation")
+def load_conversation(session_id):
+    """
+    @brief Renders the latest messages of the session when the page is opened.
+
+    @details Only the last RENDER_WINDOW turns are rendered; older ones are loaded on
+             demand by `load_earlier`. If the session's last question is still being
+             answered, the poller is restarted.
+
+    @param session_id: Id of the browser session.
+    @return: Tuple - Message bubbles, ids of the first and last rendered turns,
+             "Show earlier messages" style, pending job id, pending answer and
+             whether the job poller is disabled.
+    """
+    turns = sessions.turns(session_id, limit=RENDER_WINDOW)
+    first = turns[0]["id"] if turns else None
+    last = turns[-1]["id"] if turns else None
+    earlier = bool(turns) and bool(sessions.turns(session_id, before=first, limit=1))
+
+    job_id = sessions.pending(session_id)
+    if job_id is not None and jobs.poll(job_id) is None:
+        # The job was lost (server restart or another worker process): close the question
+        sessions.close_pending(session_id, job_id, "Sorry, the answer was interrupted. Please try again.")
+        return load_conversation(session_id)
+    return (_render_turns(turns), first, last, None if earlier else HIDDEN,
+            job_id, "" if job_id else None, job_id is None)
+
+@app.callback(
+    Output("display-conversation", "children", allow_duplicate=True),
+    Output("store-first-turn", "data", allow_duplicate=True),
+    Output("load-earlier", "style", allow_duplicate=True),
+    Input("load-earlier", "n_clicks"),
+    State("session-id", "data"),
+    State("store-first-turn", "data"),
+    prevent_initial_call=True,
+)
+@timed("render_earlier")
+def load_earlier(n_clicks, session_id, first_turn):
+    """
+    @brief Prepends the RENDER_WINDOW turns preceding the oldest rendered one.
+
+    @param n_clicks: Number of clicks on "Show earlier messages".
+    @param session_id: Id of the browser session.
+    @param first_turn: Id of the oldest rendered turn.
+    @return: Tuple - Patch of the message bubbles, id of the oldest rendered turn and
+             "Show earlier messages" style.
+    """
+    turns = sessions.turns(session_id, before=first_turn, limit=RENDER_WINDOW)
+    if not turns:
+        return no_update, no_update, HIDDEN
+    bubbles = Patch()
+    for bubble in reversed(_render_turns(turns)):
+        bubbles.prepend(bubble)
+    first = turns[0]["id"]
+    earlier = bool(sessions.turns(session_id, before=first, limit=1))
+    return bubbles, first, None if earlier else HIDDEN
+
+@app.callback(
+    Output("display-conversation", "children", allow_duplicate=True),
+    Output("store-last-turn", "data", allow_duplicate=True),
+    Output("store-partial", "data", allow_duplicate=True),
+    Input("store-server-turn", "data"),
+    State("session-id", "data"),
+    State("store-last-turn", "data"),
+    prevent_initial_call=True,
+)
+@timed("render_turns")
+def append_new_turns(server_turn, session_id, last_turn):
+    """
+    @brief Appends the turns stored since the last rendered one to the display.
+
+    @details The client only receives the new message bubbles (a Patch), never the
+             whole conversation. Triggered whenever a callback stores new turns.
+
+    @param server_turn: Id of the latest turn stored on the server.
+    @param session_id: Id of the browser session.
+    @param last_turn: Id of the latest rendered turn.
+    @return: Tuple - Patch of the message bubbles, id of the last rendered turn and
+             the pending answer (cleared once the question is closed).
+    """
+    turns = sessions.turns(session_id, after=last_turn)
+    if not turns:
+        return no_update, no_update, no_update
+    bubbles = Patch()
+    bubbles.extend(_render_turns(turns))
+    partial = no_update if sessions.pending(session_id) else None
+    return bubbles, turns[-1]["id"], partial
+
+@app.callback(
+    Output("pending-answer", "children"),
+    Input("store-partial", "data"),
+)
+@timed("render_partial")
+def render_pending_answer(partial_answer):
+    """
+    @brief Renders the answer streamed so far (or "...") while a question is pending.
+
+    @param partial_answer: The pending answer streamed so far, None if nothing is pending.
+    @return: html.Div or None - The pending AI message bubble.
+    """
+    if partial_answer is None:
+        return None
+    return render_textbox(partial_answer or "...", box="AI")
+
 @app.callback(
     Output(component_id="user-input", component_property="value"),
     Input(component_id="submit", component_property="n_clicks"),
@@ -43,60 +224,119 @@ def clear_input(n_clicks, n_submit):
     """
     return ""
 
+def _answer(job, user_input, selected_model, strategy, filing):
+    """
+    @brief Generates the chatbot answer. Runs on a JobManager worker thread.
+
+    @param job: The Job being run, checked for cancellation between steps.
+    @param user_input: The question asked by the user.
+    @param selected_model: The model selected by the user (e.g., GPT, LLAMA2).
+    @param strategy: The chain strategy selected by the user (e.g., stuff, refine).
+    @param filing: The filing selected by the user (or detected from the question).
+    @return: str - The answer.
+    """
+    # Root of the request's spans: the pipeline stages nest under it
+    with span("answer", model=selected_model, strategy=strategy, job=job.id):
+        return answer_question(user_input, selected_model, emit=job.emit, is_cancelled=lambda: job.cancelled,
+                               strategy=strategy, filing=filing)
+
 @app.callback(
-    Output("store-conversation", "data"),
+    Output("store-server-turn", "data"),
     Output("loading-component", "children"),
+    Output("store-job", "data"),
+    Output("store-partial", "data", allow_duplicate=True),
+    Output("job-poller", "disabled"),
     Input("submit", "n_clicks"),
     Input("user-input", "n_submit"),
     State("user-input", "value"),
-    State("store-conversation", "data"),
     State("selected-model", "data"),
+    State("session-id", "data"),
+    State("chain-strategy", "value"),
+    State("filing-select", "value"),
+    prevent_initial_call=True,
 )
-def run_chatbot(n_clicks, n_submit, user_input, chat_history, selected_model):
+@timed("submit")
+def run_chatbot(n_clicks, n_submit, user_input, selected_model, session_id, strategy, filing):
     """
-    @brief Handles user input and generates chatbot responses.
+    @brief Handles user input and schedules the chatbot response.
 
     @details Executes the following steps:
              1. Checks for user input and handles empty or null values.
-             2. Appends the user's input to the conversation history.
-             3. Dynamically selects the model to process the response (GPT or other).
-             4. Fetches AI-generated output using the selected model.
-             5. Appends the chatbot's response to the conversation history.
+             2. Closes the previous answer if it is still pending (the job manager
+                cancels it when the new question is submitted).
+             3. Appends the user's input to the session's conversation.
+             4. Submits the question to the job manager and returns immediately;
+                `poll_answer` stores the response once it is ready.
 
     @param n_clicks: Number of clicks on the "Send" button.
     @param n_submit: Number of times the "Enter" key is pressed in the input field.
     @param user_input: The text entered by the user.
-    @param chat_history: The current conversation history.
     @param selected_model: The model selected by the user (e.g., GPT, LLAMA2).
-    @return: Tuple[str, None] - Updated conversation history and `None` for loading component.
+    @param session_id: Id of the browser session.
+    @param strategy: The chain strategy selected by the user (e.g., stuff, refine).
+    @param filing: The filing selected by the user, or "auto" to detect it from the question.
+    @return: Tuple - Id of the latest stored turn, `None` for loading component,
+             pending job id, pending answer and whether the job poller is disabled.
     """
-    # If no input is provided, do nothing
-    if n_clicks == 0 and n_submit is None:
-        return "", None
-
     if not user_input:  # If the input field is empty
-        return chat_history, None
+        return no_update, None, no_update, no_update, no_update
 
-    # Initialize conversation history if not already present
-    chat_history = chat_history or ""
-    # Append the user's input to the conversation history
-    chat_history += f"Human: {user_input}<split>ChatBot: "
+    previous = sessions.pending(session_id)
+    if previous is not None:
+        sessions.close_pending(session_id, previous, "(cancelled)")
+    sessions.append(session_id, ROLE_HUMAN, user_input)
 
+    if selected_model not in MODELS:  # Only offered models may be loaded
+        selected_model = MODEL_NAME
     try:
-        # Handle logic based on the selected model
-        if selected_model == "GPT":
-            # Use GPT model to generate a response
-            output = conversation_chain.invoke(user_input)
-        else:
-            # Use other models for generating responses
-            docs = vectordb.similarity_search(user_input)  # Retrieve similar documents
-            inputs = {"input_documents": docs, "question": user_input}
-            output = conversation_chain.run(inputs)  # Generate the response
-        # Append the chatbot's response to the conversation history
-        chat_history += f"{output}<split>"
-    except Exception as e:
-        # Handle any exceptions in the chatbot logic
-        print(f"Error in chatbot logic: {e}")
-        return chat_history, None
-
-    return chat_history, None
+        job = jobs.submit(session_id, _answer, user_input, selected_model, strategy or CHAIN_STRATEGY,
+                          filing or FILING_AUTO)
+    except JobRejected as e:
+        turn = sessions.append(session_id, ROLE_AI, str(e))
+        return turn["id"], None, None, None, True
+
+    sessions.set_pending(session_id, job.id)
+    return _last_turn_id(session_id), None, job.id, "", False
+
+@app.callback(
+    Output("store-server-turn", "data", allow_duplicate=True),
+    Output("store-partial", "data"),
+    Output("store-job", "data", allow_duplicate=True),
+    Output("job-poller", "disabled", allow_duplicate=True),
+    Input("job-poller", "n_intervals"),
+    State("store-job", "data"),
+    State("session-id", "data"),
+    State("store-partial", "data"),
+    prevent_initial_call=True,
+)
+@timed("poll")
+def poll_answer(n_intervals, job_id, session_id, shown_partial):
+    """
+    @brief Polls the pending job and stores its answer in the conversation.
+
+    @param n_intervals: Number of times the poller has fired.
+    @param job_id: Id of the pending job.
+    @param session_id: Id of the browser session.
+    @param shown_partial: The streamed answer currently displayed.
+    @return: Tuple - Id of the latest stored turn, answer streamed so far, job id and
+             poller disabled flag.
+    """
+    job = jobs.poll(job_id) if job_id else None
+    if job is not None and job.status not in FINAL_STATES:
+        # Show the tokens streamed since the last poll, if any
+        partial = job.partial
+        return no_update, partial if partial != shown_partial else no_update, no_update, no_update
+
+    if job is None:
+        output = "Sorry, the answer was interrupted. Please try again."
+    elif job.status == JOB_DONE:
+        output = job.output
+    elif job.status == JOB_TIMEOUT:
+        output = job.partial or "Sorry, the answer took too long. Please try again."
+    else:
+        output = "Sorry, something went wrong while answering. Please try again."
+    # No-op if the question was already closed (e.g. superseded by a new question)
+    if job_id:
+        sessions.close_pending(session_id, job_id, output)
+    # The pending answer is replaced by the stored one in `append_new_turns`
+    return _last_turn_id(session_id), no_update, None, True
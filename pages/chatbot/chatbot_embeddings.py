@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+
+from pages.chatbot.chatbot_config import EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_DTYPE
+
+# Size in bytes of a text key (BLAKE2b digest)
+KEY_SIZE = 16
+
+# Initial number of rows of a vector file (doubled whenever it is full)
+INITIAL_CAPACITY = 1024
+
+
+def embed_query_array(embeddings, text):
+    """
+    @brief Embeds a query as an array, without copying a cached vector.
+
+    @param embeddings: LangChain embeddings, ideally CachedEmbeddings.
+    @param text: The query.
+    @return: np.ndarray - The query vector. A read-only view on the memory-mapped
+             cache row when it is cached (in the cache dtype); never modify it.
+    """
+    embed = getattr(embeddings, "embed_query_array", None)
+    return embed(text) if embed else np.asarray(embeddings.embed_query(text), dtype=np.float32)
+
+
+def text_key(model_name, text):
+    """
+    @brief Hashes a text together with the model embedding it.
+
+    @param model_name: Name of the embedding model.
+    @param text: Text to embed.
+    @return: bytes - 16-byte BLAKE2b digest.
+    """
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.digest()
+
+
+class EmbeddingStore:
+    """
+    @brief Append-only on-disk store of embedding vectors, memory-mapped for zero-copy reads.
+
+    @details Three files per model and dtype live in the cache directory:
+             - `<name>.vectors`: raw row-major matrix (capacity x dim), memory-mapped;
+             - `<name>.keys`: 16-byte text keys appended in row order, row i <-> key i;
+             - `<name>.json`: model name, dimension and dtype.
+             A vector is written before its key, so a row only becomes visible once it
+             is complete. Appends are serialised across processes with a file lock;
+             the in-memory hash index catches up with rows written by other processes.
+    """
+
+    def __init__(self, cache_dir, model_name, dtype=EMBEDDING_CACHE_DTYPE):
+        """
+        @param cache_dir: Directory of the cache files.
+        @param model_name: Name of the embedding model (part of every key).
+        @param dtype: "float32" or "float16" (half the size, ~3 significant digits).
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        name = f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)}.{dtype}"
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(cache_dir, f"{name}.vectors")
+        self.keys_path = os.path.join(cache_dir, f"{name}.keys")
+        self.meta_path = os.path.join(cache_dir, f"{name}.json")
+        self._file_lock = FileLock(os.path.join(cache_dir, f"{name}.lock"))
+        self._lock = threading.Lock()
+        self._index = {}  # key -> row
+        self._keys_offset = 0  # Bytes of the keys file already indexed
+        self._matrix = None
+        self.dim = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            self._refresh()
+
+    def __len__(self):
+        return len(self._index)
+
+    # ---------------------------------------------------------------------
+    # Reads
+    # ---------------------------------------------------------------------
+
+    def _refresh(self):
+        """
+        @brief Indexes the rows appended (by this or another process) since the last call.
+        """
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        complete = len(data) - len(data) % KEY_SIZE
+        first_row = self._keys_offset // KEY_SIZE
+        for i in range(0, complete, KEY_SIZE):
+            self._index[data[i:i + KEY_SIZE]] = first_row + i // KEY_SIZE
+        self._keys_offset += complete
+        if self._matrix is None or self._matrix.shape[0] < len(self._index):
+            self._map()
+
+    def _map(self):
+        rows = os.path.getsize(self.vectors_path) // (self.dim * self.dtype.itemsize)
+        self._matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(rows, self.dim))
+
+    def get(self, key):
+        """
+        @brief Returns a cached vector without copying it.
+
+        @param key: Key returned by `text_key`.
+        @return: np.ndarray or None - Read-only view on the memory-mapped row.
+        """
+        row = self._index.get(key)
+        if row is None:
+            return None
+        view = self._matrix[row]
+        view.flags.writeable = False
+        return view
+
+    def rows(self, keys):
+        """
+        @param keys: Keys returned by `text_key`.
+        @return: List[int or None] - Row of each key, None when not cached.
+        """
+        return [self._index.get(key) for key in keys]
+
+    def take(self, rows):
+        """
+        @brief Gathers rows into a float32 matrix (a single vectorised copy).
+        """
+        return np.asarray(self._matrix[np.asarray(rows, dtype=np.int64)], dtype=np.float32)
+
+    # ---------------------------------------------------------------------
+    # Writes
+    # ---------------------------------------------------------------------
+
+    def add(self, keys, vectors):
+        """
+        @brief Appends vectors, skipping keys stored meanwhile by another thread or process.
+
+        @param keys: Keys returned by `text_key`.
+        @param vectors: float32 matrix, one row per key.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "dim": self.dim, "dtype": self.dtype.name}, f)
+                open(self.vectors_path, "ab").close()
+                self._map_capacity(INITIAL_CAPACITY)
+            self._refresh()
+
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._index and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+
+            start = len(self._index)
+            capacity = self._matrix.shape[0]
+            if start + len(new) > capacity:
+                while start + len(new) > capacity:
+                    capacity *= 2
+                self._map_capacity(capacity)
+            self._matrix[start:start + len(new)] = np.stack(list(new.values())).astype(self.dtype)
+            self._matrix.flush()
+
+            # Publish the rows: they become visible once their keys are written
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new.keys()))
+            self._refresh()
+
+    def _map_capacity(self, capacity):
+        size = capacity * self.dim * self.dtype.itemsize
+        if os.path.getsize(self.vectors_path) < size:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(size)
+        self._map()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    @brief LangChain embeddings wrapper serving repeated texts from an EmbeddingStore.
+
+    @details Texts are keyed by hash and model name; only cache misses of a batch are
+             sent to the wrapped model, in one call. Chunk boilerplate repeated across
+             filings and repeated questions are therefore embedded once.
+    """
+
+    def __init__(self, base, model_name, cache_dir=EMBEDDING_CACHE_DIR, dtype=EMBEDDING_CACHE_DTYPE):
+        """
+        @param base: The wrapped LangChain embeddings (e.g. HuggingFaceEmbeddings).
+        @param model_name: Name of the wrapped model.
+        @param cache_dir: Directory of the cache files.
+        @param dtype: Storage dtype, "float32" or "float16".
+        """
+        self.base = base
+        self.model_name = model_name
+        self.store = EmbeddingStore(cache_dir, model_name, dtype)
+        self.hits = 0
+        self.misses = 0
+
+    def embed_array(self, texts):
+        """
+        @brief Embeds texts, computing only the ones not cached yet.
+
+        @param texts: Texts to embed.
+        @return: np.ndarray - float32 matrix, one row per text.
+        """
+        if not texts:
+            return np.zeros((0, self.store.dim or 0), dtype=np.float32)
+        keys = [text_key(self.model_name, text) for text in texts]
+        rows = self.store.rows(keys)
+        result = np.empty((len(texts), self.store.dim or 0), dtype=np.float32)
+
+        cached = [i for i, row in enumerate(rows) if row is not None]
+        if cached:
+            result[cached] = self.store.take([rows[i] for i in cached])
+        self.hits += len(cached)
+
+        # Embed each distinct missing text once, in a single call
+        missing = {}
+        for i, row in enumerate(rows):
+            if row is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            first = [positions[0] for positions in missing.values()]
+            computed = np.asarray(self.base.embed_documents([texts[i] for i in first]), dtype=np.float32)
+            self.store.add(list(missing), computed)
+            self.misses += len(first)
+            if result.shape[1] != computed.shape[1]:  # First vectors ever stored
+                result = np.empty((len(texts), computed.shape[1]), dtype=np.float32)
+            for vector, positions in zip(computed, missing.values()):
+                result[positions] = vector
+        return result
+
+    def embed_documents(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query_array(self, text):
+        """
+        @brief Embeds a query, returning a cached vector without copying it.
+
+        @param text: The query.
+        @return: np.ndarray - Read-only view on the memory-mapped row if the query is
+                 cached (in the cache dtype), else a freshly computed float32 vector.
+        """
+        vector = self.store.get(text_key(self.model_name, text))
+        if vector is not None:
+            self.hits += 1
+            return vector
+        return self.embed_array([text])[0]
+
+    def embed_query(self, text):
+        # LangChain expects a list of floats: the only copy of a cached query vector
+        return self.embed_query_array(text).tolist()
+
+    def stats(self):
+        """
+        @return: dict - Cache hits, misses and number of stored vectors.
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.store)}
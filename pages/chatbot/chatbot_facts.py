@@ -0,0 +1,552 @@
+import json
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from pages.chatbot.chatbot_filters import MONTHS, company_alias, mentioned_periods
+
+# A line item value of a statement table. `period` is the end date of the column
+# ("YYYY-MM-DD"), `months` its duration (0 for a balance at a date) and `page` the
+# 0-based page index, as in the chunk metadata.
+Fact = namedtuple("Fact", ["statement", "section", "item", "period", "months", "value", "unit", "page"])
+
+# Columns of the fact store and their NumPy types (strings are fixed-width unicode)
+FACT_COLUMNS = [
+    ("statement", str), ("section", str), ("item", str), ("period", str),
+    ("months", np.int8), ("value", np.float64), ("unit", str), ("page", np.int32),
+]
+
+# Longer lines without values are prose rather than section headings
+MAX_HEADING_WORDS = 12
+
+NUMBER_WORDS = {"three": 3, "six": 6, "nine": 9, "twelve": 12}
+MONTH_COUNTS = {months: word for word, months in NUMBER_WORDS.items()}
+MONTH_NAMES = ["January", "February", "March", "April", "May", "June", "July", "August", "September",
+               "October", "November", "December"]
+
+# Questions asking for an explanation or a comparison rather than a reported value
+NON_DIRECT_PATTERN = re.compile(
+    r"\b(?:why|explain|describe|discuss|compare[ds]?|comparison|versus|vs|change[ds]?|increase[ds]?|decrease[ds]?|"
+    r"grow|grew|growth|trend|driven|drivers?|impact|reasons?|difference|outlook|guidance|risks?)\b",
+    re.IGNORECASE,
+)
+# Questions carving a part out of a line item ("revenue excluding regulatory credits",
+# "revenue not from automotive"), which no single reported value answers
+EXCLUSION_PATTERN = re.compile(
+    r"\b(?:exclud(?:e[ds]?|ing)|not|non|without|other\s+than|net\s+of|except|apart\s+from|besides|minus|"
+    r"\w+n't)\b",
+    re.IGNORECASE,
+)
+MONTHS_PATTERN = re.compile(r"\b(three|six|nine|twelve)\s+months\b", re.IGNORECASE)
+QUARTER_WORD_PATTERN = re.compile(r"\bquarter(?:ly)?\b", re.IGNORECASE)
+ANNUAL_PATTERN = re.compile(r"\b(?:annual|full\s+year|year\s+ended|fiscal\s+year)\b", re.IGNORECASE)
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+# ", net" closing a balance sheet label ("Accounts receivable, net") is not asked for
+COMMA_NET_PATTERN = re.compile(r",\s*net$", re.IGNORECASE)
+STOP_WORDS = {"a", "an", "and", "as", "at", "by", "for", "from", "in", "of", "on", "or", "the", "to", "s"}
+# Words that do not identify an item on their own ("Total", "Less: ...", "Basic")
+GENERIC_WORDS = {"total", "less", "add", "other", "basic", "diluted"}
+# Words of a question that frame it or name its period rather than what it asks for
+# (singular, as returned by `label_words`). Any other word must be matched by the
+# answered item, its section or statement, or its filing.
+QUESTION_WORDS = {
+    "what", "was", "were", "is", "are", "did", "do", "doe", "how", "much", "many", "which", "it", "its", "their",
+    "company", "value", "amount", "figure", "number", "report", "reported", "record", "recorded",
+    "have", "has", "had", "hold", "held", "come", "came", "spend", "spent", "generate", "generated", "earn", "earned",
+    "make", "made", "during", "ended", "ending", "period", "month", "quarter", "quarterly", "year", "annual",
+    "fiscal", "full", "q", "fy", "first", "second", "third", "fourth", "three", "six", "nine", "twelve",
+} | {month.lower() for month in MONTH_NAMES}
+
+# "(in millions, except per share data)", "(Dollars in thousands)"
+SCALE_PATTERN = re.compile(r"\(\s*(?:dollars\s+|\$\s*)?in\s+(thousands|millions|billions)", re.IGNORECASE)
+# "Consolidated Statements of Operations", "Consolidated Balance Sheets"
+STATEMENT_PATTERN = re.compile(r"^(?:condensed\s+)?consolidated\s+(?:statements?\s+of\s+[a-z ,()']+|balance\s+sheets?)\s*$",
+                               re.IGNORECASE)
+# "Three Months Ended September 30,", "Year Ended December 31,"
+DURATION_PATTERN = re.compile(
+    r"\b(?:(three|six|nine|twelve)\s+months|(year))\s+ended\s+(" + "|".join(MONTHS) + r")\.?\s+(\d{1,2})",
+    re.IGNORECASE,
+)
+# "September 30, 2023" in a column header
+HEADER_DATE_PATTERN = re.compile(r"\b(" + "|".join(MONTHS) + r")\.?\s+(\d{1,2}),?\s+(\d{4})\b", re.IGNORECASE)
+YEARS_PATTERN = re.compile(r"^\s*(?:(?:19|20)\d{2}\s*){2,}$")
+# Pieces of a column header broken over several lines ("September 30,", "2023")
+HEADER_PIECE_PATTERN = re.compile(r"\b(?:(?:" + "|".join(MONTHS) + r")\.?\s+\d{1,2}|(?:19|20)\d{2})\b,?", re.IGNORECASE)
+# A value cell: "$ 18,582", "(38)", "0.53", "17.9 %" or a dash for zero
+VALUE_PATTERN = re.compile(r"(?:^|\s)(?:\$\s*)?(\(?-?\d[\d,]*(?:\.\d+)?\)?|[—–-])\s*(%)?\s*$")
+
+
+def _period(year, month, day):
+    return f"{int(year):04d}-{MONTHS[month.lower()]:02d}-{int(day):02d}"
+
+
+def _number(cell):
+    if cell in ("—", "–", "-"):
+        return 0.0
+    negative = cell.startswith("(") and cell.endswith(")")
+    value = float(cell.strip("()").replace(",", ""))
+    return -value if negative else value
+
+
+# -------------------------------------------------------------------------
+# Table Extraction
+# -------------------------------------------------------------------------
+
+def header_columns(lines):
+    """
+    @brief Reads the columns of a statement table from its header lines.
+
+    @details Two layouts are recognised: duration groups over a line of years
+             ("Three Months Ended September 30, Nine Months Ended September 30," then
+             "2023 2022 2023 2022") and full dates ("September 30, 2023 December 31,
+             2022"), which are balances unless a duration group precedes them.
+
+    @param lines: The candidate header line, preceded by up to two earlier lines.
+    @return: List[Tuple[str, int]] or None - (period end date, months) per column.
+    """
+    line = lines[-1]
+    durations = []
+    for previous in lines[:-1]:
+        durations += [(NUMBER_WORDS[words.lower()] if words else 12, month, day)
+                      for words, year_word, month, day in DURATION_PATTERN.findall(previous)]
+
+    if YEARS_PATTERN.match(line):
+        years = line.split()
+        if not durations or len(years) % len(durations):
+            return None
+        per_group = len(years) // len(durations)
+        return [(_period(year, *durations[i // per_group][1:]), durations[i // per_group][0])
+                for i, year in enumerate(years)]
+
+    dates = HEADER_DATE_PATTERN.findall(line)
+    if len(dates) < 2 or HEADER_DATE_PATTERN.sub("", line).strip(" ,"):
+        return None
+    if durations and len(dates) % len(durations) == 0:
+        per_group = len(dates) // len(durations)
+        return [(_period(year, month, day), durations[i // per_group][0])
+                for i, (month, day, year) in enumerate(dates)]
+    return [(_period(year, month, day), 0) for month, day, year in dates]
+
+
+def join_header_pieces(lines):
+    """
+    @brief Joins the consecutive lines holding only dates or years, so a header
+           printed one cell per line ("September 30,", "2023", "December 31,", "2022")
+           reads as one line.
+    """
+    joined = []
+    for line in lines:
+        piece = not HEADER_PIECE_PATTERN.sub("", line).strip(" ,") and HEADER_PIECE_PATTERN.search(line)
+        if piece and joined and joined[-1][1]:
+            joined[-1] = (f"{joined[-1][0]} {line}", True)
+        else:
+            joined.append((line, bool(piece)))
+    return [line for line, _ in joined]
+
+
+def split_row(line):
+    """
+    @brief Splits a table row into its label and trailing value cells.
+
+    @return: Tuple[str, List[str], bool] - Label, value cells (left to right) and
+             whether the values are percentages.
+    """
+    cells, percent = [], False
+    rest = line.replace("$", " $ ").rstrip()
+    while True:
+        match = VALUE_PATTERN.search(rest)
+        if not match:
+            break
+        cells.insert(0, match.group(1))
+        percent = percent or bool(match.group(2))
+        rest = rest[:match.start()]
+    return rest.strip(" $:"), cells, percent
+
+
+def _unit(scale, section, item, percent):
+    context = f"{section} {item}".lower()
+    if percent:
+        return "%"
+    if re.search(r"\bshares\b", context):
+        return f"shares ({scale})" if scale else "shares"
+    if "per share" in context and "used in computing" not in context:
+        return "USD per share"
+    return f"USD {scale}" if scale else "USD"
+
+
+def extract_facts(page_texts):
+    """
+    @brief Pulls the line items of the statement tables out of a filing's pages.
+
+    @details PyPDF renders a table row as one line: the item label followed by one
+             value per column. Inside a table (a scale such as "(in millions)" and a
+             column header were read), every line with exactly one value per column
+             becomes a fact. Short lines without values open a section ("Revenues",
+             "Cost of revenues"), or continue a label broken over two lines. A title
+             and scale closing a page apply to the table opening the next one.
+
+    @param page_texts: Text of every page, in order.
+    @return: List[Fact]
+    """
+    facts = []
+    statement = scale = ""
+    for page, text in enumerate(page_texts):
+        lines = join_header_pieces([line.strip() for line in text.splitlines() if line.strip()])
+        columns = None
+        section = outer = pending = ""  # `outer`: section before the pending line
+        for i, line in enumerate(lines):
+            if STATEMENT_PATTERN.match(line):
+                statement, columns, section = line, None, ""
+                continue
+            scale_match = SCALE_PATTERN.search(line)
+            if scale_match:
+                scale = scale_match.group(1).lower()
+                continue
+            header = header_columns(lines[max(i - 2, 0):i + 1])
+            if header:
+                columns, section, pending = header, "", ""
+                continue
+            if columns is None or not scale:
+                continue
+
+            label, cells, percent = split_row(line)
+            if not cells and (len(label.split()) > MAX_HEADING_WORDS or label.endswith((".", ":"))):
+                section = pending = ""  # Prose between two tables
+                continue
+            if not cells:
+                # Section heading, or the first part of a label continued on the next line
+                if label[:1].islower() and pending:
+                    pending = f"{pending} {label}"
+                else:
+                    outer, pending = section, label
+                section = pending
+                continue
+            if len(cells) != len(columns) or not label:
+                pending = ""
+                continue
+            if label[:1].islower() and pending:
+                label, section = f"{pending} {label}", outer
+            pending = ""
+            unit = _unit(scale, section, label, percent)
+            facts.extend(Fact(statement, section, label, period, months, _number(cell), unit, page)
+                         for (period, months), cell in zip(columns, cells))
+            if label.lower() == f"total {section.lower()}":
+                section = ""  # "Total revenues" closes "Revenues"
+        if columns is not None:
+            statement = scale = ""  # Only a title without its table carries over
+    return facts
+
+
+# -------------------------------------------------------------------------
+# Question Matching
+# -------------------------------------------------------------------------
+
+def label_words(text):
+    """
+    @return: List[str] - Lower-cased, singular words of a label or question, without
+             stop words ("Total revenues" -> ["total", "revenue"]).
+    """
+    words = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if word.endswith("ies") and len(word) > 4:
+            word = word[:-3] + "y"
+        elif word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+@lru_cache(maxsize=65536)
+def _word_set(label):
+    return frozenset(label_words(label))
+
+
+def question_months(question, quarters, years):
+    """
+    @return: int - Duration the question asks about in months (0 when not stated).
+    """
+    match = MONTHS_PATTERN.search(question)
+    if match:
+        return NUMBER_WORDS[match.group(1).lower()]
+    if quarters or QUARTER_WORD_PATTERN.search(question):
+        return 3
+    if years or ANNUAL_PATTERN.search(question):
+        return 12
+    return 0
+
+
+def _label_score(words, item, section, primary):
+    """
+    @brief Scores how well a line item matches the words of a question.
+
+    @details At least two thirds of the item's distinctive words must appear in the
+             question (all of them for items of one or two words). Generic items
+             ("Total", "Diluted") are only named through their section, half of whose
+             words must then appear. Among matching items, the one accounting for the
+             most question words (with its section) wins: "diluted net income per share"
+             is "Diluted" under "Net income per share", not "Net income". Items of the
+             primary statements win ties.
+
+    @return: tuple or None - Sort key (higher is better), None if the item does not match.
+    """
+    item_words = _word_set(COMMA_NET_PATTERN.sub("", item))
+    section_words = _word_set(section)
+    core = item_words - GENERIC_WORDS
+    section_coverage = len(section_words & words) / len(section_words) if section_words else 0.0
+    if not core:
+        if section_coverage < 0.5:
+            return None
+        core = item_words
+    coverage = len(core & words) / len(core)
+    if coverage < (1.0 if len(core) <= 2 else 2 / 3):
+        return None
+    return len((item_words | section_words) & words), coverage, section_coverage, primary
+
+
+def _covered_words(columns, row, filing):
+    """
+    @return: Set[str] - Question words accounted for by a fact: its item, section and
+             statement, its filing (company, ticker, form) and the framing words.
+    """
+    covered = QUESTION_WORDS | _word_set(columns["item"][row]) | _word_set(columns["section"][row])
+    covered |= _word_set(columns["statement"][row])
+    for part in (company_alias(filing.get("company") or ""), filing.get("ticker") or "", filing.get("form") or ""):
+        covered |= _word_set(part)
+    return covered
+
+
+def _date_text(period):
+    year, month, day = (int(part) for part in period.split("-"))
+    return f"{MONTH_NAMES[month - 1]} {day}, {year}"
+
+
+def format_value(value, unit):
+    """
+    @return: str - A value in the units of its table ("$23,350 million", "$0.53", "17.9%").
+    """
+    number = f"{abs(value):,.0f}" if value == int(value) else f"{abs(value):,.2f}"
+    sign = "-" if value < 0 else ""
+    if unit == "%":
+        return f"{value:g}%"
+    if unit == "USD per share":
+        return f"{sign}${abs(value):,.2f}"
+    if unit.startswith("shares"):
+        scale = unit[len("shares ("):-1]
+        return f"{sign}{number} {scale[:-1]} shares" if scale else f"{sign}{number} shares"
+    scale = unit[len("USD "):]
+    return f"{sign}${number} {scale[:-1]}" if scale else f"{sign}${number}"
+
+
+def format_fact(columns, row, filing):
+    """
+    @return: str - Answer stating a fact, its period and where it is reported.
+    """
+    item, section = columns["item"][row], columns["section"][row]
+    if not set(label_words(item)) - GENERIC_WORDS and section:
+        item = f"{section}, {item[:1].lower()}{item[1:]}"  # "..., diluted"
+    months, period = int(columns["months"][row]), columns["period"][row]
+    if months == 0:
+        when = f"as of {_date_text(period)}"
+    elif months == 12:
+        when = f"for the year ended {_date_text(period)}"
+    else:
+        when = f"for the {MONTH_COUNTS[months]} months ended {_date_text(period)}"
+    label = " ".join(part for part in (filing.get("ticker"), filing.get("form"), filing.get("period")) if part)
+    where = [label or os.path.basename(filing["source"]), columns["statement"][row],
+             f"page {int(columns['page'][row]) + 1}"]
+    value = format_value(float(columns["value"][row]), columns["unit"][row])
+    return f"{item}: {value} {when} ({', '.join(part for part in where if part)})."
+
+
+# -------------------------------------------------------------------------
+# Fact Store
+# -------------------------------------------------------------------------
+
+def facts_path(directory, key):
+    """
+    @return: str - File holding the facts of the filing ingested under `key`.
+    """
+    return os.path.join(directory, f"{key[:16]}.npz")
+
+
+class FactStore:
+    """
+    @brief Columnar store of the statement line items of the corpus.
+
+    @details Every fact is a row across typed NumPy columns (see FACT_COLUMNS) plus the
+             index of its filing in `filings`. Each filing's facts are saved next to the
+             vector store when it is ingested, and the store of the whole corpus
+             concatenates them at startup.
+    """
+
+    def __init__(self, columns, filings):
+        """
+        @param columns: Dict of column name -> np.ndarray, including "filing".
+        @param filings: List of dicts (source, ticker, form, period) indexed by "filing".
+        """
+        self.columns = columns
+        self.filings = filings
+        self.sources = np.array([filing["source"] for filing in filings] or [""])
+        periods = columns["period"].astype("U10")
+        self.years = np.array([int(p[:4]) for p in periods], dtype=np.int16)
+        self.quarters = np.array([(int(p[5:7]) - 1) // 3 + 1 for p in periods], dtype=np.int8)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.columns["value"])
+
+    @classmethod
+    def from_facts(cls, facts, filing):
+        """
+        @brief Builds the store of one filing.
+
+        @param facts: List of Fact (see `extract_facts`).
+        @param filing: Filing metadata: source, ticker, form and period.
+        """
+        columns = {name: np.array([getattr(fact, name) for fact in facts], dtype=dtype)
+                   for name, dtype in FACT_COLUMNS}
+        columns["filing"] = np.zeros(len(facts), dtype=np.int32)
+        return cls(columns, [filing] if facts else [])
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        @brief Merges the stores of several filings.
+        """
+        stores = [store for store in stores if len(store)]
+        if not stores:
+            return cls.from_facts([], None)
+        filings, offsets = [], []
+        for store in stores:
+            offsets.append(len(filings))
+            filings.extend(store.filings)
+        columns = {name: np.concatenate([store.columns[name] for store in stores]) for name, _ in FACT_COLUMNS}
+        columns["filing"] = np.concatenate([store.columns["filing"] + offset for store, offset in zip(stores, offsets)])
+        return cls(columns, filings)
+
+    def save(self, path):
+        """
+        @brief Writes the columns and filing metadata to a .npz file (no pickled objects).
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, filings=np.array(json.dumps(self.filings)), **self.columns)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {name: data[name] for name, _ in FACT_COLUMNS + [("filing", np.int32)]}
+            return cls(columns, json.loads(data["filings"].item()))
+
+    def stats(self):
+        return {"facts": len(self), "filings": len(self.filings), "hits": self.hits, "misses": self.misses}
+
+    # ---------------------------------------------------------------------
+    # Numeric Answers
+    # ---------------------------------------------------------------------
+
+    def answer(self, question, sources=None):
+        """
+        @brief Answers a direct numeric question from the stored line items.
+
+        @details The question must name a period and a line item, and ask for its value
+                 rather than an explanation or a comparison. The rows of the filings
+                 searched (`sources`) at that period are narrowed with column masks,
+                 then their labels are matched against the question words (see
+                 `_label_score`). Anything ambiguous (two items, two durations, two
+                 companies with different values) is left to the LLM, and so are
+                 questions excluding part of an item ("excluding", "not from") or
+                 with words the matched item, period and filing do not account for.
+
+        @param question: The user's question.
+        @param sources: Sources of the filings to search, None for all of them.
+        @return: str or None - The answer with its source, or None to fall back to RAG.
+        """
+        answer = self._answer(question, sources) if len(self) else None
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def _answer(self, question, sources):
+        if NON_DIRECT_PATTERN.search(question) or EXCLUSION_PATTERN.search(question):
+            return None
+        dates, quarters, years = mentioned_periods(question)
+        if not (dates or quarters or years):
+            return None
+
+        mask = np.zeros(len(self), dtype=bool)
+        if dates:
+            mask |= np.isin(self.columns["period"], list(dates))
+        for year, quarter in quarters:
+            mask |= (self.years == year) & (self.quarters == quarter)
+        if years and not (dates or quarters):
+            mask |= np.isin(self.years, list(years))
+        months = question_months(question, quarters, years)
+        balances = self.columns["months"] == 0
+        if months:
+            mask &= (self.columns["months"] == months) | balances
+        elif (mask & balances).any():
+            mask &= balances  # "Inventory at September 30": the balance, not the change in the period
+        if sources is not None:
+            mask &= np.isin(self.sources[self.columns["filing"]], sources)
+
+        words = set(label_words(question))
+        best, rows = None, []
+        for row in np.flatnonzero(mask):
+            score = _label_score(words, self.columns["item"][row], self.columns["section"][row],
+                                 bool(self.columns["statement"][row]))
+            if score is None or (best is not None and score < best):
+                continue
+            if best is None or score > best:
+                best, rows = score, []
+            rows.append(row)
+
+        values = {self.columns["value"][row] for row in rows}
+        if len(values) != 1:
+            return None
+        row = rows[0]
+        filing = self.filings[self.columns["filing"][row]]
+        if words - _covered_words(self.columns, row, filing):
+            return None  # The question asks for more than the item ("...in China", "...per vehicle")
+        return format_fact(self.columns, row, filing)
+
+
+# -------------------------------------------------------------------------
+# Persistence
+# -------------------------------------------------------------------------
+
+def remove_facts(directory, key):
+    """
+    @brief Deletes the facts of a filing that left the corpus or changed.
+    """
+    path = facts_path(directory, key)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def load_fact_store(directory, manifest):
+    """
+    @brief Loads the facts of every filing recorded in the ingestion manifest.
+
+    @param directory: Directory of the per-filing fact files.
+    @param manifest: IngestManifest of the persisted vector store.
+    @return: FactStore
+    """
+    stores = []
+    for entry in manifest.documents.values():
+        path = facts_path(directory, entry["key"])
+        if os.path.exists(path):
+            stores.append(FactStore.load(path))
+    store = FactStore.concat(stores)
+    print(f'Loaded {len(store)} facts from {len(store.filings)} filings')
+    return store
@@ -0,0 +1,193 @@
+import re
+from collections import namedtuple
+
+# Selector values that are not a filing: detect the filings from the question, or search all
+FILING_AUTO = "auto"
+FILING_ALL = "all"
+
+# A filing of the corpus, as described by the metadata of its chunks
+Filing = namedtuple("Filing", ["source", "ticker", "form", "period", "company"])
+
+MONTHS = {
+    name: number
+    for number, names in enumerate([
+        ("january", "jan"), ("february", "feb"), ("march", "mar"), ("april", "apr"), ("may",),
+        ("june", "jun"), ("july", "jul"), ("august", "aug"), ("september", "sep", "sept"),
+        ("october", "oct"), ("november", "nov"), ("december", "dec"),
+    ], start=1)
+    for name in names
+}
+ORDINALS = {"first": 1, "second": 2, "third": 3, "fourth": 4, "1st": 1, "2nd": 2, "3rd": 3, "4th": 4}
+
+# "September 30, 2023", "Sept. 30 2023"
+DATE_PATTERN = re.compile(r"\b(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?\s+(\d{1,2}),?\s+(\d{4})\b",
+                          re.IGNORECASE)
+# "Q3 2023", "Q3 FY2023", "Q3'23", "3Q23"
+QUARTER_PATTERN = re.compile(r"\b(?:Q([1-4])|([1-4])Q)\s*(?:of\s+)?(?:FY\s*|fiscal\s+)?'?(\d{4}|\d{2})\b", re.IGNORECASE)
+# "third quarter of 2023", "second fiscal quarter 2023"
+ORDINAL_QUARTER_PATTERN = re.compile(
+    r"\b(" + "|".join(ORDINALS) + r")\s+(?:fiscal\s+)?quarter\s+(?:of\s+)?(?:fiscal\s+)?(?:year\s+)?(\d{4})\b",
+    re.IGNORECASE,
+)
+# "fiscal 2023", "fiscal year 2023", "FY2023", "FY 23"
+FISCAL_YEAR_PATTERN = re.compile(r"\b(?:fiscal\s+(?:year\s+)?|FY\s*'?)(\d{4}|\d{2})\b", re.IGNORECASE)
+
+FORM_PATTERNS = [
+    ("10-K", re.compile(r"\b10-?K\b|\bannual report\b", re.IGNORECASE)),
+    ("10-Q", re.compile(r"\b10-?Q\b|\bquarterly report\b", re.IGNORECASE)),
+]
+
+# Legal suffixes dropped from company names to match them in questions ("Tesla, Inc." -> "tesla")
+COMPANY_SUFFIX_PATTERN = re.compile(
+    r"[,.]?\s+(?:inc|incorporated|corp|corporation|co|company|ltd|limited|plc|holdings|group|n\.v|s\.a|ag|llc)\.?$",
+    re.IGNORECASE,
+)
+
+
+def _year(text):
+    year = int(text)
+    return year + 2000 if year < 100 else year
+
+
+def company_alias(company):
+    """
+    @brief Name a question is expected to use for a company ("Tesla, Inc." -> "tesla").
+    """
+    alias = company.strip()
+    while True:
+        shorter = COMPANY_SUFFIX_PATTERN.sub("", alias)
+        if shorter == alias:
+            return alias.lower()
+        alias = shorter
+
+
+# -------------------------------------------------------------------------
+# Question Parsing
+# -------------------------------------------------------------------------
+
+def mentioned_periods(question):
+    """
+    @brief Extracts the reporting periods a question refers to.
+
+    @details Quarters are calendar quarters of the period end date; a fiscal year is
+             the year of the period end date.
+
+    @param question: The user's question.
+    @return: Tuple[Set[str], Set[Tuple[int, int]], Set[int]] - Period end dates
+             ("YYYY-MM-DD"), (year, quarter) pairs and fiscal years.
+    """
+    dates = {
+        f"{int(year):04d}-{MONTHS[month.lower()]:02d}-{int(day):02d}"
+        for month, day, year in DATE_PATTERN.findall(question)
+    }
+    quarters = {(_year(year), int(q or q_first)) for q, q_first, year in QUARTER_PATTERN.findall(question)}
+    quarters |= {(int(year), ORDINALS[ordinal.lower()]) for ordinal, year in ORDINAL_QUARTER_PATTERN.findall(question)}
+    years = {_year(year) for year in FISCAL_YEAR_PATTERN.findall(question)}
+    return dates, quarters, years
+
+
+def mentioned_form(question):
+    """
+    @return: str or None - "10-K" or "10-Q" if the question names a form type.
+    """
+    for form, pattern in FORM_PATTERNS:
+        if pattern.search(question):
+            return form
+    return None
+
+
+# -------------------------------------------------------------------------
+# Filing Catalog
+# -------------------------------------------------------------------------
+
+class FilingCatalog:
+    """
+    @brief The filings of the corpus, and the subset of them a question is about.
+
+    @details A question restricted to some filings is only searched in their chunks
+             (a Chroma `where` filter and per-filing partitions of the in-process
+             indexes), so its cost follows the size of those filings rather than of the
+             corpus. Constraints are applied in turn (company or ticker, form type,
+             period); one that matches no filing is ignored rather than returning nothing.
+    """
+
+    def __init__(self, filings):
+        """
+        @param filings: Iterable of Filing.
+        """
+        self.filings = {filing.source: filing for filing in filings}
+        self.aliases = {}  # Lower-cased company name -> tickers
+        for filing in self.filings.values():
+            if filing.company:
+                self.aliases.setdefault(company_alias(filing.company), set()).add(filing.ticker)
+
+    def __len__(self):
+        return len(self.filings)
+
+    @classmethod
+    def from_metadatas(cls, metadatas):
+        """
+        @brief Builds the catalog from the chunk metadata of the vector store.
+        """
+        filings = {}
+        for metadata in metadatas:
+            source = metadata.get("source")
+            if source and source not in filings:
+                filings[source] = Filing(source, metadata.get("ticker", ""), metadata.get("form", ""),
+                                         metadata.get("period", ""), metadata.get("company", ""))
+        return cls(sorted(filings.values(), key=lambda f: (f.ticker, f.period, f.form, f.source)))
+
+    @staticmethod
+    def label(filing):
+        """
+        @return: str - Name of a filing in the UI (e.g., "TSLA 10-Q 2023-09-30").
+        """
+        return " ".join(part for part in (filing.ticker, filing.form, filing.period) if part) or filing.source
+
+    def select(self, question, choice=FILING_AUTO):
+        """
+        @brief Returns the filings a question is searched in.
+
+        @param question: The user's question.
+        @param choice: Selector value: FILING_AUTO (detect from the question), FILING_ALL
+                       or the source of a filing.
+        @return: List[str] or None - Sources of the selected filings, None for all of them.
+        """
+        if choice in self.filings:
+            return [choice]
+        if choice == FILING_ALL or len(self.filings) < 2:
+            return None
+        candidates = list(self.filings.values())
+        for constraint in (self._by_company, self._by_form, self._by_period):
+            narrowed = constraint(question, candidates)
+            if narrowed:
+                candidates = narrowed
+        if len(candidates) == len(self.filings):
+            return None
+        return [filing.source for filing in candidates]
+
+    def _by_company(self, question, candidates):
+        # Tickers must be written in capitals ("ON", "IT" and "A" are also words)
+        tickers = {word for word in re.findall(r"\b[A-Z][A-Z.]{0,5}\b", question)}
+        lowered = question.lower()
+        for alias, alias_tickers in self.aliases.items():
+            if re.search(r"\b" + re.escape(alias) + r"\b", lowered):
+                tickers |= alias_tickers
+        return [filing for filing in candidates if filing.ticker in tickers]
+
+    @staticmethod
+    def _by_form(question, candidates):
+        form = mentioned_form(question)
+        return [filing for filing in candidates if form and filing.form.startswith(form)]
+
+    @staticmethod
+    def _by_period(question, candidates):
+        dates, quarters, years = mentioned_periods(question)
+        selected = []
+        for filing in candidates:
+            if not filing.period:
+                continue
+            year, month = int(filing.period[:4]), int(filing.period[5:7])
+            if filing.period in dates or (year, (month - 1) // 3 + 1) in quarters or year in years:
+                selected.append(filing)
+        return selected
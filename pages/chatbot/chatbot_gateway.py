@@ -0,0 +1,613 @@
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from pages.chatbot.chatbot_config import (
+    OPENAI_MODEL, OPENAI_BASE_URL, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES,
+    LLM_BACKOFF_BASE, LLM_BACKOFF_MAX, LLM_TIMEOUT, LLM_MAX_CONNECTIONS, LLM_COALESCE, ANSWER_MAX_TOKENS
+)
+from pages.chatbot.chatbot_context import gpt_token_counter
+from pages.chatbot.chatbot_metrics import Counter, Histogram
+
+# Status codes worth retrying: request timeout, conflict, rate limit and server errors
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+# Seconds of the configured rate a bucket accumulates while idle (burst size)
+BURST_SECONDS = 10
+
+# Share of the configured rate restored by each successful request (additive
+# increase), and the lowest share 429 responses halve it down to
+RATE_RECOVERY = 0.05
+MIN_RATE_SHARE = 0.05
+
+# Roles of LangChain message types in the OpenAI chat format
+OPENAI_ROLES = {"human": "user", "ai": "assistant", "system": "system"}
+
+LLM_REQUESTS = Counter("rag_llm_requests_total", "Requests sent to the hosted LLM API, by outcome (ok, retried, failed).",
+                       ["result"])
+LLM_RATE_LIMITED = Counter("rag_llm_rate_limited_total", "429 responses of the hosted LLM API.")
+LLM_COALESCED = Counter("rag_llm_coalesced_total", "Prompts answered by an identical request already in flight.")
+LLM_THROTTLE_SECONDS = Histogram("rag_llm_throttle_seconds", "Time requests waited for the client-side rate limiter.")
+
+
+def retry_after_seconds(headers):
+    """
+    @brief Reads the delay a server asks for before the next request.
+
+    @param headers: Response headers.
+    @return: float or None - From "retry-after-ms", or "retry-after" (seconds or HTTP date).
+    """
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    @brief Token-bucket rate limiter shared by threads and event loops.
+
+    @details Callers reserve tokens: the bucket may go negative, and the reservation
+             returns how long the caller must wait for the tokens it took, so callers
+             are served in arrival order without polling. The rate adapts while in
+             use: `slow_down` halves it, `speed_up` restores part of it, and `pause`
+             makes every new reservation wait (a server's Retry-After).
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        @param rate: Tokens added per second (0: unlimited).
+        @param capacity: Maximum tokens accumulated while idle.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount=1):
+        """
+        @brief Takes `amount` tokens (at most the capacity).
+
+        @return: float - Seconds to wait before using them.
+        """
+        if not self.max_rate:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+    def pause(self, seconds):
+        """
+        @brief Makes every new reservation wait at least `seconds`.
+        """
+        if not self.max_rate:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def slow_down(self):
+        if self.max_rate:
+            with self._lock:
+                self._refill()
+                self.rate = max(self.max_rate * MIN_RATE_SHARE, self.rate / 2)
+
+    def speed_up(self):
+        if self.max_rate and self.rate < self.max_rate:
+            with self._lock:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+
+# -------------------------------------------------------------------------
+# Request Coalescing
+# -------------------------------------------------------------------------
+
+class _Flight:
+    """
+    @brief One API request whose streamed pieces are replayed to every caller asking
+           the same prompt while it runs.
+
+    @details The request is driven by a producer (a thread, or a task of the event
+             loop), independently of its callers: one caller stopping early does not
+             cut the answer of the others. The producer stops once every caller left.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.producer = None  # Task of an asynchronous flight (kept referenced while running)
+        self._changed = threading.Condition()
+
+    @property
+    def abandoned(self):
+        return self.readers == 0
+
+    def attach(self):
+        with self._changed:
+            self.readers += 1
+
+    def publish(self, piece):
+        with self._changed:
+            self.pieces.append(piece)
+            self._changed.notify_all()
+
+    def finish(self, error=None):
+        with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    def replay(self):
+        """
+        @brief Yields every piece of the answer, waiting for those not received yet.
+
+        @return: Iterator[str]
+        """
+        position = 0
+        try:
+            while True:
+                with self._changed:
+                    while position == len(self.pieces) and not self.done:
+                        self._changed.wait()
+                    pieces, done = self.pieces[position:], self.done
+                position += len(pieces)
+                yield from pieces
+                if done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            with self._changed:
+                self.readers -= 1
+
+
+class _AsyncFlight(_Flight):
+    """
+    @brief A flight of an event loop: its producer and callers all run on the loop.
+    """
+
+    def __init__(self, key):
+        super().__init__(key)
+        self._event = asyncio.Event()
+
+    def publish(self, piece):
+        self.pieces.append(piece)
+        self._wake()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def areplay(self):
+        """
+        @brief Yields every piece of the answer, waiting for those not received yet.
+
+        @return: AsyncIterator[str]
+        """
+        position = 0
+        try:
+            while True:
+                if position == len(self.pieces) and not self.done:
+                    await self._event.wait()
+                    continue
+                pieces, done = self.pieces[position:], self.done
+                position += len(pieces)
+                for piece in pieces:
+                    yield piece
+                if done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.readers -= 1
+
+
+def _content(chunk):
+    """
+    @return: str - Text of a streamed completion chunk ("" for role and usage chunks).
+    """
+    return (chunk.choices[0].delta.content or "") if chunk.choices else ""
+
+
+# -------------------------------------------------------------------------
+# Gateway
+# -------------------------------------------------------------------------
+
+class LLMGateway:
+    """
+    @brief Client of the hosted chat model, shared by every request of the process.
+
+    @details - Requests wait for two token buckets, requests and tokens per minute
+               (prompt plus expected completion). A 429 halves their rate and pauses
+               them for the server's Retry-After; each success restores part of it.
+             - Requests failing with 429, 5xx or a connection error before their first
+               token are retried with exponential backoff and full jitter. A failure
+               while streaming is not retried: the answer is already partly shown.
+             - Identical prompts in flight at the same time share one request, whose
+               streamed pieces are replayed to every caller.
+             - Synchronous calls (Dash callback threads) share one HTTP connection pool;
+               asynchronous calls share one per event loop, where many requests run
+               concurrently (`astream`, `acomplete`).
+    """
+
+    def __init__(self, model=OPENAI_MODEL, base_url=OPENAI_BASE_URL, api_key=None,
+                 requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX,
+                 timeout=LLM_TIMEOUT, max_connections=LLM_MAX_CONNECTIONS, coalesce=LLM_COALESCE):
+        """
+        @param model: Chat model name.
+        @param base_url: OpenAI-compatible API URL ("" for OpenAI's).
+        @param api_key: API key (default: OPENAI_API_KEY).
+        @param requests_per_minute: Request rate limit (0: unlimited).
+        @param tokens_per_minute: Token rate limit (0: unlimited).
+        @param max_retries: Retries of a request failing before its first token.
+        @param backoff_base: Seconds of the first retry's maximum backoff, doubled on each retry.
+        @param backoff_max: Maximum backoff; a longer Retry-After fails the request.
+        @param timeout: Seconds before a connection, or a silent stream, times out.
+        @param max_connections: Connections of each HTTP pool.
+        @param coalesce: Share one request between identical prompts in flight.
+        """
+        self.model = model
+        self.base_url = base_url or None
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.coalesce = coalesce
+        self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60 * BURST_SECONDS))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60 * BURST_SECONDS)
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._flights = {}  # Prompt key -> _Flight of the synchronous calls
+        self._loops = weakref.WeakKeyDictionary()  # Event loop -> (AsyncOpenAI, {prompt key -> _AsyncFlight})
+        self._count_tokens = gpt_token_counter(model)
+
+        # Metrics
+        self.sent = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    # ---------------------------------------------------------------------
+    # Synchronous API
+    # ---------------------------------------------------------------------
+
+    def stream(self, messages, **params):
+        """
+        @brief Streams the answer to a chat prompt.
+
+        @param messages: OpenAI chat messages ({"role", "content"}).
+        @param params: Completion parameters (temperature, max_tokens, stop...).
+        @return: Iterator[str] - Pieces of the answer.
+        """
+        key = self._key(messages, params)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._joined(flight)
+                return flight.replay()
+            flight = _Flight(key)
+            flight.attach()
+            if self.coalesce:
+                self._flights[key] = flight
+        threading.Thread(target=self._produce, args=(flight, messages, params), name="llm-request", daemon=True).start()
+        return flight.replay()
+
+    def complete(self, messages, **params):
+        """
+        @return: str - The answer to a chat prompt (see `stream`).
+        """
+        return "".join(self.stream(messages, **params))
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            import openai
+
+            with self._lock:
+                if self._client is None:
+                    self._client = openai.OpenAI(
+                        api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                        http_client=httpx.Client(**self._http_options()),
+                    )
+        return self._client
+
+    def _produce(self, flight, messages, params):
+        error = None
+        try:
+            attempt = 0
+            while True:
+                time.sleep(self._reserve(messages, params))
+                try:
+                    stream = self.client.chat.completions.create(
+                        model=self.model, messages=messages, stream=True, **params
+                    )
+                    with stream:
+                        for chunk in stream:
+                            piece = _content(chunk)
+                            if piece:
+                                flight.publish(piece)
+                            if flight.abandoned:
+                                break
+                    self._succeeded()
+                    return
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, started=bool(flight.pieces))
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+            self._failed(e)
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+            flight.finish(error)
+
+    # ---------------------------------------------------------------------
+    # Asynchronous API
+    # ---------------------------------------------------------------------
+
+    async def astream(self, messages, **params):
+        """
+        @brief Streams the answer to a chat prompt on the running event loop.
+
+        @param messages: OpenAI chat messages ({"role", "content"}).
+        @param params: Completion parameters (temperature, max_tokens, stop...).
+        @return: AsyncIterator[str] - Pieces of the answer.
+        """
+        client, flights = self._loop_state()
+        key = self._key(messages, params)
+        flight = flights.get(key)
+        if flight is not None:
+            with self._lock:
+                self._joined(flight)
+        else:
+            flight = _AsyncFlight(key)
+            flight.attach()
+            if self.coalesce:
+                flights[key] = flight
+            flight.producer = asyncio.get_running_loop().create_task(
+                self._aproduce(client, flights, flight, messages, params)
+            )
+        async for piece in flight.areplay():
+            yield piece
+
+    async def acomplete(self, messages, **params):
+        """
+        @return: str - The answer to a chat prompt (see `astream`).
+        """
+        return "".join([piece async for piece in self.astream(messages, **params)])
+
+    def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            import httpx
+            import openai
+
+            client = openai.AsyncOpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                http_client=httpx.AsyncClient(**self._http_options()),
+            )
+            state = self._loops[loop] = (client, {})
+        return state
+
+    async def _aproduce(self, client, flights, flight, messages, params):
+        error = None
+        try:
+            attempt = 0
+            while True:
+                await asyncio.sleep(self._reserve(messages, params))
+                try:
+                    stream = await client.chat.completions.create(
+                        model=self.model, messages=messages, stream=True, **params
+                    )
+                    async with stream:
+                        async for chunk in stream:
+                            piece = _content(chunk)
+                            if piece:
+                                flight.publish(piece)
+                            if flight.abandoned:
+                                break
+                    self._succeeded()
+                    return
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, started=bool(flight.pieces))
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        except Exception as e:
+            error = e
+            self._failed(e)
+        finally:
+            if flights.get(flight.key) is flight:
+                del flights[flight.key]
+            flight.finish(error)
+
+    # ---------------------------------------------------------------------
+    # Rate Limiting and Retries
+    # ---------------------------------------------------------------------
+
+    def _http_options(self):
+        import httpx
+
+        # Requests beyond the pool's connections wait for one, up to the timeout
+        return {
+            "limits": httpx.Limits(max_connections=self.max_connections,
+                                   max_keepalive_connections=self.max_connections),
+            "timeout": httpx.Timeout(self.timeout),
+        }
+
+    def _key(self, messages, params):
+        payload = json.dumps([self.model, messages, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _joined(self, flight):
+        flight.attach()
+        self.coalesced += 1
+        LLM_COALESCED.inc()
+
+    def _reserve(self, messages, params):
+        """
+        @return: float - Seconds to wait for both rate limits before sending the request.
+        """
+        tokens = sum(self._count_tokens(message["content"]) for message in messages)
+        tokens += params.get("max_tokens") or ANSWER_MAX_TOKENS  # Expected completion
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        LLM_THROTTLE_SECONDS.observe(wait)
+        self.sent += 1
+        return wait
+
+    def _retry_delay(self, error, attempt, started):
+        """
+        @brief Adapts the rate limits to a failed request and decides whether to retry it.
+
+        @param error: Exception raised by the request.
+        @param attempt: Retries already made.
+        @param started: Whether pieces of the answer were already streamed.
+        @return: float - Seconds to wait before retrying, or None to fail the request.
+        """
+        import openai
+
+        status = getattr(error, "status_code", None)
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            retry_after = retry_after_seconds(error.response.headers)
+        if status == 429:
+            self.rate_limited += 1
+            LLM_RATE_LIMITED.inc()
+            self.requests.slow_down()
+            self.tokens.slow_down()
+            if retry_after is not None:
+                self.requests.pause(retry_after)  # Every request waits, not only this one
+
+        retryable = isinstance(error, openai.APIConnectionError) or status in RETRY_STATUSES
+        if started or not retryable or attempt >= self.max_retries:
+            return None
+        if retry_after is not None and retry_after > self.backoff_max:
+            return None
+        self.retries += 1
+        LLM_REQUESTS.inc(result="retried")
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(backoff, retry_after or 0.0)
+
+    def _succeeded(self):
+        LLM_REQUESTS.inc(result="ok")
+        self.requests.speed_up()
+        self.tokens.speed_up()
+
+    def _failed(self, error):
+        print(f"LLM request failed: {error}")
+        self.failed += 1
+        LLM_REQUESTS.inc(result="failed")
+
+    def stats(self):
+        """
+        @return: dict - Requests sent, retried, rate limited, coalesced and failed, and
+                 the current rate limits (per minute).
+        """
+        return {
+            "sent": self.sent,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "in_flight": len(self._flights) + sum(len(flights) for _, flights in list(self._loops.values())),
+            "requests_per_minute": round(self.requests.rate * 60, 1),
+            "tokens_per_minute": round(self.tokens.rate * 60, 1),
+        }
+
+
+# -------------------------------------------------------------------------
+# LangChain Chat Model
+# -------------------------------------------------------------------------
+
+def _openai_messages(messages):
+    return [{"role": OPENAI_ROLES.get(message.type, "user"), "content": message.content} for message in messages]
+
+
+class GatewayChatModel(BaseChatModel):
+    """
+    @brief LangChain chat model answering through an LLMGateway: the `llm` of the GPT
+           chain, used like ChatOpenAI (`invoke`, `stream`, `ainvoke`, `astream`).
+    """
+
+    gateway: Any
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "llm-gateway"
+
+    def _params(self, stop):
+        params = {"temperature": self.temperature}
+        if stop:
+            params["stop"] = stop
+        return params
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.gateway.complete(_openai_messages(messages), **self._params(stop))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for piece in self.gateway.stream(_openai_messages(messages), **self._params(stop)):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = await self.gateway.acomplete(_openai_messages(messages), **self._params(stop))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for piece in self.gateway.astream(_openai_messages(messages), **self._params(stop)):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
@@ -0,0 +1,310 @@
+import hashlib
+import json
+import os
+
+# Name of the manifest file stored next to the persisted Chroma collection
+MANIFEST_FILENAME = "ingest_manifest.json"
+MANIFEST_VERSION = 5  # Bumped whenever the stored chunk metadata or ids change
+
+# Read files in 1 MiB blocks when hashing
+HASH_BLOCK_SIZE = 1 << 20
+
+# Maximum number of ids sent to Chroma in a single write (upsert, update, delete) call
+WRITE_BATCH_SIZE = 1000
+
+# HNSW parameters of collections created without `hnsw:*` metadata (Chroma's defaults)
+CHROMA_HNSW_DEFAULTS = {"hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+
+
+# -------------------------------------------------------------------------
+# Hashing
+# -------------------------------------------------------------------------
+
+def file_sha256(path):
+    """
+    @brief Computes the SHA-256 digest of a file's content.
+
+    @param path: Path of the file to hash.
+    @return: str - Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingest_key(file_hash, settings):
+    """
+    @brief Derives the content address of an ingested file.
+
+    @details The key changes whenever the file content, the splitter parameters
+             or the embedding model change, i.e. whenever its vectors would differ.
+
+    @param file_hash: SHA-256 digest of the file content.
+    @param settings: Index settings (see `chatbot_config.index_settings`).
+    @return: str - Hex digest identifying the file's chunks and vectors.
+    """
+    payload = json.dumps({"file": file_hash, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# -------------------------------------------------------------------------
+# Ingestion Manifest
+# -------------------------------------------------------------------------
+
+class IngestManifest:
+    """
+    @brief Records which source files are already embedded in the persisted vector store.
+
+    @details The manifest maps every source path to its ingestion key, its filing
+             identity and the ids of the chunks stored for it. Filings replaced by an
+             amendment are kept aside as superseded. It is saved as JSON inside the
+             persist directory, so it lives and dies together with the Chroma collection.
+    """
+
+    def __init__(self, persist_directory, settings):
+        """
+        @param persist_directory: Directory of the persisted Chroma collection.
+        @param settings: Index settings the current process ingests with.
+        """
+        self.path = os.path.join(persist_directory, MANIFEST_FILENAME)
+        self.settings = settings
+        self.documents = {}
+        self.superseded = {}  # source -> key and source of the amendment replacing it
+        self.exists = False  # Whether a manifest was found on disk
+        self.compatible = True  # Whether the stored vectors match `settings`
+        self.load()
+
+    def load(self):
+        """
+        @brief Loads the manifest from disk, if present.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.exists = True
+        if data.get("version") != MANIFEST_VERSION or data.get("settings") != self.settings:
+            # Stored vectors were produced with other parameters: none of them can be reused
+            self.compatible = False
+            return
+        self.documents = data.get("documents", {})
+        self.superseded = data.get("superseded", {})
+
+    def save(self):
+        """
+        @brief Writes the manifest atomically (write to a temporary file, then rename).
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": MANIFEST_VERSION, "settings": self.settings, "documents": self.documents,
+                 "superseded": self.superseded},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
+        self.exists = True
+        self.compatible = True
+
+    def clear(self):
+        """
+        @brief Forgets every recorded document.
+        """
+        self.documents = {}
+        self.superseded = {}
+
+    def key_for(self, path):
+        """
+        @param path: Path of a source file.
+        @return: str - The ingestion key of the file under the current settings.
+        """
+        return ingest_key(file_sha256(path), self.settings)
+
+    def is_current(self, source, key):
+        """
+        @return: bool - True if `source` was ingested with exactly this key.
+        """
+        entry = self.documents.get(source)
+        return entry is not None and entry["key"] == key
+
+    def is_superseded(self, source, key, present):
+        """
+        @return: bool - True if this version of `source` was replaced by an amendment
+                 that is still in the corpus (`present` holds the corpus sources).
+        """
+        entry = self.superseded.get(source)
+        return entry is not None and entry["key"] == key and entry["by"] in present
+
+    def record(self, source, key, ids, identity="", form=""):
+        """
+        @brief Marks `source` as ingested under `key` with the given chunk ids.
+
+        @param identity: Filing identity (see `filing_identity`).
+        @param form: Form type, which tells amendments ("10-Q/A") from original filings.
+        """
+        self.superseded.pop(source, None)
+        self.documents[source] = {"key": key, "ids": list(ids), "identity": identity, "form": form}
+
+    def supersede(self, source, key, by):
+        """
+        @brief Marks this version of `source` as replaced by the amendment `by`.
+        """
+        self.documents.pop(source, None)
+        self.superseded[source] = {"key": key, "by": by}
+
+    def forget(self, source):
+        """
+        @brief Removes `source` from the manifest.
+
+        @return: List[str] - Chunk ids previously stored for `source`.
+        """
+        self.superseded.pop(source, None)
+        entry = self.documents.pop(source, None)
+        return entry["ids"] if entry else []
+
+    def versions(self, source, identity):
+        """
+        @return: List[str] - Recorded sources holding a version of the same filing:
+                 `source` itself and the sources with the same filing identity.
+        """
+        return [s for s, entry in self.documents.items()
+                if s == source or (identity and entry.get("identity") == identity)]
+
+    def fingerprint(self):
+        """
+        @return: str - Digest of the whole indexed corpus; changes whenever any document does.
+        """
+        payload = json.dumps({s: e["key"] for s, e in self.documents.items()}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# -------------------------------------------------------------------------
+# Vector Store Synchronisation
+# -------------------------------------------------------------------------
+
+def filing_identity(source, metadata):
+    """
+    @brief Names the filing a document is a version of: its ticker, period and form
+           type without the amendment suffix ("TSLA|2023-09-30|10-Q" for a 10-Q/A too).
+
+    @param source: Path of the filing, used when its metadata is incomplete.
+    @param metadata: Filing metadata (see `chatbot_ingest.filing_metadata`).
+    @return: str
+    """
+    ticker, period, form = metadata.get("ticker"), metadata.get("period"), metadata.get("form")
+    if ticker and period and form:
+        return f"{ticker}|{period}|{form.split('/')[0]}"
+    return source
+
+
+def chunk_ids(identity, texts):
+    """
+    @brief Builds stable ids for the chunks of a filing.
+
+    @details An id is the filing identity followed by a digest of the chunk text, and
+             the occurrence number among identical chunks. A chunk keeps its id in every
+             version of the filing (amendments included) as long as its text is
+             unchanged, so a new version only needs its changed chunks embedded.
+
+    @param identity: Filing identity (see `filing_identity`).
+    @param texts: Chunk texts, in order.
+    @return: List[str] - One id per chunk.
+    """
+    prefix = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:12]
+    seen, ids = {}, []
+    for text in texts:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        seen[digest] = seen.get(digest, -1) + 1
+        ids.append(f"{prefix}-{digest}-{seen[digest]}")
+    return ids
+
+
+def delete_ids(vectordb, ids):
+    """
+    @brief Deletes vectors from the store in batches.
+
+    @param vectordb: LangChain Chroma vector store.
+    @param ids: Ids of the vectors to delete.
+    """
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        vectordb.delete(ids=ids[start:start + WRITE_BATCH_SIZE])
+
+
+def upsert_chunks(vectordb, ids, vectors, metadatas, texts):
+    """
+    @brief Inserts (or replaces) chunks with precomputed vectors, in batches.
+    """
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        end = start + WRITE_BATCH_SIZE
+        vectordb._collection.upsert(ids=ids[start:end], embeddings=vectors[start:end],
+                                    metadatas=metadatas[start:end], documents=texts[start:end])
+
+
+def update_metadatas(vectordb, ids, metadatas):
+    """
+    @brief Replaces the metadata of stored chunks, keeping their vectors.
+    """
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        vectordb._collection.update(ids=ids[start:start + WRITE_BATCH_SIZE],
+                                    metadatas=metadatas[start:start + WRITE_BATCH_SIZE])
+
+
+def clear_vectordb(vectordb):
+    """
+    @brief Removes every vector from the store (legacy or incompatible collections).
+    """
+    delete_ids(vectordb, vectordb.get(include=[])["ids"])
+
+
+def open_vectordb(embeddings, persist_directory, settings, hnsw):
+    """
+    @brief Opens the persisted Chroma collection with the configured HNSW parameters.
+
+    @details Chroma fixes the HNSW parameters of a collection when it is created. A
+             collection built with other parameters is therefore dropped and created
+             again, and the manifest emptied so every filing is ingested anew (the
+             embedding cache spares re-embedding them).
+
+    @param embeddings: Embedding model used for queries and new chunks.
+    @param persist_directory: Directory of the persisted collection.
+    @param settings: Index settings (see `chatbot_config.index_settings`).
+    @param hnsw: `hnsw:*` collection metadata (see `chatbot_config.hnsw_metadata`).
+    @return: Chroma - The vector store.
+    """
+    from langchain_community.vectorstores import Chroma
+
+    vectordb = Chroma(persist_directory=persist_directory, embedding_function=embeddings,
+                      collection_metadata=hnsw)
+    current = {**CHROMA_HNSW_DEFAULTS, **(vectordb._collection.metadata or {})}
+    if all(current[key] == value for key, value in hnsw.items()):
+        return vectordb
+
+    print('Vector store was built with other HNSW parameters, rebuilding it...')
+    vectordb.delete_collection()
+    manifest = IngestManifest(persist_directory, settings)
+    manifest.clear()
+    manifest.save()
+    return Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_metadata=hnsw)
+
+
+def reset_if_stale(vectordb, manifest):
+    """
+    @brief Wipes the collection if its vectors cannot be trusted.
+
+    @details The collection is cleared when it was built with other index settings,
+             or when it predates the manifest (it may then contain duplicated vectors).
+
+    @param vectordb: LangChain Chroma vector store opened on the persist directory.
+    @param manifest: IngestManifest of the persist directory.
+    @return: bool - True if the collection was wiped.
+    """
+    if manifest.compatible and (manifest.exists or not vectordb.get(include=[])["ids"]):
+        return False
+    print('Vector store does not match the manifest, rebuilding it...')
+    clear_vectordb(vectordb)
+    manifest.clear()
+    return True
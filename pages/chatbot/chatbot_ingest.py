@@ -0,0 +1,479 @@
+import argparse
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_community.document_loaders import PyPDFLoader
+
+from pages.chatbot.chatbot_config import (
+    DATA_DIR, SPLITTER, CHUNK_SIZE, CHUNK_OVERLAP, INGEST_WORKERS, EMBEDDING_BATCH_SIZE, FACTS_DIRECTORY
+)
+from pages.chatbot.chatbot_facts import FactStore, extract_facts, facts_path, remove_facts
+from pages.chatbot.chatbot_index import (
+    WRITE_BATCH_SIZE, chunk_ids, delete_ids, filing_identity, reset_if_stale, update_metadatas, upsert_chunks
+)
+from pages.chatbot.chatbot_splitter import split_filing
+
+try:
+    import resource  # Unix only, used for the peak memory figure of the report
+except ImportError:
+    resource = None
+
+# Filing file names look like "tsla-20230930.pdf" (ticker, period end date)
+FILENAME_PATTERN = re.compile(r"(?P<ticker>[A-Za-z.]{1,6})-(?P<date>\d{8})")
+
+# Form type as printed on the cover page ("FORM 10-Q", "FORM 10-K/A", ...)
+FORM_PATTERN = re.compile(r"FORM\s+(10-[QK](?:/A)?)", re.IGNORECASE)
+
+# Company name, printed on the cover page above "(Exact name of registrant ...)"
+COMPANY_PATTERN = re.compile(r"([^\n]+?)\s*\n\s*\(Exact name of registrant", re.IGNORECASE)
+
+
+# -------------------------------------------------------------------------
+# Discovery and Parsing
+# -------------------------------------------------------------------------
+
+def discover_filings(data_dir=DATA_DIR):
+    """
+    @brief Walks a directory for PDF filings.
+
+    @param data_dir: Root directory of the corpus.
+    @return: List[str] - Normalised paths of every PDF below `data_dir`, sorted.
+    """
+    paths = []
+    for root, _, files in os.walk(data_dir):
+        paths.extend(os.path.normpath(os.path.join(root, f)) for f in files if f.lower().endswith(".pdf"))
+    return sorted(paths)
+
+
+def filing_metadata(path, cover_text):
+    """
+    @brief Derives the filing metadata attached to every chunk of a document.
+
+    @param path: Path of the filing, whose name carries the ticker and period end date.
+    @param cover_text: Text of the first page, which carries the form type and company name.
+    @return: dict - ticker, form, period and company ("" when unknown).
+    """
+    match = FILENAME_PATTERN.search(os.path.basename(path))
+    form = FORM_PATTERN.search(cover_text)
+    company = COMPANY_PATTERN.search(cover_text)
+    date = match.group("date") if match else ""
+    return {
+        "ticker": match.group("ticker").upper() if match else "",
+        "form": form.group(1).upper() if form else "",
+        "period": f"{date[:4]}-{date[4:6]}-{date[6:]}" if date else "",
+        "company": company.group(1).strip() if company else "",
+    }
+
+
+def parse_filing(source, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, splitter=SPLITTER):
+    """
+    @brief Loads and splits one filing, and extracts the line items of its statement
+           tables. Runs inside a worker process.
+
+    @details Chunks are returned as plain (text, metadata) tuples, which are cheaper
+             to send back to the parent process than LangChain Documents.
+
+    @param source: Path of the PDF file.
+    @param chunk_size: Splitter chunk size.
+    @param chunk_overlap: Splitter chunk overlap.
+    @param splitter: "filing" or "recursive" (see `chatbot_splitter.split_filing`).
+    @return: Tuple[str, int, List[Tuple[str, dict]], FactStore] - Source, page count,
+             chunks and facts.
+    """
+    pages = PyPDFLoader(source).load()
+    metadata = filing_metadata(source, pages[0].page_content if pages else "")
+    page_texts = [page.page_content for page in pages]
+    chunks = [
+        (text, {"source": source, **chunk_metadata, **metadata})
+        for text, chunk_metadata in split_filing(page_texts, chunk_size, chunk_overlap, splitter)
+    ]
+    facts = FactStore.from_facts(extract_facts(page_texts), {"source": source, **metadata})
+    return source, len(pages), chunks, facts
+
+
+def parse_facts(source):
+    """
+    @brief Extracts the facts of a filing alone (filings embedded before facts were extracted).
+
+    @param source: Path of the PDF file.
+    @return: FactStore
+    """
+    pages = PyPDFLoader(source).load()
+    metadata = filing_metadata(source, pages[0].page_content if pages else "")
+    return FactStore.from_facts(extract_facts([page.page_content for page in pages]), {"source": source, **metadata})
+
+
+def _parsed_filings(sources, workers):
+    """
+    @brief Yields parsed filings, parsing up to `workers` files in parallel.
+
+    @details At most two files per worker are in flight, so the number of parsed
+             but not yet embedded chunks stays bounded however large the corpus is.
+    """
+    if workers <= 0 or len(sources) <= 1:
+        for source in sources:
+            yield parse_filing(source)
+        return
+
+    # Fork keeps workers from re-importing the Dash entry point (spawn would)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        for source in sources:
+            pending.append(pool.submit(parse_filing, source))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# -------------------------------------------------------------------------
+# Throughput Report
+# -------------------------------------------------------------------------
+
+class IngestStats:
+    """
+    @brief Counters and timings of an ingestion run, used to size ingestion workers.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.skipped = 0  # Files unchanged since the last run
+        self.ingested = 0  # New or changed files parsed
+        self.removed = 0  # Files deleted from the corpus
+        self.superseded = 0  # Filings replaced by an amendment
+        self.pages = 0
+        self.chunks = 0
+        self.facts = 0  # Line items extracted from statement tables
+        self.embedded = 0
+        self.reused = 0  # Chunks kept from the stored version of a filing
+        self.relabelled = 0  # Kept chunks whose metadata was updated
+        self.deleted = 0  # Chunks of stored versions no longer present
+        self.embed_seconds = 0.0
+        self.insert_seconds = 0.0
+
+    @property
+    def wall_seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @staticmethod
+    def peak_memory_mb():
+        """
+        @return: float - Peak resident memory of the process in MB (0 if unavailable).
+        """
+        if resource is None:
+            return 0.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def as_dict(self):
+        wall = max(self.wall_seconds, 1e-9)
+        return {
+            "files_skipped": self.skipped,
+            "files_ingested": self.ingested,
+            "files_removed": self.removed,
+            "files_superseded": self.superseded,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "chunks_embedded": self.embedded,
+            "chunks_reused": self.reused,
+            "chunks_relabelled": self.relabelled,
+            "chunks_deleted": self.deleted,
+            "facts": self.facts,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "embed_seconds": round(self.embed_seconds, 3),
+            "insert_seconds": round(self.insert_seconds, 3),
+            "pages_per_second": round(self.pages / wall, 2),
+            "chunks_per_second": round(self.chunks / wall, 2),
+            "embeddings_per_second": round(self.embedded / max(self.embed_seconds, 1e-9), 2),
+            "peak_memory_mb": round(self.peak_memory_mb(), 1),
+        }
+
+    def report(self):
+        """
+        @return: str - Human readable throughput report.
+        """
+        s = self.as_dict()
+        return (
+            f"Ingestion: {s['files_ingested']} updated, {s['files_skipped']} unchanged, "
+            f"{s['files_removed']} removed, {s['files_superseded']} superseded | "
+            f"chunks: {s['chunks_embedded']} embedded, {s['chunks_reused']} reused, "
+            f"{s['chunks_deleted']} deleted | {s['facts']} facts extracted in {s['wall_seconds']}s | "
+            f"{s['pages_per_second']} pages/s, {s['chunks_per_second']} chunks/s, "
+            f"{s['embeddings_per_second']} embeddings/s | peak memory {s['peak_memory_mb']} MB"
+        )
+
+
+# -------------------------------------------------------------------------
+# Filing Updates
+# -------------------------------------------------------------------------
+
+def _is_amendment(form):
+    return form.endswith("/A")
+
+
+def _stored_ids(manifest, versions):
+    ids = set()
+    for source in versions:
+        ids.update(manifest.documents[source]["ids"])
+    return ids
+
+
+def _replacing_amendment(manifest, source, form, versions):
+    """
+    @return: str - Source of a recorded amendment that an original filing `source`
+             must not replace, or None.
+    """
+    if _is_amendment(form):
+        return None
+    return next((s for s in versions if s != source and _is_amendment(manifest.documents[s].get("form", ""))), None)
+
+
+class FilingUpdate:
+    """
+    @brief The changes bringing the stored chunks and facts of one filing to its current
+           version: a new or changed file, an amendment, or a file removed from the corpus.
+
+    @details Chunk ids are stable across versions of a filing (see
+             `chatbot_index.chunk_ids`), so only the chunks whose id no stored version
+             has are embedded. `apply` then writes the difference: it upserts the new
+             chunks, updates the metadata of the kept ones where it changed (the source
+             and form of an amendment), deletes the chunks no longer present, and
+             records the filing in the manifest. An amendment ("10-Q/A") replaces the
+             stored versions of the same filing, which are recorded as superseded; an
+             original filed after its amendment is superseded straight away.
+    """
+
+    def __init__(self, source, key=None, form="", identity="", ids=(), chunks=(), facts=None, known=()):
+        """
+        @param source: Path of the filing.
+        @param key: Ingestion key of the new version (None: the file left the corpus).
+        @param form: Form type of the new version.
+        @param identity: Filing identity (see `chatbot_index.filing_identity`).
+        @param ids: Chunk ids of the new version.
+        @param chunks: (text, metadata) of each chunk, aligned with `ids`.
+        @param facts: FactStore of the new version.
+        @param known: Ids of the chunks already stored for a version of the filing.
+        """
+        self.source = source
+        self.key = key
+        self.form = form
+        self.identity = identity
+        self.ids = list(ids)
+        self.chunks = dict(zip(self.ids, chunks))
+        self.facts = facts
+        self.missing = [chunk_id for chunk_id in self.ids if chunk_id not in known]  # Chunks to embed
+        self.vectors = {}  # Chunk id -> vector, for the chunks of `missing` embedded so far
+
+    @property
+    def ready(self):
+        return len(self.vectors) == len(self.missing)
+
+    def apply(self, vectordb, embeddings, manifest, facts_directory, stats):
+        """
+        @brief Writes the update to the vector store, the facts directory and the
+               manifest (saving the manifest is left to the caller).
+
+        @param vectordb: LangChain Chroma vector store.
+        @param embeddings: Embeddings for chunks that must be embedded after all (their
+                           stored copy was replaced since the update was prepared).
+        @param manifest: IngestManifest of the persist directory.
+        @param facts_directory: Directory of the per-filing fact files.
+        @param stats: IngestStats updated with the chunks reused, relabelled and deleted.
+        """
+        start = time.perf_counter()
+        versions = manifest.versions(self.source, self.identity)
+        if self.key is not None:
+            amendment = _replacing_amendment(manifest, self.source, self.form, versions)
+            if amendment is not None:
+                manifest.supersede(self.source, self.key, by=amendment)
+                stats.superseded += 1
+                return
+
+        stored = _stored_ids(manifest, versions)
+        late = [chunk_id for chunk_id in self.ids if chunk_id not in stored and chunk_id not in self.vectors]
+        if late:
+            self.vectors.update(zip(late, embeddings.embed_documents([self.chunks[i][0] for i in late])))
+            stats.embedded += len(late)
+
+        added = list(self.vectors)
+        upsert_chunks(vectordb, added, [self.vectors[i] for i in added],
+                      [self.chunks[i][1] for i in added], [self.chunks[i][0] for i in added])
+        kept = [chunk_id for chunk_id in self.ids if chunk_id in stored and chunk_id not in self.vectors]
+        relabelled = self._relabelled(vectordb, kept)
+        update_metadatas(vectordb, relabelled, [self.chunks[i][1] for i in relabelled])
+        stale = sorted(stored.difference(self.ids))
+        delete_ids(vectordb, stale)
+
+        for source in versions:
+            entry = manifest.documents[source]
+            remove_facts(facts_directory, entry["key"])
+            if source != self.source and self.key is not None:
+                manifest.supersede(source, entry["key"], by=self.source)
+                stats.superseded += 1
+            else:
+                manifest.forget(source)
+        if self.key is None:
+            manifest.forget(self.source)  # Also drops a superseded record
+        else:
+            self.facts.save(facts_path(facts_directory, self.key))
+            manifest.record(self.source, self.key, self.ids, self.identity, self.form)
+
+        stats.reused += len(kept)
+        stats.relabelled += len(relabelled)
+        stats.deleted += len(stale)
+        stats.insert_seconds += time.perf_counter() - start
+
+    def _relabelled(self, vectordb, ids):
+        """
+        @return: List[str] - Ids among `ids` whose stored metadata differs from the new version's.
+        """
+        changed = []
+        for start in range(0, len(ids), WRITE_BATCH_SIZE):
+            stored = vectordb._collection.get(ids=ids[start:start + WRITE_BATCH_SIZE], include=["metadatas"])
+            changed.extend(chunk_id for chunk_id, metadata in zip(stored["ids"], stored["metadatas"])
+                           if metadata != self.chunks[chunk_id][1])
+        return changed
+
+
+# -------------------------------------------------------------------------
+# Ingestion Pipeline
+# -------------------------------------------------------------------------
+
+def ingest_corpus(vectordb, embeddings, manifest, data_dir=DATA_DIR, workers=INGEST_WORKERS,
+                  batch_size=EMBEDDING_BATCH_SIZE, facts_directory=FACTS_DIRECTORY, sources=None, deferred=None):
+    """
+    @brief Synchronises the vector store with every filing below `data_dir`.
+
+    @details Executes the following steps:
+             1. Wipes the collection if it does not match the manifest.
+             2. Deletes the vectors of filings removed from the corpus.
+             3. Parses new or changed filings across a process pool, and diffs their
+                chunk ids against the stored versions of the same filing.
+             4. Streams the chunks not stored yet into fixed-size batches and embeds
+                each batch in one call.
+             5. Once all of a filing's new chunks are embedded, applies its
+                FilingUpdate (vectors, metadata, stale chunks, facts) and records it
+                in the manifest.
+
+    @param vectordb: LangChain Chroma vector store opened on the persist directory.
+    @param embeddings: LangChain embeddings used to embed the chunks.
+    @param manifest: IngestManifest of the persist directory.
+    @param data_dir: Root directory of the corpus.
+    @param workers: Number of PDF parsing processes.
+    @param batch_size: Number of chunks per embedding batch.
+    @param facts_directory: Directory of the per-filing fact files.
+    @param sources: Paths of the only files to update (added, changed or deleted),
+                    None to synchronise the whole of `data_dir`.
+    @param deferred: List collecting the FilingUpdates instead of applying them, for
+                     callers that apply them at once (see `chatbot_updates.refresh_corpus`).
+                     The vector store and manifest are then left untouched.
+    @return: IngestStats - Counters and throughput of the run.
+    """
+    stats = IngestStats()
+    if deferred is None:
+        reset_if_stale(vectordb, manifest)
+
+    corpus = discover_filings(data_dir)
+    if sources is None:
+        targets = corpus
+        removed = [s for s in list(manifest.documents) + list(manifest.superseded) if s not in set(corpus)]
+    else:
+        sources = [os.path.normpath(source) for source in sources]
+        targets = [source for source in sources if os.path.exists(source)]
+        removed = [source for source in sources if not os.path.exists(source)]
+    present = set(corpus).union(targets).difference(removed)
+
+    def commit(update):
+        if deferred is not None:
+            deferred.append(update)
+            return
+        update.apply(vectordb, embeddings, manifest, facts_directory, stats)
+        manifest.save()  # Persist progress so an interrupted run resumes where it stopped
+
+    # Drop vectors of filings removed from the corpus
+    for source in removed:
+        commit(FilingUpdate(source))
+        stats.removed += 1
+
+    wanted = {source: manifest.key_for(source) for source in targets}
+    todo = [source for source, key in wanted.items()
+            if not manifest.is_current(source, key) and not manifest.is_superseded(source, key, present)]
+    stats.skipped = len(wanted) - len(todo)
+
+    # Filings embedded before facts were extracted only need their tables parsed
+    for source in wanted:
+        if manifest.is_current(source, wanted[source]) and not os.path.exists(facts_path(facts_directory, wanted[source])):
+            facts = parse_facts(source)
+            facts.save(facts_path(facts_directory, wanted[source]))
+            stats.facts += len(facts)
+
+    buffer = deque()  # (update, chunk id, text) waiting to be embedded
+    pending = deque()  # Updates in parse order, committed once their chunks are embedded
+
+    def flush(size):
+        batch = [buffer.popleft() for _ in range(min(size, len(buffer)))]
+        if batch:
+            updates, ids, texts = zip(*batch)
+            start = time.perf_counter()
+            vectors = embeddings.embed_documents(list(texts))
+            stats.embed_seconds += time.perf_counter() - start
+            stats.embedded += len(vectors)
+            for update, chunk_id, vector in zip(updates, ids, vectors):
+                update.vectors[chunk_id] = vector
+        while pending and pending[0].ready:
+            commit(pending.popleft())
+
+    for source, page_count, chunks, facts in _parsed_filings(todo, workers):
+        metadata = chunks[0][1] if chunks else {}
+        identity = filing_identity(source, metadata)
+        ids = chunk_ids(identity, [text for text, _ in chunks])
+        versions = manifest.versions(source, identity)
+        known = _stored_ids(manifest, versions)
+        if _replacing_amendment(manifest, source, metadata.get("form", ""), versions) is not None:
+            known.update(ids)  # Superseded when applied: nothing to embed
+        update = FilingUpdate(source, wanted[source], metadata.get("form", ""), identity, ids, chunks, facts, known)
+        stats.ingested += 1
+        stats.pages += page_count
+        stats.chunks += len(chunks)
+        stats.facts += len(facts)
+
+        pending.append(update)
+        buffer.extend((update, chunk_id, update.chunks[chunk_id][0]) for chunk_id in update.missing)
+        while len(buffer) >= batch_size:
+            flush(batch_size)
+        flush(0)  # Commits the filings with nothing left to embed
+
+    while buffer:
+        flush(batch_size)
+    flush(0)
+    if deferred is None:
+        manifest.save()
+
+    stats.finished = time.perf_counter()
+    return stats
+
+
+if __name__ == "__main__":
+    from pages.chatbot.chatbot_config import PERSIST_DIRECTORY, index_settings, hnsw_metadata
+    from pages.chatbot.chatbot_index import IngestManifest, open_vectordb
+    from pages.chatbot.chatbot_model import build_embeddings
+
+    parser = argparse.ArgumentParser(description="Ingest 10-Q/10-K filings into the vector store.")
+    parser.add_argument("files", nargs="*", help="Only update these files (added, changed or deleted).")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Directory walked for PDF filings.")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="PDF parsing processes.")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE, help="Chunks per embedding batch.")
+    args = parser.parse_args()
+
+    embeddings = build_embeddings()  # Same backend and embedding cache as the server
+    vectordb = open_vectordb(embeddings, PERSIST_DIRECTORY, index_settings(), hnsw_metadata())
+    manifest = IngestManifest(PERSIST_DIRECTORY, index_settings())
+    stats = ingest_corpus(vectordb, embeddings, manifest, args.data_dir, args.workers, args.batch_size,
+                          sources=args.files or None)
+    print(stats.report())
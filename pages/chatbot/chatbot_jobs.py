@@ -0,0 +1,320 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pages.chatbot.chatbot_config import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_MAX_PER_SESSION
+from pages.chatbot.chatbot_config import JOB_TIMEOUT as JOB_TIMEOUT_SECONDS  # JOB_TIMEOUT is a job state here
+from pages.chatbot.chatbot_metrics import Counter, Gauge, Histogram
+from pages.chatbot.chatbot_sessions import sessions
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_TIMEOUT = "timeout"
+
+# States after which a job's result will never change
+FINAL_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED, JOB_TIMEOUT)
+
+# Seconds a finished job is kept around for polling before being forgotten
+JOB_RETENTION = 300
+
+# Seconds between two publications of a running job's streamed answer to the shared
+# store, and between two checks for a cancellation asked by another process
+JOB_PUBLISH_INTERVAL = 0.25
+
+JOB_SECONDS = Histogram("rag_job_seconds", "Time from submission to the end of a job, by final state.", ["state"])
+JOB_QUEUE_SECONDS = Histogram("rag_job_queue_seconds", "Time jobs waited for a worker.")
+JOBS_REJECTED = Counter("rag_jobs_rejected_total", "Questions refused because the server or session was at capacity.")
+
+
+class JobRejected(Exception):
+    """
+    @brief Raised when a job cannot be accepted (server or session at capacity).
+    """
+
+
+class Job:
+    """
+    @brief A question being answered off the Dash callback thread.
+
+    @details The function running the job receives the Job itself and should check
+             `cancelled` between expensive steps: cancellation is cooperative, a job
+             that is already inside an LLM call finishes it, but its result is dropped.
+             With a `board` (the session store), its state is published there so
+             that other server processes can poll or cancel it.
+    """
+
+    def __init__(self, session_id, board=None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = JOB_QUEUED
+        self.output = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None  # Set when the worker thread is released
+        self.first_token = None  # Time the first streamed token was emitted
+        self._chunks = []  # Streamed answer so far
+        self._cancel = threading.Event()
+        self._board = board
+        self._published = 0.0  # Last publication of the job's state to the board
+        self._pending = None  # Timer publishing the pieces emitted since the last publication
+        self._publish_lock = threading.Lock()
+        self._checked = 0.0  # Last check of the board for a cancellation
+
+    @property
+    def cancelled(self):
+        if self._cancel.is_set():
+            return True
+        if self._board is not None and time.time() - self._checked >= JOB_PUBLISH_INTERVAL:
+            # The session's next question may have reached another process
+            self._checked = time.time()
+            record = self._board.job(self.id)
+            if record is not None and record["cancel"]:
+                self.cancel(status=record["cancel"])
+                return True
+        return False
+
+    def emit(self, text):
+        """
+        @brief Appends a streamed piece of the answer, visible to pollers at once (and
+               to the other processes within JOB_PUBLISH_INTERVAL).
+        """
+        if self.first_token is None:
+            self.first_token = time.time()
+        self._chunks.append(text)
+        if self._board is None:
+            return
+        wait = JOB_PUBLISH_INTERVAL - (time.time() - self._published)
+        if wait <= 0:
+            self.publish()
+        elif self._pending is None:
+            # Publish this piece even if no other one follows before a slow step
+            self._pending = threading.Timer(wait, self.publish)
+            self._pending.daemon = True
+            self._pending.start()
+
+    def record(self):
+        """
+        @return: dict - The state of the job polled by other processes.
+        """
+        return {"status": self.status, "partial": self.partial, "output": self.output,
+                "error": self.error, "submitted": self.submitted}
+
+    def publish(self):
+        """
+        @brief Saves the job's state to the board, if any.
+        """
+        if self._board is None:
+            return
+        # Serialised, so that a late timer never overwrites a newer state
+        with self._publish_lock:
+            if self._pending is not None:
+                self._pending.cancel()
+                self._pending = None
+            self._published = time.time()
+            self._board.save_job(self.id, self.session_id, self.record())
+
+    @property
+    def partial(self):
+        """
+        @return: str - The answer streamed so far.
+        """
+        return "".join(self._chunks)
+
+    @property
+    def time_to_first_token(self):
+        """
+        @return: float or None - Seconds between the job start and its first streamed token.
+        """
+        if self.first_token is None or self.started is None:
+            return None
+        return self.first_token - self.started
+
+    @property
+    def generation_seconds(self):
+        """
+        @return: float or None - Seconds between the job start and its end.
+        """
+        if self.finished is None or self.started is None:
+            return None
+        return self.finished - self.started
+
+    def cancel(self, status=JOB_CANCELLED):
+        """
+        @brief Asks the job to stop and marks it with a final `status`.
+        """
+        self._cancel.set()
+        if self.status not in FINAL_STATES:
+            self.status = status
+
+
+class PublishedJob:
+    """
+    @brief Read-only view of a job run by another server process, as last published
+           to the shared store (same attributes as Job for pollers).
+    """
+
+    def __init__(self, job_id, record):
+        self.id = job_id
+        self.session_id = record["session_id"]
+        self.status = record["status"]
+        if record["cancel"] and self.status not in FINAL_STATES:
+            # Asked to stop: the owner reports it at its next check
+            self.status = record["cancel"]
+        self.partial = record["partial"]
+        self.output = record["output"]
+        self.error = record["error"]
+        self.submitted = record["submitted"]
+
+
+class JobManager:
+    """
+    @brief Runs RAG requests on a bounded thread pool so Dash callbacks return immediately.
+
+    @details - At most `max_queued` jobs are accepted at once (queued or running).
+             - Each session may occupy at most `max_per_session` workers; a new question
+               cancels the session's previous, unfinished one.
+             - Jobs still unfinished `timeout` seconds after submission are cancelled
+               and reported as timed out.
+             - Results are collected by polling `poll(job_id)`. With a `board` shared
+               by the server processes (the SQLite session store), a job may be polled
+               or cancelled from any of them, not only from the one running it. The
+               capacity limits apply per process.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE,
+                 max_per_session=JOB_MAX_PER_SESSION, timeout=JOB_TIMEOUT_SECONDS, board=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.max_queued = max_queued
+        self.max_per_session = max_per_session
+        self.timeout = timeout
+        self.board = board
+
+    def submit(self, session_id, fn, *args):
+        """
+        @brief Cancels the session's previous job and schedules `fn(job, *args)`.
+
+        @param session_id: Id of the browser session asking the question.
+        @param fn: Function computing the job output; receives the Job first.
+        @return: Job - The scheduled job.
+
+        @raises JobRejected: If the server or the session is at capacity.
+        """
+        if self.board is not None:
+            self.board.cancel_jobs(session_id=session_id)  # Including those run by other processes
+        with self._lock:
+            self._forget_expired()
+
+            # A new question supersedes the previous one of the same session
+            for job in self._jobs.values():
+                if job.session_id == session_id and job.status not in FINAL_STATES:
+                    job.cancel()
+
+            # Cancelled jobs keep their worker until their current step returns
+            busy = [job for job in self._jobs.values() if job.finished is None]
+            if len(busy) >= self.max_queued:
+                JOBS_REJECTED.inc()
+                raise JobRejected("The server is busy, please try again in a moment.")
+            if sum(job.session_id == session_id for job in busy) >= self.max_per_session:
+                JOBS_REJECTED.inc()
+                raise JobRejected("Too many questions in flight, please wait for the previous answer.")
+
+            job = Job(session_id, self.board)
+            self._jobs[job.id] = job
+
+        job.publish()  # Pollable by every process before `submit` returns
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        try:
+            if job.cancelled:
+                return
+            job.started = time.time()
+            JOB_QUEUE_SECONDS.observe(job.started - job.submitted)
+            job.status = JOB_RUNNING
+            job.publish()
+            output = fn(job, *args)
+            if not job.cancelled:
+                job.output = output
+                job.status = JOB_DONE
+        except Exception as e:
+            print(f"Error in chatbot job {job.id}: {e}")
+            job.error = str(e)
+            if not job.cancelled:
+                job.status = JOB_FAILED
+        finally:
+            job.finished = time.time()
+            job.publish()
+            JOB_SECONDS.observe(job.finished - job.submitted, state=job.status)
+            if job.started is not None:
+                ttft = job.time_to_first_token
+                print(f"Job {job.id} {job.status} in {job.generation_seconds:.2f}s "
+                      f"(time to first token: {'n/a' if ttft is None else f'{ttft:.2f}s'})")
+
+    def poll(self, job_id):
+        """
+        @brief Returns a job, timing it out if it has been running for too long.
+
+        @param job_id: Id returned by `submit`.
+        @return: Job, PublishedJob if another process runs it, or None if the job is
+                 unknown (or expired).
+        """
+        job = self._jobs.get(job_id)
+        if job is None and self.board is not None:
+            record = self.board.job(job_id)
+            if record is not None:
+                job = PublishedJob(job_id, record)
+                if job.status not in FINAL_STATES and time.time() - job.submitted > self.timeout:
+                    self.board.cancel_jobs(job_id=job_id, status=JOB_TIMEOUT)
+                    job.status = JOB_TIMEOUT
+                return job
+        if job is not None and job.status not in FINAL_STATES and time.time() - job.submitted > self.timeout:
+            job.cancel(status=JOB_TIMEOUT)
+        return job
+
+    def cancel_session(self, session_id):
+        """
+        @brief Cancels every unfinished job of a session.
+        """
+        if self.board is not None:
+            self.board.cancel_jobs(session_id=session_id)
+        with self._lock:
+            for job in self._jobs.values():
+                if job.session_id == session_id:
+                    job.cancel()
+
+    def _forget_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > JOB_RETENTION]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if self.board is not None:
+            # Records of every process, including those of a process that died
+            self.board.forget_jobs(now - JOB_RETENTION - self.timeout)
+
+    def stats(self):
+        """
+        @return: dict - Number of jobs per state.
+        """
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+
+# Job manager shared by every Dash callback of the process; jobs are published to the
+# session store, shared by every process with SESSION_STORE=sqlite
+jobs = JobManager(board=sessions)
+
+Gauge("rag_jobs", "Jobs kept by the job manager, by state.", ["state"],
+      callback=lambda: {(state,): count for state, count in jobs.stats().items()})
@@ -0,0 +1,277 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from pages.chatbot.chatbot_config import OTEL_EXPORTER, OTEL_SERVICE_NAME
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# -------------------------------------------------------------------------
+# Metrics
+# -------------------------------------------------------------------------
+
+class Metric:
+    """
+    @brief A metric family in the Prometheus data model, with optional labels.
+
+    @details Values are recorded with keyword labels (`inc(model="GPT")`). Metrics
+             built with a `callback` are read at scrape time instead: the callback
+             returns {label values tuple: value}, e.g. from a component's `stats()`.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, registry=None):
+        """
+        @param name: Metric name (e.g., "rag_stage_seconds").
+        @param documentation: HELP text.
+        @param labelnames: Names of the labels, in order.
+        @param callback: Returns the current values at scrape time (gauges and counters).
+        @param registry: MetricsRegistry exporting the metric (default: `metrics`).
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or metrics).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """
+        @return: List[Tuple[str, str, float]] - Sample name suffix, formatted labels and value.
+        """
+        values = self.callback() if self.callback else dict(self._values)
+        return [("", _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            samples = self.samples()
+        except Exception as e:  # A failing component must not break the whole scrape
+            print(f"Error while collecting {self.name}: {e}")
+            samples = []
+        lines += [f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in samples]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    @brief Distribution of observations in cumulative buckets, with their sum and count.
+
+    @details Percentiles (p50/p95/p99) are computed by the monitoring system from the
+             buckets, e.g. `histogram_quantile(0.95, rate(rag_stage_seconds_bucket[5m]))`.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([*counts], total, count) for key, (counts, total, count) in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="' + _format_value(float(bound)) + '"'
+                samples.append(("_bucket", _format_labels(self.labelnames, key, le), cumulative))
+            samples.append(("_sum", _format_labels(self.labelnames, key), round(total, 6)))
+            samples.append(("_count", _format_labels(self.labelnames, key), count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    @brief The metrics exported by the process, rendered in the Prometheus text format.
+
+    @details Each server process (e.g. gunicorn worker) exports its own values.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """
+        @return: str - Every metric in the text exposition format.
+        """
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# Metrics of the process, served on /metrics
+metrics = MetricsRegistry()
+
+# Pipeline metrics, recorded by the chatbot modules
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Duration of each stage of a request (retrieval, generation, rendering...).",
+    ["stage"],
+)
+STAGE_ERRORS = Counter("rag_stage_errors_total", "Stages that raised an exception.", ["stage"])
+ANSWER_SECONDS = Histogram(
+    "rag_answer_seconds", "Time to answer a question (source: facts, cache or generated), to the last token.",
+    ["model", "source"],
+)
+FIRST_TOKEN_SECONDS = Histogram(
+    "rag_time_to_first_token_seconds", "Time from the start of generation to the first streamed token.",
+    ["model"],
+)
+RETRIEVED_CHUNKS = Histogram("rag_retrieved_chunks", "Chunks retrieved per question.", buckets=COUNT_BUCKETS)
+TOKENS = Histogram(
+    "rag_tokens", "Tokens per request, by model and kind (prompt or completion).",
+    ["model", "kind"], buckets=TOKEN_BUCKETS,
+)
+CONTEXT_TOKENS_SAVED = Histogram(
+    "rag_context_tokens_saved", "Prompt tokens saved per request by sending the compressed context instead of the chunks.",
+    ["model"], buckets=TOKEN_BUCKETS,
+)
+
+# -------------------------------------------------------------------------
+# Spans
+# -------------------------------------------------------------------------
+
+def _build_tracer():
+    """
+    @brief Sets up the OpenTelemetry exporter configured by OTEL_EXPORTER.
+
+    @return: Tracer or None - None when spans are not exported.
+    """
+    if not OTEL_EXPORTER:
+        return None
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if OTEL_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()  # Endpoint and headers from the standard OTEL_EXPORTER_OTLP_* variables
+    elif OTEL_EXPORTER == "console":
+        exporter = ConsoleSpanExporter()
+    else:
+        raise ValueError(f"Unknown OpenTelemetry exporter: {OTEL_EXPORTER}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))  # Exports off the request threads
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+
+_tracer = _build_tracer()
+
+
+class Span:
+    """
+    @brief Handle of a running stage, to attach attributes to its exported span.
+    """
+
+    def __init__(self, otel_span=None):
+        self._otel_span = otel_span
+
+    def set(self, **attributes):
+        if self._otel_span is not None:
+            for name, value in attributes.items():
+                self._otel_span.set_attribute(name, value)
+
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    @brief Times a stage of a request.
+
+    @details The duration is recorded in `rag_stage_seconds{stage=...}` and exceptions
+             in `rag_stage_errors_total`. With OTEL_EXPORTER set, the stage is also
+             exported as a span (nested in the enclosing stage of the same thread),
+             carrying `attributes`.
+
+    @param stage: Stage name (e.g., "retrieve", "generate").
+    @param attributes: Span attributes (e.g., model="GPT").
+    @return: Span - To add attributes known at the end of the stage.
+    """
+    started = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield Span()
+        else:
+            with _tracer.start_as_current_span(f"rag.{stage}", attributes=attributes) as otel_span:
+                yield Span(otel_span)
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def timed(stage):
+    """
+    @brief Decorator running a whole function (e.g. a Dash callback) as one stage.
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -1,170 +1,421 @@
+import threading
 import torch
 import transformers
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, LlamaForCausalLM
-from time import time
-from langchain.document_loaders import PyPDFLoader
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoConfig, LlamaForCausalLM
 from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI
 from langchain_community.llms import HuggingFacePipeline
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains.question_answering import load_qa_chain
 
-from dotenv import load_dotenv
-load_dotenv()  # Load environment variables (e.g., API keys)
+from pages.chatbot.chatbot_config import (
+    EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_CACHE, PERSIST_DIRECTORY, CONTEXT_TOKEN_BUDGET,
+    ANSWER_MAX_TOKENS, INFERENCE_MODE, CPU_QUANTIZE, BATCHING, RERANKER_MODEL_NAME, index_settings, hnsw_metadata
+)
+from pages.chatbot.chatbot_batching import BatchedPipeline
+from pages.chatbot.chatbot_context import ContextAssembler, format_context
+from pages.chatbot.chatbot_embeddings import CachedEmbeddings
+from pages.chatbot.chatbot_index import IngestManifest, open_vectordb
+from pages.chatbot.chatbot_metrics import span
+from pages.chatbot.chatbot_ingest import ingest_corpus
+from pages.chatbot.chatbot_onnx import OnnxEmbeddings, cpu_threads
+from pages.chatbot.chatbot_rerank import CrossEncoderReranker
 
 # -------------------------------------------------------------------------
 # Device Selection
 # -------------------------------------------------------------------------
 
-# Select the device for computation (GPU if available, otherwise CPU)
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# Select the device for computation (see INFERENCE_MODE; GPU if available by default)
+if INFERENCE_MODE == "auto":
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+elif INFERENCE_MODE in ("gpu", "cpu"):
+    device = 'cuda' if INFERENCE_MODE == "gpu" else 'cpu'
+else:
+    raise ValueError(f"Unknown inference mode: {INFERENCE_MODE}")
 print(f'Using {device} device')
 
+if device == 'cpu':
+    torch.set_num_threads(cpu_threads())
+
+# Prompt template of the GPT chain and of the "stuff" strategy of local models
+QA_TEMPLATE = """
+You are an assistant for question-answering tasks for Retrieval Augmented Generation system for the financial reports such as 10Q and 10K.
+Use the following pieces of retrieved context to answer the question.
+If you don't know the answer, just say that you don't know.
+Use two sentences maximum and keep the answer concise.
+Question: {question}
+Context: {context}
+Answer:
+"""
+
 # -------------------------------------------------------------------------
 # Model Loading
 # -------------------------------------------------------------------------
 
-print('Loading the model...')
+def load_kwargs():
+    """
+    @return: dict - `from_pretrained` arguments placing a local model on the selected device.
+    """
+    if device == 'cuda':
+        return {"device_map": "auto"}
+    # Full precision on CPU (float16 matmuls are slow there), loaded shard by shard
+    return {"torch_dtype": torch.float32, "low_cpu_mem_usage": True}
+
 
-# Define the model to use
-MODEL_NAME = "GPT"  # Change this value to "LLAMA2" or "FLANT5" as required
+def quantize_dynamic(model):
+    """
+    @brief Quantizes the linear layers of a model to int8 for CPU inference.
 
-if MODEL_NAME == "GPT":
-    # ---------------------------------------------------------------------
-    # GPT Model Setup
-    # ---------------------------------------------------------------------
-    from langchain.chat_models import ChatOpenAI
-    from langchain.prompts import ChatPromptTemplate
-    from langchain.schema.runnable import RunnablePassthrough
-    from langchain.schema.output_parser import StrOutputParser
-    import os
-    import openai
+    @details Weights are stored in int8 (a quarter of their float32 size) and
+             activations are quantized on the fly, per batch, so no calibration data
+             is needed. Attention and feed-forward projections dominate generation
+             time and become int8 matrix multiplications.
 
-    # Set your OpenAI API key from the .env file
-    openai.api_key = os.getenv("OPENAI_API_KEY")
+    @param model: A float32 PyTorch model on CPU.
+    @return: The quantized model.
+    """
+    print('Quantizing the model to int8...')
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
 
-    # Define the GPT model
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
 
-elif MODEL_NAME == "LLAMA2":
-    # ---------------------------------------------------------------------
-    # LLAMA2 Model Setup
-    # ---------------------------------------------------------------------
-    model_config = AutoConfig.from_pretrained("meta-llama/Llama-2-7b-chat-hf")
-    model = LlamaForCausalLM.from_pretrained(
-        "meta-llama/Llama-2-7b-chat-hf",
-        trust_remote_code=True, 
-        config=model_config, 
-        device_map='auto'
-    )
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-chat-hf")
+def build_llm(model_name):
+    """
+    @brief Loads the language model.
 
-elif MODEL_NAME == "FLANT5":
-    # ---------------------------------------------------------------------
-    # Flan-T5 Model Setup
-    # ---------------------------------------------------------------------
-    model_name = "google/flan-t5-large"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
+    @param model_name: "GPT", "LLAMA2" or "FLANT5".
+    @return: The LangChain LLM (GatewayChatModel or HuggingFacePipeline).
+    """
+    print(f'Loading the model {model_name}...')
+
+    if model_name == "GPT":
+        # ---------------------------------------------------------------------
+        # GPT Model Setup
+        # ---------------------------------------------------------------------
+        from pages.chatbot.chatbot_gateway import GatewayChatModel, LLMGateway
+
+        # The gateway reads OPENAI_API_KEY (from the .env file), and handles the rate
+        # limits, retries, coalescing of identical prompts and the HTTP connection pool
+        return GatewayChatModel(gateway=LLMGateway(), temperature=0)
+
+    if model_name == "LLAMA2":
+        # ---------------------------------------------------------------------
+        # LLAMA2 Model Setup
+        # ---------------------------------------------------------------------
+        task = "text-generation"
+        model_config = AutoConfig.from_pretrained("meta-llama/Llama-2-7b-chat-hf")
+        model = LlamaForCausalLM.from_pretrained(
+            "meta-llama/Llama-2-7b-chat-hf",
+            trust_remote_code=True,
+            config=model_config,
+            **load_kwargs()
+        )
+        tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-chat-hf")
+
+    elif model_name == "FLANT5":
+        # ---------------------------------------------------------------------
+        # Flan-T5 Model Setup
+        # ---------------------------------------------------------------------
+        # An encoder-decoder model: it generates the answer alone, without the prompt
+        task = "text2text-generation"
+        tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-large")
+        model = AutoModelForSeq2SeqLM.from_pretrained("google/flan-t5-large", **load_kwargs())
+
+    else:
+        raise ValueError(f"Unknown model: {model_name}")
 
-if MODEL_NAME != "GPT":
     # ---------------------------------------------------------------------
     # Pipeline Creation for Non-GPT Models
     # ---------------------------------------------------------------------
+    if device == 'cpu' and CPU_QUANTIZE:
+        model = quantize_dynamic(model)
+
     print('Creating Pipeline...')
+    if device == 'cuda':
+        placement = {"torch_dtype": torch.float16, "device_map": "auto"}
+    else:
+        placement = {"device": "cpu"}
     query_pipeline = transformers.pipeline(
-        "text-generation",
+        task,
         model=model,
         tokenizer=tokenizer,
-        torch_dtype=torch.float16,
-        device_map="auto",
+        **placement,
     )
-    llm = HuggingFacePipeline(pipeline=query_pipeline)
+    if BATCHING:
+        # Concurrent questions share generate calls instead of queueing for the model
+        query_pipeline = BatchedPipeline(query_pipeline)
+    return HuggingFacePipeline(pipeline=query_pipeline)
 
 # -------------------------------------------------------------------------
-# PDF Loading and Splitting
+# Embedding Creation
 # -------------------------------------------------------------------------
 
-print('Loading the corpus for TESLA...')
+def build_embeddings():
+    """
+    @brief Instantiates the embedding model on the configured backend.
 
-# Load the PDF file using LangChain's PyPDFLoader
-loader = PyPDFLoader(r"data/tsla-20230930.pdf")
-data = loader.load()  # Load the text data from the PDF
+    @details EMBEDDING_BACKEND selects LangChain's HuggingFaceEmbeddings ("torch") or
+             OnnxEmbeddings ("onnx", the default in cpu mode). With EMBEDDING_CACHE enabled, the model is wrapped in a persistent
+             embedding cache so repeated chunks and questions are embedded once.
 
-# Split the text into manageable chunks
-print('Instantiating Text Splitter...')
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=300)
-all_splits = text_splitter.split_documents(data)
+    @return: Embeddings - The chunk and query embedding model.
+    """
+    print('Preparing Embeddings...')
+    backend = EMBEDDING_BACKEND
+    if backend == "auto":
+        backend = "onnx" if device == 'cpu' else "torch"
+    if backend == "onnx":
+        embeddings = OnnxEmbeddings(EMBEDDING_MODEL_NAME)
+    elif backend == "torch":
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if EMBEDDING_CACHE:
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_MODEL_NAME)
+    return embeddings
 
 # -------------------------------------------------------------------------
-# Embedding Creation
+# Vector Store Preparation
 # -------------------------------------------------------------------------
 
-print('Preparing Embeddings...')
+def build_vectordb(embeddings, ingest=True):
+    """
+    @brief Opens the persisted Chroma collection and brings it up to date.
 
-# Define the embedding model to use (HuggingFace's MPNet)
-model_name = "sentence-transformers/all-mpnet-base-v2"
+    @param embeddings: Embedding model used for queries and new chunks.
+    @param ingest: Whether to embed filings that are new or changed since the last boot.
+                   Workers forked by gunicorn skip it: the master process ingests
+                   once before forking them (see gunicorn.conf.py).
+    @return: Chroma - The vector store.
+    """
+    print('Preparing Vector Embeddings...')
 
-# Instantiate the embedding model using LangChain's HuggingFaceEmbeddings
-embeddings = HuggingFaceEmbeddings(model_name=model_name)
+    # Open the persisted Chroma collection (created empty on first boot, with the
+    # configured HNSW parameters)
+    vectordb = open_vectordb(embeddings, PERSIST_DIRECTORY, index_settings(), hnsw_metadata())
 
-# -------------------------------------------------------------------------
-# Vector Store Preparation
-# -------------------------------------------------------------------------
+    if ingest:
+        print('Loading the corpus of filings...')
+        manifest = IngestManifest(PERSIST_DIRECTORY, index_settings())
+        print(ingest_corpus(vectordb, embeddings, manifest).report())
+    return vectordb
 
-print('Preparing Vector Embeddings...')
+def build_reranker():
+    """
+    @brief Loads the cross-encoder that reranks the retrieved chunks (see RERANK).
 
-# Create a vector store to store the document chunks and their embeddings
-# Using LangChain's Chroma as the vector store backend
-vectordb = Chroma.from_documents(
-    documents=all_splits,  # Provide the split documents
-    embedding=embeddings,  # Provide the embedding model
-    persist_directory="chroma_db"  # Specify the directory to store the vector database
-)
+    @return: CrossEncoderReranker - The reranker, on the selected device.
+    """
+    from sentence_transformers import CrossEncoder
+
+    print('Preparing Reranker...')
+    model = CrossEncoder(RERANKER_MODEL_NAME, device=device)
+    # Warm-up pass, so the first question's scoring time is representative for the
+    # reranker's latency budget
+    model.predict([("warm-up", "warm-up")], show_progress_bar=False)
+    return CrossEncoderReranker(model)
 
 # -------------------------------------------------------------------------
 # Chain Preparation
 # -------------------------------------------------------------------------
 
-print('Preparing chain...')
+def build_chains(model_name, llm):
+    """
+    @brief Assembles the question-answering chains for the selected model.
+
+    @details Retrieval happens before the chains (see `chatbot_pipeline`), so they
+             take the retrieved documents as input:
+             - GPT: a single "stuff" chain taking `{"context": text, "question": question}`;
+               its context is formatted and compressed by `chatbot_pipeline._gpt_context`.
+             - Others, one chain per strategy (see CHAIN_STRATEGIES):
+               - "stuff": the prompt template, filled by `build_stuffed_prompt`;
+               - "refine" and "map_reduce": LangChain QA chains taking
+                 `{"input_documents": docs, "question": question}`.
+
+    @param model_name: "GPT", "LLAMA2" or "FLANT5".
+    @param llm: The language model returned by `build_llm`.
+    @return: dict - Strategy name -> chain.
+    """
+    print('Preparing chain...')
+
+    if model_name == "GPT":
+        # ---------------------------------------------------------------------
+        # GPT-Specific Chain Setup
+        # ---------------------------------------------------------------------
+        from langchain.prompts import ChatPromptTemplate
+        from langchain.schema.output_parser import StrOutputParser
+
+        # Create a ChatPromptTemplate using the defined template
+        prompt = ChatPromptTemplate.from_template(QA_TEMPLATE)
+
+        # Define the RAG pipeline using LangChain's pipeline operators
+        return {
+            "stuff": (
+                prompt  # Apply the prompt to the question and the retrieved context
+                | llm  # Pass the question to the selected GPT model
+                | StrOutputParser()  # Parse the output
+            )
+        }
 
-if MODEL_NAME == "GPT":
     # ---------------------------------------------------------------------
-    # GPT-Specific Chain Setup
+    # Non-GPT Chain Setup
     # ---------------------------------------------------------------------
+    from langchain.prompts import PromptTemplate
+
+    # Define the chains for models like LLAMA2 or Flan-T5
+    return {
+        "stuff": PromptTemplate.from_template(QA_TEMPLATE),
+        "refine": load_qa_chain(llm, chain_type="refine"),
+        "map_reduce": load_qa_chain(llm, chain_type="map_reduce"),
+    }
+
+# -------------------------------------------------------------------------
+# Context Assembly
+# -------------------------------------------------------------------------
+
+def token_counter(tokenizer):
+    """
+    @return: Callable[[str], int] - Counts the tokens of a text for the tokenizer.
+    """
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def context_window(query_pipeline):
+    """
+    @brief Returns the number of tokens the model attends to.
+
+    @param query_pipeline: The transformers text-generation or text2text-generation pipeline.
+    @return: int - Maximum positions of the model (or of its tokenizer).
+    """
+    config = query_pipeline.model.config
+    for name in ("max_position_embeddings", "n_positions"):
+        if getattr(config, name, None):
+            return getattr(config, name)
+    return query_pipeline.tokenizer.model_max_length
+
 
-    # Define a prompt template for question-answering
-    template = """
-    You are an assistant for question-answering tasks for Retrieval Augmented Generation system for the financial reports such as 10Q and 10K.
-    Use the following pieces of retrieved context to answer the question. 
-    If you don't know the answer, just say that you don't know. 
-    Use two sentences maximum and keep the answer concise.
-    Question: {question} 
-    Context: {context} 
-    Answer:
-    """
-    
-    # Create a ChatPromptTemplate using the defined template
-    prompt = ChatPromptTemplate.from_template(template)
-
-    # Use the vector database as a retriever
-    retriever = vectordb.as_retriever()
-
-    # Define the RAG pipeline using LangChain's pipeline operators
-    conversation_chain = (
-        {"context": retriever, "question": RunnablePassthrough()} 
-        | prompt  # Apply the prompt
-        | llm  # Pass the question to the selected GPT model
-        | StrOutputParser()  # Parse the output
+def build_stuffed_prompt(prompt, query_pipeline, docs, question):
+    """
+    @brief Packs the retrieved documents into a single prompt for the model.
+
+    @details The context budget is the model's context window minus the prompt
+             template, the question and, for decoder-only models, the answer
+             (ANSWER_MAX_TOKENS), capped by CONTEXT_TOKEN_BUDGET. Overlapping chunks
+             are merged before packing.
+
+    @param prompt: The "stuff" prompt template returned by `build_chains`.
+    @param query_pipeline: The transformers text-generation or text2text-generation pipeline.
+    @param docs: Retrieved documents, best first.
+    @param question: The user's question.
+    @return: Tuple[str, List[Document]] - The prompt and the passages it contains.
+    """
+    with span("build_prompt") as stage:
+        count_tokens = token_counter(query_pipeline.tokenizer)
+        budget = context_window(query_pipeline) - count_tokens(prompt.format(context="", question=question))
+        if not getattr(query_pipeline.model.config, "is_encoder_decoder", False):
+            budget -= ANSWER_MAX_TOKENS  # The answer follows the prompt in the same window
+        if CONTEXT_TOKEN_BUDGET:
+            budget = min(budget, CONTEXT_TOKEN_BUDGET)
+
+        passages = ContextAssembler(count_tokens, max(budget, 0)).assemble(docs)
+        stage.set(budget=budget, passages=len(passages))
+        return prompt.format(context=format_context(passages), question=question), passages
+
+
+def run_pipeline(query_pipeline, prompt):
+    """
+    @brief Generates the answer to a complete prompt in one pass.
+
+    @return: str - The generated text (without the prompt).
+    """
+    # text2text-generation pipelines only return the answer (and reject the argument)
+    kwargs = {"return_full_text": False} if query_pipeline.task == "text-generation" else {}
+    result = query_pipeline(prompt, max_new_tokens=ANSWER_MAX_TOKENS, **kwargs)
+    return result[0]["generated_text"]
+
+# -------------------------------------------------------------------------
+# Streaming
+# -------------------------------------------------------------------------
+
+def stream_pipeline(query_pipeline, prompt, **generate_kwargs):
+    """
+    @brief Streams the text generated by a transformers pipeline, token by token.
+
+    @details The pipeline runs in a separate thread and pushes decoded tokens into a
+             `TextIteratorStreamer`, which this generator drains. A BatchedPipeline
+             generates the prompt in a batch with the concurrent ones.
+
+    @param query_pipeline: The transformers text-generation or text2text-generation pipeline.
+    @param prompt: The full prompt.
+    @param generate_kwargs: Extra generation arguments for the pipeline.
+    @return: Iterator[str] - Pieces of generated text (the prompt is not repeated).
+    """
+    streamer = transformers.TextIteratorStreamer(
+        query_pipeline.tokenizer, skip_prompt=True, skip_special_tokens=True
     )
+    errors = []
 
-else:
-    # ---------------------------------------------------------------------
-    # Non-GPT Chain Setup
-    # ---------------------------------------------------------------------
+    def generate():
+        try:
+            query_pipeline(prompt, streamer=streamer, **generate_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()  # Unblock the consumer
 
-    # Define the chain for models like LLAMA2 or Flan-T5
-    conversation_chain = load_qa_chain(llm, chain_type="map_reduce")
+    thread = threading.Thread(target=generate, name="pipeline-stream", daemon=True)
+    thread.start()
+    yield from streamer
+    thread.join()
+    if errors:
+        raise errors[0]
 
-print('Chain Prepared...')
+
+def stream_map_reduce(chain, llm, docs, question):
+    """
+    @brief Answers with the map_reduce QA chain, streaming the final (reduce) step.
+
+    @details The map step summarises every document as `chain.run` would; the reduce
+             prompt is then built the same way and its generation is streamed.
+
+    @param chain: The map_reduce chain returned by `build_chains`.
+    @param llm: The HuggingFacePipeline LLM of the chain.
+    @param docs: Retrieved documents.
+    @param question: The user's question.
+    @return: Iterator[str] - Pieces of the answer.
+    """
+    from langchain_core.documents import Document
+
+    map_chain = chain.llm_chain
+    with span("map", documents=len(docs)):
+        mapped = map_chain.apply(
+            [{chain.document_variable_name: doc.page_content, "question": question} for doc in docs]
+        )
+    summaries = [
+        Document(page_content=result[map_chain.output_key], metadata=doc.metadata)
+        for result, doc in zip(mapped, docs)
+    ]
+    combine_chain = chain.reduce_documents_chain.combine_documents_chain
+    inputs = combine_chain._get_inputs(summaries, question=question)
+    yield from stream_pipeline(llm.pipeline, combine_chain.llm_chain.prompt.format(**inputs))
+
+
+def stream_refine(chain, llm, docs, question):
+    """
+    @brief Answers with the refine QA chain, streaming the last refinement.
+
+    @details The first document is answered and every following one but the last
+             refines that answer, as `chain.run` would; the last refinement is streamed.
+
+    @param chain: The refine chain returned by `build_chains`.
+    @param llm: The HuggingFacePipeline LLM of the chain.
+    @param docs: Documents, best first.
+    @param question: The user's question.
+    @return: Iterator[str] - Pieces of the answer.
+    """
+    inputs = chain._construct_initial_inputs(docs, question=question)
+    if len(docs) == 1:
+        yield from stream_pipeline(llm.pipeline, chain.initial_llm_chain.prompt.format(**inputs))
+        return
+    with span("refine", documents=len(docs)):
+        answer = chain.initial_llm_chain.predict(**inputs)
+        for doc in docs[1:-1]:
+            answer = chain.refine_llm_chain.predict(**chain._construct_refine_inputs(doc, answer), question=question)
+    inputs = {**chain._construct_refine_inputs(docs[-1], answer), "question": question}
+    yield from stream_pipeline(llm.pipeline, chain.refine_llm_chain.prompt.format(**inputs))
@@ -0,0 +1,162 @@
+import json
+import os
+import re
+
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+
+from pages.chatbot.chatbot_config import EMBEDDING_MODEL_NAME, ONNX_DIR, CPU_THREADS
+
+# Files of an exported embedding model
+MODEL_FILE = "model.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+META_FILE = "embedder.json"
+
+# ONNX operator set of the export
+OPSET_VERSION = 17
+
+# Texts per ONNX Runtime call
+ONNX_BATCH_SIZE = 32
+
+
+def cpu_threads():
+    """
+    @return: int - Threads for CPU inference: CPU_THREADS, or the cores available to the process.
+    """
+    if CPU_THREADS:
+        return CPU_THREADS
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def export_directory(model_name, directory=ONNX_DIR):
+    return os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+
+
+def export_embedder(model_name=EMBEDDING_MODEL_NAME, directory=ONNX_DIR):
+    """
+    @brief Exports a sentence-transformers model to ONNX, unless already exported.
+
+    @details The transformer is traced with dynamic batch and sequence axes; pooling
+             and normalisation stay in NumPy (see OnnxEmbeddings), configured from the
+             sentence-transformers modules so the vectors match the PyTorch model's.
+             Concurrent processes wait for a single export.
+
+    @param model_name: HuggingFace name of the sentence-transformers model.
+    @param directory: Directory of the exported models.
+    @return: str - Directory holding the ONNX graph, the tokenizer and its settings.
+    """
+    path = export_directory(model_name, directory)
+    os.makedirs(path, exist_ok=True)
+    with FileLock(os.path.join(path, ".lock")):
+        if os.path.exists(os.path.join(path, META_FILE)):
+            return path
+
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        print(f'Exporting {model_name} to ONNX...')
+        encoder = SentenceTransformer(model_name, device="cpu")
+        transformer, pooling = encoder[0], encoder[1]
+        model, tokenizer = transformer.auto_model.eval(), transformer.tokenizer
+
+        sample = tokenizer(["An example sentence", "Another one"], padding=True, return_tensors="pt")
+        inputs = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+        axes = {name: {0: "batch", 1: "sequence"} for name in inputs + ["last_hidden_state"]}
+        with torch.no_grad():
+            torch.onnx.export(
+                model, ({name: sample[name] for name in inputs},), os.path.join(path, MODEL_FILE),
+                input_names=inputs, output_names=["last_hidden_state"], dynamic_axes=axes,
+                opset_version=OPSET_VERSION, do_constant_folding=True,
+            )
+        tokenizer.backend_tokenizer.save(os.path.join(path, TOKENIZER_FILE))
+
+        meta = {
+            "model_name": model_name,
+            "dimension": encoder.get_sentence_embedding_dimension(),
+            "max_length": encoder.max_seq_length,
+            "pooling": "cls" if pooling.pooling_mode_cls_token else "mean",
+            "normalize": any(type(module).__name__ == "Normalize" for module in encoder),
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+        }
+        # Written last: its presence marks a complete export
+        with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+    return path
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    @brief Sentence-transformers embeddings computed with ONNX Runtime on CPU.
+
+    @details Produces the same vectors as HuggingFaceEmbeddings for the same model
+             (newlines replaced by spaces, truncation at the model's maximum sequence
+             length, same pooling and normalisation), without loading PyTorch at
+             inference time. Texts are sorted by length so batches carry little padding.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, directory=ONNX_DIR, threads=None,
+                 batch_size=ONNX_BATCH_SIZE):
+        """
+        @param model_name: HuggingFace name of the sentence-transformers model.
+        @param directory: Directory of the exported models (exported on first use).
+        @param threads: Intra-op threads of ONNX Runtime (default: `cpu_threads()`).
+        @param batch_size: Texts per ONNX Runtime call.
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        path = export_embedder(model_name, directory)
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.model_name = model_name
+        self.batch_size = batch_size
+
+        options = onnxruntime.SessionOptions()
+        # One large operator at a time, each spread over the cores
+        options.intra_op_num_threads = threads or cpu_threads()
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, MODEL_FILE), options, providers=["CPUExecutionProvider"]
+        )
+        self.inputs = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(self.meta["max_length"])
+        self.tokenizer.enable_padding(pad_id=self.meta["pad_token_id"], pad_token=self.meta["pad_token"])
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: feeds[name] for name in self.inputs})[0]
+
+        if self.meta["pooling"] == "cls":
+            pooled = hidden[:, 0]
+        else:
+            weights = mask[:, :, None].astype(hidden.dtype)
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        if self.meta["normalize"]:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def embed_documents(self, texts):
+        texts = [text.replace("\n", " ").strip() for text in texts]
+        vectors = np.empty((len(texts), self.meta["dimension"]), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors[batch] = self._encode([texts[i] for i in batch])
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,250 @@
+import time
+
+from pages.chatbot.chatbot_cache import context_fingerprint
+from pages.chatbot.chatbot_config import (
+    STREAMING, SEMANTIC_CACHE, CHAIN_STRATEGY, ANSWER_MAX_TOKENS, RERANK_CANDIDATES, FACT_ANSWERS,
+    CONTEXT_COMPRESSION, GPT_CONTEXT_TOKEN_BUDGET
+)
+from pages.chatbot.chatbot_embeddings import embed_query_array
+from pages.chatbot.chatbot_filters import FILING_AUTO
+from pages.chatbot.chatbot_metrics import (
+    span, ANSWER_SECONDS, FIRST_TOKEN_SECONDS, RETRIEVED_CHUNKS, TOKENS, CONTEXT_TOKENS_SAVED
+)
+from pages.chatbot.chatbot_registry import registry
+from pages.chatbot.chatbot_updates import corpus_lock
+
+
+def _never_cancelled():
+    return False
+
+
+def _discard(text):
+    pass
+
+
+def answer_question(question, model_name, emit=_discard, is_cancelled=_never_cancelled, strategy=CHAIN_STRATEGY,
+                    filing=FILING_AUTO):
+    """
+    @brief Answers a question with retrieval-augmented generation.
+
+    @details Executes the following steps:
+             1. Picks the filings the question is about (ticker or company, form type,
+                period) unless one is selected. A direct numeric question is answered
+                from the line items extracted from their statement tables, if found.
+                Otherwise the question is embedded once.
+             2. Retrieves the most relevant chunks of those filings (dense search with
+                that embedding, fused with BM25 results in hybrid mode) and, with
+                RERANK, keeps the few a cross-encoder scores best.
+             3. Returns the cached answer of an equivalent question that retrieved
+                the same context, if any.
+             4. Otherwise generates the answer (streamed through `emit`) and caches it.
+
+    @param question: The question asked by the user.
+    @param model_name: The model selected by the user (e.g., GPT, LLAMA2).
+    @param emit: Called with every streamed piece of the answer.
+    @param is_cancelled: Returns True once the answer is no longer wanted.
+    @param strategy: How local models combine the chunks (see CHAIN_STRATEGIES).
+    @param filing: Filing selected by the user: FILING_AUTO, FILING_ALL or its source.
+    @return: str or None - The answer, or None if cancelled before generation.
+    """
+    started = time.perf_counter()
+
+    # Resources are built on first use if the warm-up has not finished yet
+    embeddings = registry.get("embeddings")
+    reranker = registry.get("reranker")
+
+    # Filings, facts and chunks are read from one version of the corpus: a live update
+    # waits for the questions in this block, which wait for it in turn
+    answer = None
+    with corpus_lock.read():
+        retriever = registry.get("retriever")
+        facts = registry.get("facts") if FACT_ANSWERS else None
+        cache = registry.get("answer_cache") if SEMANTIC_CACHE else None
+
+        sources = retriever.catalog.select(question, filing) if retriever.catalog is not None else None
+        if facts is not None:
+            with span("fact_lookup") as stage:
+                answer = facts.answer(question, sources)
+                stage.set(hit=answer is not None)
+        if answer is None:
+            with span("embed_query"):
+                query_vector = embed_query_array(embeddings, question)
+            with span("retrieve") as stage:
+                # Retrieve similar documents (more candidates than kept when they are reranked)
+                docs = retriever.search(question, query_vector, k=RERANK_CANDIDATES if reranker else None,
+                                        sources=sources)
+                stage.set(chunks=len(docs), filings=len(sources) if sources else 0)
+    if answer is not None:
+        emit(answer)
+        ANSWER_SECONDS.observe(time.perf_counter() - started, model=model_name, source="facts")
+        return answer
+
+    if reranker is not None:
+        with span("rerank", candidates=len(docs)):
+            docs = reranker.rerank(question, docs)
+    RETRIEVED_CHUNKS.observe(len(docs))
+
+    if model_name == "GPT":
+        strategy = "stuff"  # GPT answers from a single prompt of compressed chunks
+    fingerprint = context_fingerprint(docs, model_name, strategy)
+    if cache is not None:
+        with span("cache_lookup") as stage:
+            cached = cache.lookup(query_vector, fingerprint)
+            stage.set(hit=cached is not None)
+        if cached is not None:
+            print(f"Semantic cache hit: {cache.stats()}")
+            emit(cached)
+            ANSWER_SECONDS.observe(time.perf_counter() - started, model=model_name, source="cache")
+            return cached
+
+    if is_cancelled():  # The user asked another question meanwhile
+        return None
+    answer = generate_answer(question, docs, model_name, emit, is_cancelled, strategy, query_vector)
+    if not is_cancelled():
+        ANSWER_SECONDS.observe(time.perf_counter() - started, model=model_name, source="generated")
+
+    if cache is not None and answer and not is_cancelled():
+        cache.store(question, query_vector, fingerprint, answer)
+    return answer
+
+
+def generate_answer(question, docs, model_name, emit=_discard, is_cancelled=_never_cancelled,
+                    strategy=CHAIN_STRATEGY, query_vector=None):
+    """
+    @brief Generates the answer from the retrieved documents with the selected model.
+
+    @details GPT answers from a single prompt holding the compressed context (see
+             `_gpt_context`). Local models combine the documents with the selected strategy:
+             - "stuff": deduplicated chunks packed into one prompt under the model's
+               token budget, answered in a single generation;
+             - "refine" / "map_reduce": one generation per (deduplicated) chunk, plus
+               a final one for map_reduce.
+
+    @param question: The question asked by the user.
+    @param docs: The retrieved documents.
+    @param model_name: The model selected by the user (e.g., GPT, LLAMA2).
+    @param emit: Called with every streamed piece of the answer.
+    @param is_cancelled: Returns True once the answer is no longer wanted.
+    @param strategy: How local models combine the chunks (see CHAIN_STRATEGIES).
+    @param query_vector: Embedding of the question (computed if not given), used to
+                         compress the GPT context.
+    @return: str - The answer (possibly truncated if cancelled while streaming).
+    """
+    # The pool loads the model if needed and keeps it loaded until the answer is complete
+    with registry.get("models").use(model_name) as model:
+        with span("generate", model=model_name, strategy=strategy):
+            answer = _generate(question, docs, model, emit, is_cancelled, strategy, query_vector)
+        _record_tokens(model, "completion", answer)
+    return answer
+
+
+# Models whose tokenizer could not be loaded (e.g. tiktoken offline): not counted again
+_uncounted_models = set()
+
+
+def _token_counter(model):
+    """
+    @return: Callable[[str], int] - Counts tokens with the tokenizer of the model.
+    """
+    if model.name == "GPT":
+        from pages.chatbot.chatbot_context import tiktoken_counter
+        return tiktoken_counter()
+    from pages.chatbot.chatbot_model import token_counter
+    return token_counter(model.llm.pipeline.tokenizer)
+
+
+def _record_tokens(model, kind, text):
+    """
+    @brief Records the token count of a prompt or an answer in `rag_tokens`.
+    """
+    if not text or model.name in _uncounted_models:
+        return
+    try:
+        counter = _token_counter(model)
+    except Exception as e:  # Metrics must never fail (nor retry on every answer)
+        print(f"Token counts disabled for {model.name}: {e}")
+        _uncounted_models.add(model.name)
+        return
+    TOKENS.observe(counter(text), model=model.name, kind=kind)
+
+
+def _gpt_context(question, docs, query_vector, model):
+    """
+    @brief Formats the retrieved chunks into the context of the GPT prompt.
+
+    @details The chunks are sent as plain text preceded by their page number, without
+             their metadata, and within GPT_CONTEXT_TOKEN_BUDGET tiktoken tokens: with
+             CONTEXT_COMPRESSION, the sentences closest to the question are kept (see
+             `ContextCompressor`), otherwise whole passages in rank order. The tokens
+             saved over the chunks as previously sent (Document reprs) are logged and
+             recorded in `rag_context_tokens_saved`.
+
+    @return: str - The context.
+    """
+    from pages.chatbot.chatbot_context import ContextAssembler, ContextCompressor, format_context, gpt_token_counter
+
+    with span("compress_context") as stage:
+        count_tokens = gpt_token_counter()
+        if CONTEXT_COMPRESSION:
+            embeddings = registry.get("embeddings")
+            if query_vector is None:
+                query_vector = embed_query_array(embeddings, question)
+            passages = ContextCompressor(embeddings, count_tokens, GPT_CONTEXT_TOKEN_BUDGET).compress(docs, query_vector)
+        else:
+            passages = ContextAssembler(count_tokens, GPT_CONTEXT_TOKEN_BUDGET).assemble(docs)
+        context = format_context(passages)
+        before, after = count_tokens(str(docs)), count_tokens(context)
+        stage.set(tokens_before=before, tokens_after=after)
+    CONTEXT_TOKENS_SAVED.observe(max(before - after, 0), model=model.name)
+    print(f"Context compression: {before} -> {after} tokens ({before - after} saved)")
+    return context
+
+
+def _generate(question, docs, model, emit, is_cancelled, strategy, query_vector=None):
+    chains = model.chains
+    started = time.perf_counter()
+
+    # Handle logic based on the selected model
+    if model.name == "GPT":
+        conversation_chain = chains["stuff"]
+        inputs = {"context": _gpt_context(question, docs, query_vector, model), "question": question}
+        _record_tokens(model, "prompt", conversation_chain.first.format(**inputs))
+        if not STREAMING:
+            # Use GPT model to generate a response
+            return conversation_chain.invoke(inputs)
+        tokens = conversation_chain.stream(inputs)
+    else:
+        # Use other models for generating responses (lazy imports: torch)
+        from pages.chatbot.chatbot_context import merge_overlapping
+        from pages.chatbot.chatbot_model import (
+            build_stuffed_prompt, run_pipeline, stream_pipeline, stream_map_reduce, stream_refine
+        )
+        llm = model.llm
+        conversation_chain = chains[strategy]
+
+        if strategy == "stuff":
+            prompt, _ = build_stuffed_prompt(conversation_chain, llm.pipeline, docs, question)
+            _record_tokens(model, "prompt", prompt)
+            if not STREAMING:
+                return run_pipeline(llm.pipeline, prompt)
+            tokens = stream_pipeline(llm.pipeline, prompt, max_new_tokens=ANSWER_MAX_TOKENS)
+        else:
+            docs = merge_overlapping(docs)  # One generation less per repeated chunk
+            # The chunks and the question, sent once per generation
+            _record_tokens(model, "prompt", "\n".join([doc.page_content for doc in docs] + [question]))
+            if not STREAMING:
+                inputs = {"input_documents": docs, "question": question}
+                return conversation_chain.run(inputs)  # Generate the response
+            stream = stream_refine if strategy == "refine" else stream_map_reduce
+            tokens = stream(conversation_chain, llm, docs, question)
+
+    # Push the answer to the caller piece by piece
+    pieces = []
+    for token in tokens:
+        if is_cancelled():
+            break
+        if not pieces:
+            FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, model=model.name)
+        pieces.append(token)
+        emit(token)
+    return "".join(pieces)
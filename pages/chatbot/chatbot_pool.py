@@ -0,0 +1,311 @@
+import gc
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from pages.chatbot.chatbot_config import MODEL_NAME, MODEL_POOL_MEMORY_MB, MODEL_POOL_IDLE_TTL, JOB_TIMEOUT
+
+# How a model is loaded: `load(name)` returns (llm, chains); `memory_mb` estimates
+# its footprint before it is loaded; `fork_safe` tells whether a forked worker may
+# keep using the copy inherited from its parent process
+ModelSpec = namedtuple("ModelSpec", ["load", "memory_mb", "fork_safe"])
+
+
+def memory_footprint_mb(llm):
+    """
+    @brief Measures the weights of a local model.
+
+    @param llm: A LangChain LLM; local models wrap a transformers pipeline.
+    @return: float - Size of the model's tensors in MB (0 for remote models).
+    """
+    model = getattr(getattr(llm, "pipeline", None), "model", None)
+    if model is None or not hasattr(model, "state_dict"):
+        return 0.0
+    size = 0
+    for value in model.state_dict().values():
+        # Dynamically quantized layers store (weight, bias) tuples of packed tensors
+        for tensor in value if isinstance(value, (tuple, list)) else (value,):
+            if hasattr(tensor, "element_size"):
+                size += tensor.numel() * tensor.element_size()
+    return size / 2 ** 20
+
+
+class ModelPoolBusy(Exception):
+    """
+    @brief Raised when a model cannot be loaded because the models in use fill the memory budget.
+    """
+
+
+class LoadedModel:
+    """
+    @brief A model held by the pool: its LLM, its chains and its usage.
+    """
+
+    def __init__(self, name, llm, chains, memory_mb):
+        self.name = name
+        self.llm = llm
+        self.chains = chains
+        self.memory_mb = memory_mb
+        self.users = 0  # Requests currently using the model
+        self.requests = 0
+        self.loaded = time.time()
+        self.last_used = self.loaded
+
+
+class ModelPool:
+    """
+    @brief Holds the language models, loading them on demand and unloading idle ones.
+
+    @details - `use(name)` lends a model to a request, loading it first if needed.
+               Concurrent requests for a model being loaded wait for that single load.
+             - A model in use is never unloaded. Before a load, the least recently
+               used idle models are unloaded until the new one fits the memory
+               budget; if the models in use leave no room, the load waits for them.
+             - Models idle for more than `idle_ttl` seconds are unloaded (checked on
+               every request), except the default model.
+    """
+
+    def __init__(self, memory_budget_mb=MODEL_POOL_MEMORY_MB, idle_ttl=MODEL_POOL_IDLE_TTL,
+                 default=MODEL_NAME, wait_timeout=JOB_TIMEOUT):
+        """
+        @param memory_budget_mb: Memory the loaded models may use, in MB (0: unlimited).
+        @param idle_ttl: Seconds an unused model stays loaded (0: until its memory is needed).
+        @param default: Model kept loaded when idle.
+        @param wait_timeout: Seconds a load waits for memory before giving up.
+        """
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_ttl = idle_ttl
+        self.default = default
+        self.wait_timeout = wait_timeout
+        self._specs = {}
+        self._models = {}  # name -> LoadedModel
+        self._loading = {}  # name -> memory reserved for a load in progress
+        self._changed = threading.Condition()
+        self.loads = 0
+        self.evictions = 0
+
+    def register(self, name, load, memory_mb=0, fork_safe=True):
+        """
+        @brief Declares a model the pool may load.
+
+        @param name: Name selected in the UI (e.g., "GPT", "LLAMA2").
+        @param load: Called with the name; returns the LLM and its chains (dict strategy -> chain).
+        @param memory_mb: Estimated footprint in MB, used until the loaded model is measured.
+        @param fork_safe: Whether a forked worker may keep the copy loaded by its parent.
+        """
+        self._specs[name] = ModelSpec(load, memory_mb, fork_safe)
+
+    @property
+    def names(self):
+        return list(self._specs)
+
+    # ---------------------------------------------------------------------
+    # Lending Models
+    # ---------------------------------------------------------------------
+
+    @contextmanager
+    def use(self, name):
+        """
+        @brief Lends a model for the duration of a `with` block.
+
+        @param name: Name of a registered model.
+        @return: LoadedModel - Its `llm` and `chains`.
+
+        @raises ValueError: If the model is not registered.
+        @raises ModelPoolBusy: If no memory frees up within `wait_timeout` seconds.
+        """
+        model = self._acquire(name)
+        try:
+            yield model
+        finally:
+            with self._changed:
+                model.users -= 1
+                model.last_used = time.time()
+                self._changed.notify_all()
+
+    def load(self, name):
+        """
+        @brief Loads a model without using it (e.g., the default model at startup).
+        """
+        with self.use(name):
+            pass
+
+    def _acquire(self, name):
+        if name not in self._specs:
+            raise ValueError(f"Unknown model: {name}")
+        spec = self._specs[name]
+        deadline = time.monotonic() + self.wait_timeout
+        busy = False
+        unloaded = []
+        try:
+            with self._changed:
+                unloaded += self._expire()
+                while True:
+                    model = self._models.get(name)
+                    if model is not None:
+                        model.users += 1
+                        model.requests += 1
+                        return model
+                    if name in self._loading:  # Another request is loading it
+                        self._changed.wait()
+                        continue
+                    unloaded += self._make_room(spec.memory_mb)
+                    if self._fits(spec.memory_mb):
+                        self._loading[name] = spec.memory_mb
+                        break
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        busy = True
+                        break
+                    self._changed.wait(left)
+        finally:
+            # Unloaded models are freed outside the lock: collection may take a while
+            self._release_memory(unloaded)
+
+        if busy:
+            raise ModelPoolBusy(f"Not enough memory to load {name}: the loaded models are in use.")
+        try:
+            print(f'Loading the model {name} into the pool...')
+            llm, chains = spec.load(name)
+            memory_mb = memory_footprint_mb(llm) or spec.memory_mb
+        except Exception:
+            with self._changed:
+                del self._loading[name]
+                self._changed.notify_all()
+            raise
+
+        with self._changed:
+            del self._loading[name]
+            model = self._models[name] = LoadedModel(name, llm, chains, memory_mb)
+            model.users += 1
+            model.requests += 1
+            self.loads += 1
+            self._changed.notify_all()
+        return model
+
+    # ---------------------------------------------------------------------
+    # Memory Budget
+    # ---------------------------------------------------------------------
+
+    @property
+    def used_mb(self):
+        return sum(model.memory_mb for model in self._models.values()) + sum(self._loading.values())
+
+    def _fits(self, memory_mb):
+        if not self.memory_budget_mb:
+            return True
+        # A model larger than the whole budget still loads once everything else is gone
+        alone = not self._models and not self._loading
+        return alone or self.used_mb + memory_mb <= self.memory_budget_mb
+
+    def _make_room(self, memory_mb):
+        """
+        @brief Unloads idle models, least recently used first, until `memory_mb` fits.
+
+        @details Nothing is unloaded if the models in use leave no room anyway.
+
+        @return: List[LoadedModel] - The unloaded models (their memory is released by the caller).
+        """
+        unloaded = []
+        idle = sorted((m for m in self._models.values() if m.users == 0), key=lambda m: m.last_used)
+        for model in idle:
+            if self._fits(memory_mb):
+                break
+            unloaded.append(self._models.pop(model.name))
+        if not self._fits(memory_mb):
+            for model in unloaded:
+                self._models[model.name] = model
+            return []
+        return unloaded
+
+    def _expire(self):
+        if not self.idle_ttl:
+            return []
+        now = time.time()
+        expired = [name for name, model in self._models.items()
+                   if model.users == 0 and name != self.default and now - model.last_used > self.idle_ttl]
+        return [self._models.pop(name) for name in expired]
+
+    def _release_memory(self, unloaded):
+        if not unloaded:
+            return
+        for model in unloaded:
+            print(f'Unloaded the model {model.name} ({model.memory_mb:.0f} MB, idle since '
+                  f'{time.strftime("%H:%M:%S", time.localtime(model.last_used))})')
+            pipeline = getattr(model.llm, "pipeline", None)
+            if hasattr(pipeline, "close"):
+                pipeline.close()  # The batching thread holds the pipeline and its weights
+            model.llm = model.chains = None
+        self.evictions += len(unloaded)
+        gc.collect()
+        torch = sys.modules.get("torch")  # Only loaded if a local model was
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # ---------------------------------------------------------------------
+    # Processes and Metrics
+    # ---------------------------------------------------------------------
+
+    def after_fork(self):
+        """
+        @brief Drops the models a forked worker must not share (e.g. HTTP connection pools).
+        """
+        self._changed = threading.Condition()
+        self._loading = {}
+        for name in [name for name in self._models if not self._specs[name].fork_safe]:
+            del self._models[name]
+
+    def stats(self):
+        """
+        @return: dict - Memory budget and use, loads, evictions and every loaded model's usage
+                 (with its batching statistics, if any).
+        """
+        with self._changed:
+            models = {}
+            for name, model in self._models.items():
+                pipeline = getattr(model.llm, "pipeline", None)
+                models[name] = {
+                    "memory_mb": round(model.memory_mb, 1),
+                    "users": model.users,
+                    "requests": model.requests,
+                    "idle_seconds": round(time.time() - model.last_used, 1) if not model.users else 0,
+                    "batching": pipeline.stats() if hasattr(pipeline, "stats") else None,
+                }
+            return {
+                "memory_budget_mb": self.memory_budget_mb,
+                "memory_used_mb": round(self.used_mb, 1),
+                "loading": list(self._loading),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "models": models,
+            }
+
+
+# -------------------------------------------------------------------------
+# Chatbot Models
+# -------------------------------------------------------------------------
+
+def _load_model(name):
+    from pages.chatbot.chatbot_model import build_llm, build_chains
+
+    llm = build_llm(name)
+    return llm, build_chains(name, llm)
+
+
+def build_model_pool():
+    """
+    @brief Creates the pool of the chatbot's models.
+
+    @details Footprint estimates are float16 on GPU / int8 on CPU for Llama 2 7B and
+             float32 for Flan-T5 large; loaded models are measured.
+
+    @return: ModelPool
+    """
+    pool = ModelPool()
+    # The OpenAI client holds an HTTP connection pool: cheap to rebuild per worker
+    pool.register("GPT", _load_model, memory_mb=0, fork_safe=False)
+    pool.register("LLAMA2", _load_model, memory_mb=13500)
+    pool.register("FLANT5", _load_model, memory_mb=3200)
+    return pool
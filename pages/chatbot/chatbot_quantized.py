@@ -0,0 +1,339 @@
+import json
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+from pages.chatbot.chatbot_config import (
+    PERSIST_DIRECTORY, VECTOR_QUANTIZATION, PQ_SUBSPACES, QUANTIZED_RERANK_CANDIDATES
+)
+from pages.chatbot.chatbot_retrieval import PartitionedMixin
+
+# Files of the persisted quantized index: codes and codebooks, full-precision vectors
+# (memory-mapped, only read to re-rank) and chunk texts
+QUANTIZED_INDEX_ARRAYS = "quantized.npz"
+QUANTIZED_INDEX_VECTORS = "vectors.npy"
+QUANTIZED_INDEX_TEXTS = "quantized.json"
+
+# Rows scored per block, bounding the temporary float32 copy of the codes
+SCAN_BLOCK_SIZE = 16384
+
+# Product quantization: centroids per subspace (one byte per code), k-means iterations
+# and maximum number of vectors the codebooks are trained on
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 20
+PQ_TRAINING_SIZE = 65536
+
+
+# -------------------------------------------------------------------------
+# Quantizers
+# -------------------------------------------------------------------------
+
+class ScalarQuantizer:
+    """
+    @brief 8-bit scalar quantization: every dimension is mapped linearly to 0..255.
+
+    @details Squared L2 distances to a query are computed without decoding the vectors:
+             |q - x|^2 = |q|^2 - 2 (q . low + codes . (q * scale)) + |x|^2, with |x|^2
+             of the reconstructed vectors precomputed.
+    """
+
+    method = "sq8"
+
+    def __init__(self, low, scale):
+        self.low = low
+        self.scale = scale
+
+    @classmethod
+    def train(cls, vectors):
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = np.where(high > low, (high - low) / 255, 1.0).astype(np.float32)
+        return cls(low.astype(np.float32), scale)
+
+    def encode(self, vectors):
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.low + codes.astype(np.float32) * self.scale
+
+    def prepare(self, query):
+        return query * self.scale, float(query @ self.low)
+
+    def scan(self, codes, prepared):
+        """
+        @return: np.ndarray - -2 q.x of every coded vector (add |q|^2 + |x|^2 for distances).
+        """
+        weights, offset = prepared
+        return -2 * (codes.astype(np.float32) @ weights + offset)
+
+    def arrays(self):
+        return {"low": self.low, "scale": self.scale}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["low"], arrays["scale"])
+
+
+class ProductQuantizer:
+    """
+    @brief Product quantization: vectors are cut into `subspaces` slices, each replaced
+           by the id of its nearest centroid (k-means codebook per slice).
+
+    @details A query is compared to the 256 centroids of every slice once (lookup table);
+             the distance to a coded vector is then the sum of its table entries.
+    """
+
+    method = "pq"
+
+    def __init__(self, centroids):
+        self.centroids = centroids  # (subspaces, centroids, slice dimension)
+
+    @property
+    def subspaces(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, vectors, subspaces=PQ_SUBSPACES, seed=0):
+        dimension = vectors.shape[1]
+        if dimension % subspaces:
+            raise ValueError(f"PQ_SUBSPACES ({subspaces}) must divide the embedding dimension ({dimension})")
+        rng = np.random.default_rng(seed)
+        if len(vectors) > PQ_TRAINING_SIZE:
+            vectors = vectors[rng.choice(len(vectors), PQ_TRAINING_SIZE, replace=False)]
+        count = min(PQ_CENTROIDS, len(vectors))
+
+        slices = vectors.reshape(len(vectors), subspaces, -1)
+        centroids = np.empty((subspaces, count, slices.shape[2]), dtype=np.float32)
+        for m in range(subspaces):
+            data = slices[:, m]
+            means = data[rng.choice(len(data), count, replace=False)].copy()
+            for _ in range(PQ_ITERATIONS):
+                assignment = cls._nearest(data, means)
+                sums = np.zeros_like(means)
+                np.add.at(sums, assignment, data)
+                sizes = np.bincount(assignment, minlength=count)
+                filled = sizes > 0  # Empty clusters keep their centroid
+                means[filled] = sums[filled] / sizes[filled, None]
+            centroids[m] = means
+        return cls(centroids)
+
+    @staticmethod
+    def _nearest(data, means):
+        distances = (means ** 2).sum(axis=1) - 2 * data @ means.T
+        return distances.argmin(axis=1)
+
+    def encode(self, vectors):
+        slices = vectors.reshape(len(vectors), self.subspaces, -1)
+        return np.stack([self._nearest(slices[:, m], self.centroids[m]) for m in range(self.subspaces)],
+                        axis=1).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.centroids[np.arange(self.subspaces), codes].reshape(len(codes), -1)
+
+    def prepare(self, query):
+        slices = query.reshape(self.subspaces, 1, -1)
+        return ((self.centroids - slices) ** 2).sum(axis=2)  # (subspaces, centroids)
+
+    def scan(self, codes, table):
+        """
+        @return: np.ndarray - Squared distance of every coded vector to the query.
+        """
+        return table[np.arange(self.subspaces), codes].sum(axis=1)
+
+    def arrays(self):
+        return {"centroids": self.centroids}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["centroids"])
+
+
+QUANTIZERS = {quantizer.method: quantizer for quantizer in (ScalarQuantizer, ProductQuantizer)}
+
+
+# -------------------------------------------------------------------------
+# Quantized Index
+# -------------------------------------------------------------------------
+
+class QuantizedIndex(PartitionedMixin):
+    """
+    @brief In-process dense index over compressed vectors, with exact re-ranking.
+
+    @details A query scans the codes of every chunk (brute force, but on 4x to 64x
+             less memory than float32), keeps the `rerank` best candidates and orders
+             them by their exact L2 distance, computed on the full-precision vectors
+             memory-mapped from disk (only those rows are read). Distances are squared
+             L2, as in the Chroma collection, so both backends rank alike.
+    """
+
+    def __init__(self, quantizer, codes, norms, vectors, ids, documents, metadatas, fingerprint="",
+                 rerank=QUANTIZED_RERANK_CANDIDATES):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.norms = norms  # |x|^2 of the reconstructed vectors (scalar quantization)
+        self.vectors = vectors  # Full-precision vectors (memory-mapped once saved)
+        self.ids = ids  # Chroma id of every chunk
+        self.documents = documents
+        self.metadatas = metadatas
+        self.fingerprint = fingerprint
+        self.rerank = rerank
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def method(self):
+        return self.quantizer.method
+
+    @property
+    def memory_bytes(self):
+        """
+        @return: int - Bytes of the codes, codebooks and norms kept in memory.
+        """
+        arrays = [self.codes, self.norms, *self.quantizer.arrays().values()]
+        return sum(array.nbytes for array in arrays)
+
+    @classmethod
+    def build(cls, ids, vectors, documents, metadatas, fingerprint="", method=VECTOR_QUANTIZATION,
+              subspaces=PQ_SUBSPACES, rerank=QUANTIZED_RERANK_CANDIDATES):
+        """
+        @brief Trains the quantizer on the vectors of the vector store and encodes them.
+
+        @param ids: Chroma ids of the chunks.
+        @param vectors: Their embeddings.
+        @param documents: Chunk texts.
+        @param metadatas: Chunk metadata.
+        @param fingerprint: Corpus fingerprint the index is valid for.
+        @param method: "sq8" or "pq".
+        @param subspaces: Number of product quantization subspaces (bytes per vector).
+        @param rerank: Candidates re-ranked with exact distances (0 disables re-ranking).
+        @return: QuantizedIndex
+        """
+        if method not in QUANTIZERS:
+            raise ValueError(f"Unknown vector quantization: {method}")
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if method == "pq":
+            quantizer = ProductQuantizer.train(vectors, subspaces)
+        else:
+            quantizer = ScalarQuantizer.train(vectors)
+        codes = quantizer.encode(vectors)
+        norms = (quantizer.decode(codes) ** 2).sum(axis=1).astype(np.float32)
+        return cls(quantizer, codes, norms, vectors, list(ids), list(documents), list(metadatas),
+                   fingerprint, rerank)
+
+    def search(self, query_vector, k, allowed=None):
+        """
+        @brief Returns the chunks closest to a query vector.
+
+        @param query_vector: Embedding of the query.
+        @param k: Number of results.
+        @param allowed: Optional array of chunk positions to restrict the search to.
+        @return: List[Tuple[int, float]] - (chunk position, squared L2 distance), closest first.
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        positions = np.arange(len(self)) if allowed is None else np.asarray(allowed, dtype=np.int64)
+        if not len(positions) or k <= 0:
+            return []
+
+        # Approximate distances over the codes, block by block
+        prepared = self.quantizer.prepare(query)
+        approximate = np.empty(len(positions), dtype=np.float32)
+        for start in range(0, len(positions), SCAN_BLOCK_SIZE):
+            block = positions[start:start + SCAN_BLOCK_SIZE]
+            approximate[start:start + len(block)] = self.quantizer.scan(self.codes[block], prepared)
+        if self.method == "sq8":
+            approximate += self.norms[positions] + float(query @ query)
+
+        keep = min(max(k, self.rerank), len(positions))
+        best = np.argpartition(approximate, keep - 1)[:keep] if keep < len(positions) else np.arange(keep)
+        candidates, distances = positions[best], approximate[best]
+        if self.rerank:
+            order = np.argsort(candidates)  # Sequential reads of the memory-mapped vectors
+            candidates = candidates[order]
+            distances = ((np.asarray(self.vectors[candidates]) - query) ** 2).sum(axis=1)
+        order = np.argsort(distances)[:k]
+        return [(int(candidates[i]), float(distances[i])) for i in order]
+
+    def document(self, position):
+        """
+        @return: Document - The chunk at `position`, with its Chroma id.
+        """
+        return Document(page_content=self.documents[position], metadata=self.metadatas[position],
+                        id=self.ids[position])
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        """
+        @brief Same contract as the LangChain vector stores' method of the same name.
+
+        @return: List[Document] - Closest chunks first.
+        """
+        return [self.document(position) for position, _ in self.search(embedding, k)]
+
+    # ---------------------------------------------------------------------
+    # Persistence
+    # ---------------------------------------------------------------------
+
+    def save(self, directory):
+        """
+        @brief Saves the index next to the Chroma collection and maps its vectors from disk.
+        """
+        vectors_path = os.path.join(directory, QUANTIZED_INDEX_VECTORS)
+        np.save(vectors_path, np.asarray(self.vectors, dtype=np.float32))
+        self.vectors = np.load(vectors_path, mmap_mode="r")  # Drop the in-memory copy
+        np.savez(os.path.join(directory, QUANTIZED_INDEX_ARRAYS),
+                 codes=self.codes, norms=self.norms, **self.quantizer.arrays())
+        with open(os.path.join(directory, QUANTIZED_INDEX_TEXTS), "w", encoding="utf-8") as f:
+            json.dump({
+                "fingerprint": self.fingerprint,
+                "method": self.method,
+                "subspaces": getattr(self.quantizer, "subspaces", None),
+                "ids": self.ids,
+                "documents": self.documents,
+                "metadatas": self.metadatas,
+            }, f)
+
+    @classmethod
+    def load(cls, directory, fingerprint, method=VECTOR_QUANTIZATION, subspaces=PQ_SUBSPACES,
+             rerank=QUANTIZED_RERANK_CANDIDATES):
+        """
+        @brief Loads the saved index if it was built for the given corpus and quantization.
+
+        @return: QuantizedIndex or None if missing or stale.
+        """
+        texts_path = os.path.join(directory, QUANTIZED_INDEX_TEXTS)
+        if not os.path.exists(texts_path):
+            return None
+        with open(texts_path, "r", encoding="utf-8") as f:
+            texts = json.load(f)
+        if texts["fingerprint"] != fingerprint or texts["method"] != method:
+            return None
+        if method == "pq" and texts["subspaces"] != subspaces:
+            return None
+        arrays = np.load(os.path.join(directory, QUANTIZED_INDEX_ARRAYS))
+        vectors = np.load(os.path.join(directory, QUANTIZED_INDEX_VECTORS), mmap_mode="r")
+        return cls(QUANTIZERS[method].from_arrays(arrays), arrays["codes"], arrays["norms"], vectors,
+                   texts["ids"], texts["documents"], texts["metadatas"], fingerprint, rerank)
+
+
+def build_vector_index(vectordb, fingerprint, directory=PERSIST_DIRECTORY):
+    """
+    @brief Loads the quantized index of the current corpus, or builds and saves it.
+
+    @param vectordb: LangChain Chroma vector store.
+    @param fingerprint: Fingerprint of the indexed corpus (see IngestManifest).
+    @param directory: Directory the index is saved to.
+    @return: QuantizedIndex or None if the vector store is empty.
+    """
+    index = QuantizedIndex.load(directory, fingerprint)
+    if index is None:
+        print('Building quantized vector index...')
+        data = vectordb.get(include=["embeddings", "documents", "metadatas"])
+        if not data["ids"]:
+            return None
+        index = QuantizedIndex.build(data["ids"], data["embeddings"], data["documents"], data["metadatas"],
+                                     fingerprint)
+        full_bytes = index.vectors.nbytes
+        index.save(directory)
+        print(f'Quantized {len(index)} vectors ({index.method}): {index.memory_bytes / 2**20:.1f} MB in memory '
+              f'instead of {full_bytes / 2**20:.1f} MB')
+    return index
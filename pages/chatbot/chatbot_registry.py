@@ -0,0 +1,334 @@
+import gc
+import threading
+import time
+from collections import namedtuple
+
+from pages.chatbot.chatbot_config import MODEL_NAME
+from pages.chatbot.chatbot_metrics import Counter, Gauge
+
+# Readiness states reported by `ModelRegistry.status`
+STATE_COLD = "cold"
+STATE_WARMING = "warming"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+# A lazily built resource: `build(registry)` creates it, `fork_safe` tells whether
+# a forked worker may keep using the copy inherited from its parent process
+Resource = namedtuple("Resource", ["build", "fork_safe"])
+
+
+class ModelRegistry:
+    """
+    @brief Builds the heavy resources of the chatbot (model pool, embeddings, vector store)
+           on first use instead of at import time.
+
+    @details - `get(name)` builds a resource once per process, thread-safely.
+             - `warm_up()` builds every resource in a background thread, while
+               `status()` reports the readiness state for the UI and health checks.
+             - `preload()` builds everything in a parent process before it forks
+               workers, which then share the loaded weights copy-on-write.
+             - `after_fork()` drops the resources a forked worker must not share, and
+               lets the others drop their own unshareable parts (`after_fork` method).
+    """
+
+    def __init__(self, resources):
+        """
+        @param resources: Ordered dict of resource name -> Resource. Resources are
+                          warmed up in this order.
+        """
+        self._resources = resources
+        self._locks = {name: threading.Lock() for name in resources}
+        self._loaded = {}
+        self._state = STATE_COLD
+        self._state_lock = threading.Lock()
+        self.error = None
+        self.timings = {}  # Seconds spent building each resource
+        self.forked = False  # True inside forked workers
+        self.ingested = False  # True once the parent process ingested the corpus, before forking
+
+    # ---------------------------------------------------------------------
+    # Lazy Access
+    # ---------------------------------------------------------------------
+
+    def get(self, name):
+        """
+        @brief Returns a resource, building it (and its dependencies) if needed.
+
+        @param name: Resource name ("models", "embeddings", "vectordb", "retriever", ...).
+        @return: The built resource.
+        """
+        if name in self._loaded:
+            return self._loaded[name]
+        with self._locks[name]:
+            if name not in self._loaded:
+                start = time.perf_counter()
+                self._loaded[name] = self._resources[name].build(self)
+                self.timings[name] = round(time.perf_counter() - start, 3)
+                print(f'Loaded {name} in {self.timings[name]}s')
+        return self._loaded[name]
+
+    def peek(self, name):
+        """
+        @brief Returns a resource only if it is already built (never builds it).
+
+        @param name: Resource name.
+        @return: The built resource, or None.
+        """
+        return self._loaded.get(name)
+
+    def provide(self, name, resource):
+        """
+        @brief Installs an already built resource instead of building it (e.g. a
+               stand-in model pool in benchmarks).
+
+        @param name: Resource name.
+        @param resource: The built resource.
+        """
+        with self._locks[name]:
+            self._loaded[name] = resource
+
+    def rebuild(self, names):
+        """
+        @brief Replaces loaded resources with freshly built ones (e.g. the indexes of a
+               corpus that changed). Resources not built yet are left to `get`.
+
+        @param names: Resource names, rebuilt in this order.
+        """
+        for name in names:
+            if name not in self._loaded:
+                continue
+            with self._locks[name]:
+                start = time.perf_counter()
+                self._loaded[name] = self._resources[name].build(self)
+                self.timings[name] = round(time.perf_counter() - start, 3)
+                print(f'Rebuilt {name} in {self.timings[name]}s')
+
+    # ---------------------------------------------------------------------
+    # Warm-up and Readiness
+    # ---------------------------------------------------------------------
+
+    def warm_up(self, background=True):
+        """
+        @brief Builds every resource, by default in a daemon thread.
+
+        @param background: If False, blocks until every resource is built.
+        """
+        with self._state_lock:
+            if self._state in (STATE_WARMING, STATE_READY):
+                return
+            self._state = STATE_WARMING
+            self.error = None
+
+        if background:
+            threading.Thread(target=self._warm_up, name="model-warm-up", daemon=True).start()
+        else:
+            self._warm_up()
+
+    def _warm_up(self):
+        try:
+            for name in self._resources:
+                self.get(name)
+            self._state = STATE_READY
+        except Exception as e:
+            # Keep the server up and report the failure through `status`
+            print(f"Error while warming up models: {e}")
+            self.error = str(e)
+            self._state = STATE_FAILED
+
+    @property
+    def ready(self):
+        return self._state == STATE_READY
+
+    def status(self):
+        """
+        @return: dict - Readiness state, loaded resources, build timings and last error.
+        """
+        return {
+            "state": self._state,
+            "loaded": [name for name in self._resources if name in self._loaded],
+            "timings": dict(self.timings),
+            "error": self.error,
+        }
+
+    # ---------------------------------------------------------------------
+    # Pre-fork Loading
+    # ---------------------------------------------------------------------
+
+    def preload(self):
+        """
+        @brief Builds every resource in the parent process before workers are forked.
+
+        @details The loaded objects are then moved to the permanent generation of the
+                 garbage collector, so collections in the workers do not touch (and
+                 copy) the memory pages they share with the parent.
+        """
+        self.warm_up(background=False)
+        self.ingested = True  # Building the vector store ingested the corpus
+        gc.freeze()
+
+    def after_fork(self):
+        """
+        @brief Prepares a freshly forked worker.
+
+        @details Drops the resources that must not be shared across processes (open
+                 database connections, HTTP connection pools) and rebuilds them in the
+                 background. Everything else is inherited copy-on-write.
+        """
+        self.forked = True
+        self._locks = {name: threading.Lock() for name in self._resources}
+        self._state_lock = threading.Lock()
+        for name, resource in self._resources.items():
+            if not resource.fork_safe:
+                self._loaded.pop(name, None)
+            elif hasattr(self._loaded.get(name), "after_fork"):
+                self._loaded[name].after_fork()
+        if self._state != STATE_FAILED:
+            self._state = STATE_COLD
+        self.warm_up()
+
+
+# -------------------------------------------------------------------------
+# Chatbot Resources
+# -------------------------------------------------------------------------
+
+def _build_models(registry):
+    from pages.chatbot.chatbot_pool import build_model_pool
+
+    pool = build_model_pool()
+    pool.load(MODEL_NAME)  # The other models load when first selected
+    return pool
+
+
+def _build_embeddings(registry):
+    from pages.chatbot.chatbot_model import build_embeddings
+    return build_embeddings()
+
+
+def _build_vectordb(registry):
+    from pages.chatbot.chatbot_model import build_vectordb
+    # Workers only skip ingestion if their parent ingested before forking them
+    return build_vectordb(registry.get("embeddings"), ingest=not registry.ingested)
+
+
+def _corpus_version(registry):
+    from pages.chatbot.chatbot_config import PERSIST_DIRECTORY, index_settings
+    from pages.chatbot.chatbot_index import IngestManifest
+
+    registry.get("vectordb")  # Ingestion updates the manifest
+    return IngestManifest(PERSIST_DIRECTORY, index_settings()).fingerprint()
+
+
+def _build_retriever(registry):
+    from pages.chatbot.chatbot_config import VECTOR_BACKEND
+    from pages.chatbot.chatbot_filters import FilingCatalog
+    from pages.chatbot.chatbot_retrieval import HybridRetriever, build_lexical_index
+
+    vectordb = registry.get("vectordb")
+    fingerprint = _corpus_version(registry)
+    lexical_index = build_lexical_index(vectordb, fingerprint)
+    if VECTOR_BACKEND == "quantized":
+        from pages.chatbot.chatbot_quantized import build_vector_index
+        vector_index = build_vector_index(vectordb, fingerprint)
+    elif VECTOR_BACKEND == "chroma":
+        vector_index = None
+    else:
+        raise ValueError(f"Unknown vector backend: {VECTOR_BACKEND}")
+    return HybridRetriever(
+        vectorstore=vectordb,
+        embeddings=registry.get("embeddings"),
+        lexical_index=lexical_index,
+        vector_index=vector_index,
+        catalog=FilingCatalog.from_metadatas(lexical_index.metadatas),
+    )
+
+
+def _build_reranker(registry):
+    from pages.chatbot.chatbot_config import RERANK
+
+    if not RERANK:
+        return None
+    from pages.chatbot.chatbot_model import build_reranker
+    return build_reranker()
+
+
+def _build_facts(registry):
+    from pages.chatbot.chatbot_config import FACT_ANSWERS, FACTS_DIRECTORY, PERSIST_DIRECTORY, index_settings
+    from pages.chatbot.chatbot_facts import load_fact_store
+    from pages.chatbot.chatbot_index import IngestManifest
+
+    if not FACT_ANSWERS:
+        return None
+    registry.get("vectordb")  # Ingestion extracts the facts of new filings
+    return load_fact_store(FACTS_DIRECTORY, IngestManifest(PERSIST_DIRECTORY, index_settings()))
+
+
+def _build_answer_cache(registry):
+    from pages.chatbot.chatbot_cache import SemanticCache
+
+    # Answers are only valid for the corpus indexed when they were generated
+    return SemanticCache(corpus_version=_corpus_version(registry))
+
+
+# Registry shared by the whole process. The chatbot modules (and torch) are only
+# imported when a resource is first built, so importing this module is cheap.
+registry = ModelRegistry({
+    # Loaded local models are shared; the pool drops the OpenAI client after a fork
+    "models": Resource(_build_models, fork_safe=True),
+    "embeddings": Resource(_build_embeddings, fork_safe=True),
+    # Chroma holds an SQLite connection, which must not cross a fork
+    "vectordb": Resource(_build_vectordb, fork_safe=False),
+    "retriever": Resource(_build_retriever, fork_safe=False),
+    "reranker": Resource(_build_reranker, fork_safe=True),
+    "facts": Resource(_build_facts, fork_safe=True),
+    "answer_cache": Resource(_build_answer_cache, fork_safe=True),
+})
+
+# -------------------------------------------------------------------------
+# Runtime Metrics
+# -------------------------------------------------------------------------
+
+def _stats(name):
+    """
+    @return: dict - `stats()` of a loaded resource, empty while it is not built.
+    """
+    resource = registry.peek(name)
+    return resource.stats() if hasattr(resource, "stats") else {}
+
+
+def _model_stats(key):
+    return {(name,): model[key] for name, model in _stats("models").get("models", {}).items()}
+
+
+def _batch_queue_depth():
+    models = _stats("models").get("models", {}).items()
+    return {(name,): model["batching"]["queue_depth"] for name, model in models if model["batching"]}
+
+
+def _cache_stats():
+    return (("answer", _stats("answer_cache")), ("embedding", _stats("embeddings")), ("rerank", _stats("reranker")))
+
+
+Gauge("rag_model_pool_memory_mb", "Memory of the loaded models and the pool's budget (0: unlimited).", ["kind"],
+      callback=lambda: {("used",): _stats("models").get("memory_used_mb", 0),
+                        ("budget",): _stats("models").get("memory_budget_mb", 0)})
+Counter("rag_model_loads_total", "Models loaded by the pool.",
+        callback=lambda: {(): _stats("models").get("loads", 0)})
+Counter("rag_model_evictions_total", "Models unloaded to make room or after being idle.",
+        callback=lambda: {(): _stats("models").get("evictions", 0)})
+Gauge("rag_model_memory_mb", "Memory of each loaded model.", ["model"],
+      callback=lambda: _model_stats("memory_mb"))
+Gauge("rag_model_users", "Requests currently using each loaded model.", ["model"],
+      callback=lambda: _model_stats("users"))
+Gauge("rag_batch_queue_depth", "Prompts waiting for a batched generate call.", ["model"],
+      callback=_batch_queue_depth)
+Counter("rag_cache_lookups_total", "Lookups of the answer, embedding and rerank score caches.", ["cache", "result"],
+        callback=lambda: {(cache, result): stats[result]
+                          for cache, stats in _cache_stats() for result in ("hits", "misses") if stats})
+Gauge("rag_cache_entries", "Entries of the answer, embedding and rerank score caches.", ["cache"],
+      callback=lambda: {(cache,): stats["size"] for cache, stats in _cache_stats() if stats})
+Counter("rag_fact_answers_total", "Questions answered from the extracted facts, or passed on to retrieval.",
+        ["result"], callback=lambda: {(result,): count for result, count in _stats("facts").items()
+                                      if result in ("hits", "misses")})
+Counter("rag_rerank_total", "Questions reranked, or passed through in retrieval order to stay in the latency budget.",
+        ["result"], callback=lambda: {(result,): count for result, count in _stats("reranker").items()
+                                      if result in ("reranked", "skipped")})
@@ -0,0 +1,148 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from pages.chatbot.chatbot_config import (
+    RERANK_TOP_K, RERANK_CACHE_SIZE, RERANK_LATENCY_BUDGET_MS
+)
+
+# Weight of the latest batch in the moving average of the scoring time per pair
+LATENCY_SMOOTHING = 0.2
+
+# Questions skipped in a row under load after which one is reranked anyway, so the
+# scoring time estimate follows the actual load instead of a single slow sample
+REPROBE_AFTER_SKIPS = 20
+
+
+def _chunk_key(doc):
+    if doc.id:
+        return doc.id
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+class CrossEncoderReranker:
+    """
+    @brief Reorders retrieved chunks by the relevance a cross-encoder gives each
+           (question, chunk) pair, and keeps the best few.
+
+    @details The retriever over-fetches a bounded set of candidates; the pairs not
+             already scored are sent to the model in a single batched `predict` call,
+             so the cost is one forward pass whatever the number of candidates. Scores
+             are cached per (question, chunk) and evicted least-recently-used beyond
+             `max_entries`.
+             While other reranks are in flight, the expected scoring time (moving
+             average per pair, times the pairs to score and the reranks in flight) can
+             exceed `latency_budget`; the candidates are then kept in retrieval order
+             instead. A question arriving while none is in flight is always reranked,
+             as is one every REPROBE_AFTER_SKIPS skips, which refreshes the estimate.
+    """
+
+    def __init__(self, model, top_k=RERANK_TOP_K, max_entries=RERANK_CACHE_SIZE,
+                 latency_budget=RERANK_LATENCY_BUDGET_MS / 1000):
+        """
+        @param model: Cross-encoder with a sentence-transformers style `predict(pairs)`.
+        @param top_k: Chunks kept per question.
+        @param max_entries: Maximum number of cached scores.
+        @param latency_budget: Seconds reranking may add to a question (0: unlimited).
+        """
+        self.model = model
+        self.top_k = top_k
+        self.max_entries = max_entries
+        self.latency_budget = latency_budget
+        self._scores = OrderedDict()  # (question, chunk key) -> score, least recently used first
+        self._lock = threading.Lock()
+        self._pair_seconds = None  # Moving average of the scoring time per pair
+        self._skipped_in_a_row = 0
+        self.in_flight = 0
+        self.hits = 0
+        self.misses = 0
+        self.reranked = 0
+        self.skipped = 0
+
+    def rerank(self, question, docs, top_k=None):
+        """
+        @brief Returns the `top_k` most relevant of the retrieved chunks.
+
+        @param question: The user's question.
+        @param docs: Candidate LangChain Documents, in retrieval order.
+        @param top_k: Chunks kept (defaults to `self.top_k`).
+        @return: List[Document] - Best chunks first.
+        """
+        top_k = top_k or self.top_k
+        if len(docs) <= 1:
+            return docs[:top_k]
+
+        keys = [(question, _chunk_key(doc)) for doc in docs]
+        with self._lock:
+            scores = {key: self._scores[key] for key in keys if key in self._scores}
+            for key in scores:
+                self._scores.move_to_end(key)
+            missing = [(key, doc) for key, doc in zip(keys, docs) if key not in scores]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            if missing and self._over_budget(len(missing)):
+                self.skipped += 1
+                self._skipped_in_a_row += 1
+                return docs[:top_k]
+            self._skipped_in_a_row = 0
+            self.in_flight += 1
+
+        try:
+            if missing:
+                started = time.perf_counter()
+                predicted = self.model.predict([(question, doc.page_content) for _, doc in missing],
+                                               batch_size=len(missing), show_progress_bar=False)
+                elapsed = time.perf_counter() - started
+                scores.update((key, float(score)) for (key, _), score in zip(missing, predicted))
+                self._store(scores, elapsed / len(missing))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.reranked += 1
+
+        # Stable sort: ties keep the retrieval order
+        order = sorted(range(len(docs)), key=lambda i: -scores[keys[i]])
+        return [docs[i] for i in order[:top_k]]
+
+    def _over_budget(self, pairs):
+        if not self.latency_budget or self._pair_seconds is None or not self.in_flight:
+            return False
+        if self._skipped_in_a_row >= REPROBE_AFTER_SKIPS:
+            return False
+        return self._pair_seconds * pairs * (self.in_flight + 1) > self.latency_budget
+
+    def _store(self, scores, pair_seconds):
+        with self._lock:
+            if self._pair_seconds is None:
+                self._pair_seconds = pair_seconds
+            else:
+                self._pair_seconds += LATENCY_SMOOTHING * (pair_seconds - self._pair_seconds)
+            for key, score in scores.items():
+                self._scores[key] = score
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        """
+        @brief Drops every cached score.
+        """
+        with self._lock:
+            self._scores.clear()
+
+    def stats(self):
+        """
+        @return: dict - Score cache hits and misses, questions reranked and skipped
+                 under load, and the moving average scoring time per pair.
+        """
+        with self._lock:
+            return {
+                "size": len(self._scores),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reranked": self.reranked,
+                "skipped": self.skipped,
+                "in_flight": self.in_flight,
+                "pair_ms": round(self._pair_seconds * 1000, 3) if self._pair_seconds is not None else None,
+            }
@@ -0,0 +1,326 @@
+import json
+import os
+import re
+from typing import Any, List
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from pages.chatbot.chatbot_config import (
+    PERSIST_DIRECTORY, RETRIEVAL_K, RETRIEVAL_MODE, HYBRID_FETCH_K, RRF_K, BM25_K1, BM25_B
+)
+from pages.chatbot.chatbot_embeddings import embed_query_array
+
+# Files of the persisted lexical index (numeric arrays + texts/vocabulary)
+LEXICAL_INDEX_ARRAYS = "bm25.npz"
+LEXICAL_INDEX_TEXTS = "bm25.json"
+
+# Words, numbers with thousands separators or decimals ("23,350", "1.5"),
+# and hyphenated codes ("10-q", "item 1a") are kept as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,\-/][a-z0-9]+)*")
+
+
+def tokenize(text):
+    """
+    @brief Splits text into lexical terms for BM25.
+
+    @details Lower-cases the text and strips thousands separators, so "$23,350" in a
+             question matches "23,350" or "23350" in a filing.
+
+    @param text: Text to tokenize.
+    @return: List[str] - Terms.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token[0].isdigit():
+            token = token.replace(",", "")
+        terms.append(token)
+    return terms
+
+
+def partition_by_source(metadatas):
+    """
+    @brief Groups chunk positions by filing, to restrict searches to some filings.
+
+    @param metadatas: Chunk metadata, in index order.
+    @return: dict - Source of a filing -> np.ndarray of the positions of its chunks.
+    """
+    partitions = {}
+    for position, metadata in enumerate(metadatas):
+        partitions.setdefault(metadata.get("source"), []).append(position)
+    return {source: np.array(positions, dtype=np.int64) for source, positions in partitions.items()}
+
+
+class PartitionedMixin:
+    """
+    @brief Per-filing partitions of an in-process index holding `metadatas`.
+    """
+
+    _partitions = None
+
+    def positions(self, sources):
+        """
+        @param sources: Sources of the filings to search.
+        @return: np.ndarray - Sorted positions of their chunks.
+        """
+        if self._partitions is None:
+            self._partitions = partition_by_source(self.metadatas)
+        parts = [self._partitions[source] for source in sources if source in self._partitions]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+
+# -------------------------------------------------------------------------
+# BM25 Index
+# -------------------------------------------------------------------------
+
+class BM25Index(PartitionedMixin):
+    """
+    @brief In-process BM25 inverted index over the chunks of the vector store.
+
+    @details Posting lists are stored in CSR form: for term t, `doc_ids[indptr[t]:indptr[t+1]]`
+             are the chunks containing it and `impacts[...]` their precomputed BM25
+             contributions (IDF and length normalisation included). A query therefore
+             only gathers and sums the postings of its terms.
+    """
+
+    def __init__(self, vocabulary, indptr, doc_ids, impacts, ids, documents, metadatas, fingerprint=""):
+        self.vocabulary = vocabulary  # term -> term id
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.impacts = impacts
+        self.ids = ids  # Chroma id of every chunk
+        self.documents = documents
+        self.metadatas = metadatas
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, documents, metadatas, fingerprint="", k1=BM25_K1, b=BM25_B):
+        """
+        @brief Builds the index from the chunks of the vector store.
+
+        @param ids: Chroma ids of the chunks.
+        @param documents: Chunk texts.
+        @param metadatas: Chunk metadata.
+        @param fingerprint: Corpus fingerprint the index is valid for.
+        @param k1: BM25 term frequency saturation.
+        @param b: BM25 length normalisation.
+        @return: BM25Index
+        """
+        vocabulary = {}
+        postings = []  # (term id, doc id, term frequency)
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, text in enumerate(documents):
+            counts = {}
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + 1
+            lengths[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.append((vocabulary.setdefault(term, len(vocabulary)), doc_id, tf))
+
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        postings = postings[np.lexsort((postings[:, 1], postings[:, 0]))]  # Group by term
+        term_ids, doc_ids, tfs = postings[:, 0], postings[:, 1], postings[:, 2].astype(np.float32)
+
+        document_frequency = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.float32)
+        idf = np.log1p((len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()) if len(lengths) else 1.0, 1e-9))
+        impacts = idf[term_ids] * tfs * (k1 + 1) / (tfs + norm[doc_ids])
+
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequency.astype(np.int64), out=indptr[1:])
+        return cls(vocabulary, indptr, doc_ids.astype(np.int32), impacts.astype(np.float32),
+                   list(ids), list(documents), list(metadatas), fingerprint)
+
+    def search(self, query, k, allowed=None):
+        """
+        @brief Returns the best matching chunks for a query.
+
+        @param query: Query text.
+        @param k: Number of results.
+        @param allowed: Optional array of doc positions to restrict the search to.
+        @return: List[Tuple[int, float]] - (doc position, BM25 score), best first.
+        """
+        term_ids = [self.vocabulary[t] for t in set(tokenize(query)) if t in self.vocabulary]
+        if not term_ids or (allowed is not None and not len(allowed)):
+            return []
+        doc_ids = np.concatenate([self.doc_ids[self.indptr[t]:self.indptr[t + 1]] for t in term_ids])
+        impacts = np.concatenate([self.impacts[self.indptr[t]:self.indptr[t + 1]] for t in term_ids])
+        if allowed is not None:
+            keep = np.isin(doc_ids, allowed)
+            doc_ids, impacts = doc_ids[keep], impacts[keep]
+            if not len(doc_ids):
+                return []
+
+        # Sum the contributions of each matched chunk
+        unique_docs, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=impacts)
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(int(unique_docs[i]), float(scores[i])) for i in top]
+
+    def document(self, position):
+        """
+        @return: Document - The chunk at `position`, with its Chroma id.
+        """
+        return Document(page_content=self.documents[position], metadata=self.metadatas[position],
+                        id=self.ids[position])
+
+    # ---------------------------------------------------------------------
+    # Persistence
+    # ---------------------------------------------------------------------
+
+    def save(self, directory):
+        """
+        @brief Saves the index next to the Chroma collection.
+        """
+        np.savez(os.path.join(directory, LEXICAL_INDEX_ARRAYS),
+                 indptr=self.indptr, doc_ids=self.doc_ids, impacts=self.impacts)
+        with open(os.path.join(directory, LEXICAL_INDEX_TEXTS), "w", encoding="utf-8") as f:
+            json.dump({
+                "fingerprint": self.fingerprint,
+                "vocabulary": sorted(self.vocabulary, key=self.vocabulary.get),
+                "ids": self.ids,
+                "documents": self.documents,
+                "metadatas": self.metadatas,
+            }, f)
+
+    @classmethod
+    def load(cls, directory, fingerprint):
+        """
+        @brief Loads the saved index if it was built for the given corpus.
+
+        @return: BM25Index or None if missing or stale.
+        """
+        texts_path = os.path.join(directory, LEXICAL_INDEX_TEXTS)
+        if not os.path.exists(texts_path):
+            return None
+        with open(texts_path, "r", encoding="utf-8") as f:
+            texts = json.load(f)
+        if texts["fingerprint"] != fingerprint:
+            return None
+        arrays = np.load(os.path.join(directory, LEXICAL_INDEX_ARRAYS))
+        vocabulary = {term: i for i, term in enumerate(texts["vocabulary"])}
+        return cls(vocabulary, arrays["indptr"], arrays["doc_ids"], arrays["impacts"],
+                   texts["ids"], texts["documents"], texts["metadatas"], fingerprint)
+
+
+def build_lexical_index(vectordb, fingerprint, directory=PERSIST_DIRECTORY):
+    """
+    @brief Loads the BM25 index of the current corpus, or builds and saves it.
+
+    @param vectordb: LangChain Chroma vector store.
+    @param fingerprint: Fingerprint of the indexed corpus (see IngestManifest).
+    @param directory: Directory the index is saved to.
+    @return: BM25Index
+    """
+    index = BM25Index.load(directory, fingerprint)
+    if index is None:
+        print('Building lexical index...')
+        data = vectordb.get(include=["documents", "metadatas"])
+        index = BM25Index.build(data["ids"], data["documents"], data["metadatas"], fingerprint)
+        index.save(directory)
+    return index
+
+
+# -------------------------------------------------------------------------
+# Dense Search
+# -------------------------------------------------------------------------
+
+def dense_search(vectordb, query_vector, k, where=None):
+    """
+    @brief Nearest-neighbour search in Chroma, keeping the chunk ids.
+
+    @param vectordb: LangChain Chroma vector store.
+    @param query_vector: Embedding of the query.
+    @param k: Number of results.
+    @param where: Optional Chroma metadata filter.
+    @return: List[Document] - Closest chunks first, with their Chroma id.
+    """
+    results = vectordb._collection.query(
+        query_embeddings=[np.asarray(query_vector, dtype=np.float32).tolist()], n_results=k, where=where,
+        include=["documents", "metadatas"],
+    )
+    return [
+        Document(page_content=text, metadata=metadata or {}, id=chunk_id)
+        for chunk_id, text, metadata in zip(results["ids"][0], results["documents"][0], results["metadatas"][0])
+    ]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """
+    @brief Fuses ranked lists of documents: score(d) = sum over lists of 1 / (rrf_k + rank).
+
+    @param rankings: Lists of Documents (with ids), best first.
+    @param k: Number of fused results.
+    @param rrf_k: Damping constant; 60 is the usual choice.
+    @return: List[Document] - The fused top `k`.
+    """
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            scores[doc.id] = scores.get(doc.id, 0.0) + 1.0 / (rrf_k + rank + 1)
+            documents.setdefault(doc.id, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[chunk_id] for chunk_id in best]
+
+
+# -------------------------------------------------------------------------
+# Hybrid Retriever
+# -------------------------------------------------------------------------
+
+class HybridRetriever(BaseRetriever):
+    """
+    @brief Retriever fusing dense (Chroma) and lexical (BM25) results by reciprocal rank fusion.
+
+    @details Dense search finds paraphrases; BM25 finds exact terms such as line item
+             names, amounts and "Part II Item 1A". With `mode="dense"` only the dense
+             search runs. Dense queries go to Chroma, or to `vector_index` (e.g. a
+             QuantizedIndex) when one is set.
+    """
+
+    vectorstore: Any
+    embeddings: Any
+    lexical_index: Any = None
+    vector_index: Any = None
+    catalog: Any = None  # FilingCatalog of the corpus, to restrict questions to some filings
+    k: int = RETRIEVAL_K
+    fetch_k: int = HYBRID_FETCH_K
+    mode: str = RETRIEVAL_MODE
+
+    def search(self, query, query_vector=None, k=None, sources=None):
+        """
+        @brief Retrieves the chunks most relevant to a query.
+
+        @param query: Query text.
+        @param query_vector: Embedding of the query, if already computed.
+        @param k: Number of results (defaults to `self.k`).
+        @param sources: Sources of the filings to search (None searches every filing).
+        @return: List[Document] - Best chunks first.
+        """
+        k = k or self.k
+        if query_vector is None:
+            query_vector = embed_query_array(self.embeddings, query)
+        if self.mode == "dense" or self.lexical_index is None:
+            return self._dense(query_vector, k, sources)
+
+        dense = self._dense(query_vector, max(k, self.fetch_k), sources)
+        allowed = self.lexical_index.positions(sources) if sources else None
+        lexical = [self.lexical_index.document(i) for i, _ in self.lexical_index.search(query, self.fetch_k, allowed)]
+        return reciprocal_rank_fusion([dense, lexical], k)
+
+    def _dense(self, query_vector, k, sources=None):
+        if self.vector_index is not None:
+            allowed = self.vector_index.positions(sources) if sources else None
+            return [self.vector_index.document(i) for i, _ in self.vector_index.search(query_vector, k, allowed)]
+        where = None
+        if sources:
+            where = {"source": sources[0]} if len(sources) == 1 else {"source": {"$in": list(sources)}}
+        return dense_search(self.vectorstore, query_vector, k, where)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query)
@@ -0,0 +1,364 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from pages.chatbot.chatbot_config import SESSION_STORE, SESSION_DB_PATH, SESSION_TTL, SESSION_MAX_SESSIONS
+from pages.chatbot.chatbot_metrics import Gauge
+
+# Authors of a turn
+ROLE_HUMAN = "human"
+ROLE_AI = "AI"
+
+# Appends between two purges of idle sessions
+PURGE_INTERVAL = 1000
+
+
+def make_turn(turn_id, role, text, created):
+    """
+    @return: dict - A conversation turn: id (increasing within a session), role, text, creation time.
+    """
+    return {"id": turn_id, "role": role, "text": text, "created": created}
+
+
+class MemorySessionStore:
+    """
+    @brief Conversations of the browser sessions, held in process memory.
+
+    @details Each session holds its turns and the id of the job answering its last
+             question, if any. Sessions idle for more than `ttl` seconds are dropped,
+             and the least recently used ones beyond `max_sessions`. Only suitable
+             for a single server process (see SQLiteSessionStore otherwise).
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=SESSION_MAX_SESSIONS):
+        """
+        @param ttl: Seconds a session is kept after its last activity.
+        @param max_sessions: Maximum number of sessions kept.
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> {"turns", "pending", "updated"}, least recent first
+        self._lock = threading.Lock()
+        self._appends = 0
+        self._jobs = {}  # job id -> job record (see `save_job`)
+
+    def _session(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = {"turns": [], "pending": None, "updated": time.time()}
+        self._sessions.move_to_end(session_id)
+        session["updated"] = time.time()
+        return session
+
+    def append(self, session_id, role, text):
+        """
+        @brief Appends a turn to a conversation.
+
+        @param session_id: Id of the browser session.
+        @param role: ROLE_HUMAN or ROLE_AI.
+        @param text: Message text.
+        @return: dict - The stored turn.
+        """
+        with self._lock:
+            return self._append(session_id, role, text)
+
+    def _append(self, session_id, role, text):
+        turns = self._session(session_id)["turns"]
+        turn = make_turn(len(turns), role, text, time.time())
+        turns.append(turn)
+        self._appends += 1
+        if self._appends % PURGE_INTERVAL == 0 or len(self._sessions) > self.max_sessions:
+            self._purge()
+        return turn
+
+    def turns(self, session_id, after=None, before=None, limit=None):
+        """
+        @brief Returns turns of a conversation, oldest first.
+
+        @param session_id: Id of the browser session.
+        @param after: Only turns with a greater id.
+        @param before: Only turns with a smaller id.
+        @param limit: Only the latest `limit` matching turns.
+        @return: List[dict] - Turns (see `make_turn`).
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            turns = session["turns"] if session else []
+            start = 0 if after is None else after + 1  # Turn ids are list positions
+            end = len(turns) if before is None else max(min(before, len(turns)), start)
+            if limit is not None:
+                start = max(start, end - limit)
+            return turns[start:end]
+
+    def pending(self, session_id):
+        """
+        @return: str or None - Id of the job answering the session's last question.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["pending"] if session else None
+
+    def set_pending(self, session_id, job_id):
+        """
+        @brief Records the job answering the session's last question.
+        """
+        with self._lock:
+            self._session(session_id)["pending"] = job_id
+
+    def close_pending(self, session_id, job_id, text):
+        """
+        @brief Appends the answer of a pending job, once.
+
+        @details Concurrent callers (a poll and a new question) may both try to close
+                 the same job: only the first one appends its text.
+
+        @param session_id: Id of the browser session.
+        @param job_id: Id of the job to close.
+        @param text: The answer (or the reason there is none).
+        @return: bool - True if the answer was appended.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session["pending"] != job_id:
+                return False
+            session["pending"] = None
+            self._append(session_id, ROLE_AI, text)
+            return True
+
+    def save_job(self, job_id, session_id, record):
+        """
+        @brief Records the state of a job, so that any server process can poll it.
+
+        @param job_id: Id of the job.
+        @param session_id: Id of the browser session that asked the question.
+        @param record: dict - status, partial, output, error and submitted (see Job.record).
+        """
+        with self._lock:
+            stored = self._jobs.get(job_id)
+            self._jobs[job_id] = {**record, "session_id": session_id, "updated": time.time(),
+                                  "cancel": stored["cancel"] if stored else None}
+
+    def job(self, job_id):
+        """
+        @return: dict or None - The job record (see `save_job`) with the final status
+                 requested by `cancel_jobs` ("cancel", None if none), or None if unknown.
+        """
+        with self._lock:
+            record = self._jobs.get(job_id)
+            return dict(record) if record else None
+
+    def cancel_jobs(self, session_id=None, job_id=None, status="cancelled"):
+        """
+        @brief Asks the process running the jobs of a session (or one job) to stop them.
+
+        @param session_id: Cancel every job of this session...
+        @param job_id: ...or only this job.
+        @param status: Final status the jobs should report.
+        """
+        with self._lock:
+            for key, record in self._jobs.items():
+                if key == job_id or (session_id is not None and record["session_id"] == session_id):
+                    record["cancel"] = record["cancel"] or status
+
+    def forget_jobs(self, updated_before):
+        """
+        @brief Drops the records of the jobs not updated since `updated_before`.
+        """
+        with self._lock:
+            for job_id in [j for j, record in self._jobs.items() if record["updated"] < updated_before]:
+                del self._jobs[job_id]
+
+    def _purge(self):
+        now = time.time()
+        for session_id in [s for s, session in self._sessions.items() if now - session["updated"] > self.ttl]:
+            del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def stats(self):
+        """
+        @return: dict - Number of sessions, stored turns and job records.
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "turns": sum(len(session["turns"]) for session in self._sessions.values()),
+                "jobs": len(self._jobs),
+            }
+
+
+class SQLiteSessionStore:
+    """
+    @brief Conversations of the browser sessions, stored in an SQLite database.
+
+    @details Same interface as MemorySessionStore. The database file can be shared
+             by every process of the server (e.g. gunicorn workers), so a session
+             may be served by any of them, and the job answering its question polled
+             from any of them. Each thread uses its own connection.
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL):
+        """
+        @param path: Database file.
+        @param ttl: Seconds a session is kept after its last activity.
+        """
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._appends = 0
+        # Connections must not cross a fork: this one is closed once the schema exists
+        db = sqlite3.connect(self.path, timeout=30)
+        with db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY, pending TEXT, updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS turns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,
+                    role TEXT NOT NULL, text TEXT NOT NULL, created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS turns_by_session ON turns (session_id, id);
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, status TEXT NOT NULL,
+                    partial TEXT NOT NULL, output TEXT, error TEXT, submitted REAL NOT NULL,
+                    cancel TEXT, updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_by_session ON jobs (session_id);
+            """)
+        db.close()
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+        return db
+
+    def _touch(self, db, session_id):
+        db.execute(
+            "INSERT INTO sessions (session_id, pending, updated) VALUES (?, NULL, ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET updated = excluded.updated",
+            (session_id, time.time()),
+        )
+
+    def append(self, session_id, role, text):
+        with self._connection() as db:
+            turn = self._insert(db, session_id, role, text)
+        self._appends += 1
+        if self._appends % PURGE_INTERVAL == 0:
+            self._purge()
+        return turn
+
+    def _insert(self, db, session_id, role, text):
+        created = time.time()
+        self._touch(db, session_id)
+        cursor = db.execute(
+            "INSERT INTO turns (session_id, role, text, created) VALUES (?, ?, ?, ?)",
+            (session_id, role, text, created),
+        )
+        return make_turn(cursor.lastrowid, role, text, created)
+
+    def turns(self, session_id, after=None, before=None, limit=None):
+        query = "SELECT id, role, text, created FROM turns WHERE session_id = ?"
+        params = [session_id]
+        if after is not None:
+            query += " AND id > ?"
+            params.append(after)
+        if before is not None:
+            query += " AND id < ?"
+            params.append(before)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = self._connection().execute(query, params).fetchall()
+        return [make_turn(*row) for row in reversed(rows)]
+
+    def pending(self, session_id):
+        row = self._connection().execute(
+            "SELECT pending FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_pending(self, session_id, job_id):
+        with self._connection() as db:
+            self._touch(db, session_id)
+            db.execute("UPDATE sessions SET pending = ? WHERE session_id = ?", (job_id, session_id))
+
+    def close_pending(self, session_id, job_id, text):
+        with self._connection() as db:
+            # The conditional update takes the write lock: only one closer sees a changed row,
+            # and its answer is inserted in the same transaction
+            cursor = db.execute(
+                "UPDATE sessions SET pending = NULL WHERE session_id = ? AND pending = ?", (session_id, job_id)
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._insert(db, session_id, ROLE_AI, text)
+            return True
+
+    def save_job(self, job_id, session_id, record):
+        with self._connection() as db:
+            db.execute(
+                "INSERT INTO jobs (job_id, session_id, status, partial, output, error, submitted, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, "
+                "partial = excluded.partial, output = excluded.output, error = excluded.error, "
+                "updated = excluded.updated",
+                (job_id, session_id, record["status"], record["partial"], record["output"], record["error"],
+                 record["submitted"], time.time()),
+            )
+
+    def job(self, job_id):
+        row = self._connection().execute(
+            "SELECT session_id, status, partial, output, error, submitted, cancel, updated FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("session_id", "status", "partial", "output", "error", "submitted", "cancel", "updated"), row))
+
+    def cancel_jobs(self, session_id=None, job_id=None, status="cancelled"):
+        with self._connection() as db:
+            db.execute("UPDATE jobs SET cancel = COALESCE(cancel, ?) WHERE session_id = ? OR job_id = ?",
+                       (status, session_id, job_id))
+
+    def forget_jobs(self, updated_before):
+        with self._connection() as db:
+            db.execute("DELETE FROM jobs WHERE updated < ?", (updated_before,))
+
+    def _purge(self):
+        with self._connection() as db:
+            expired = time.time() - self.ttl
+            db.execute("DELETE FROM turns WHERE session_id IN (SELECT session_id FROM sessions WHERE updated < ?)",
+                       (expired,))
+            db.execute("DELETE FROM sessions WHERE updated < ?", (expired,))
+
+    def stats(self):
+        db = self._connection()
+        return {
+            "sessions": db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "turns": db.execute("SELECT COUNT(*) FROM turns").fetchone()[0],
+            "jobs": db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0],
+        }
+
+
+def build_session_store(backend=SESSION_STORE):
+    """
+    @brief Creates the configured session store.
+
+    @param backend: "memory" or "sqlite".
+    @return: MemorySessionStore or SQLiteSessionStore
+    """
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"Unknown session store: {backend}")
+
+
+# Session store shared by every Dash callback of the process
+sessions = build_session_store()
+
+Gauge("rag_sessions", "Conversations, turns and job records kept by the session store.", ["kind"],
+      callback=lambda: {(kind,): count for kind, count in sessions.stats().items()})
@@ -0,0 +1,310 @@
+import hashlib
+import re
+from collections import Counter
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from pages.chatbot.chatbot_config import CHUNK_SIZE, CHUNK_OVERLAP, DEDUP_MAX_DISTANCE
+
+# Part and Item headings of 10-Q/10-K filings, as printed in the body ("ITEM 1A.    RISK FACTORS").
+# Upper case only: the table of contents and cross-references use "Item 1A".
+PART_PATTERN = re.compile(r"^PART\s+(I{1,3}|IV)\.?\s+(.+)$")
+ITEM_PATTERN = re.compile(r"^ITEM\s+(\d{1,2}[A-C]?)\.?\s+(.+)$")
+
+# Amounts and percentages in a table row ("$ 18,582", "(38)", "17.9 %", "—")
+NUMBER_PATTERN = re.compile(r"(?<![\w.])\(?\$?\s?\d[\d,]*(?:\.\d+)?\)?%?|(?<!\w)—(?!\w)")
+
+# Column headers of financial tables
+HEADER_ROW_PATTERN = re.compile(r"\b(?:months ended|year ended|as of)\b", re.IGNORECASE)
+
+# A line repeated at the top or bottom of this share of the pages is boilerplate
+BOILERPLATE_MIN_SHARE = 0.3
+
+# Lines examined at each end of a page when looking for headers and footers
+EDGE_LINES = 2
+
+# Chunks shorter than this (in characters) carry no retrievable information
+MIN_CHUNK_CHARS = 40
+
+# Number of bits of a SimHash fingerprint
+SIMHASH_BITS = 64
+
+
+# -------------------------------------------------------------------------
+# Page Cleaning
+# -------------------------------------------------------------------------
+
+def _line_shape(line):
+    # "Table of Contents" and "12" / "13" (page numbers) are repeated across pages
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+
+def boilerplate_lines(page_texts):
+    """
+    @brief Finds the headers and footers repeated across the pages of a filing.
+
+    @details The first and last EDGE_LINES lines of every page are compared after
+             replacing digits with "#", so running page numbers count as repeated.
+
+    @param page_texts: Text of every page.
+    @return: Set[str] - Shapes (see `_line_shape`) of the boilerplate lines.
+    """
+    counts = Counter()
+    for text in page_texts:
+        lines = [line for line in text.splitlines() if line.strip()]
+        counts.update({_line_shape(line) for line in lines[:EDGE_LINES] + lines[-EDGE_LINES:]})
+    minimum = max(3, BOILERPLATE_MIN_SHARE * len(page_texts))
+    return {shape for shape, count in counts.items() if count >= minimum}
+
+
+def clean_page(text, boilerplate):
+    """
+    @brief Removes the headers and footers from the edges of a page.
+
+    @param text: Page text.
+    @param boilerplate: Shapes returned by `boilerplate_lines`.
+    @return: List[str] - Remaining non-empty lines.
+    """
+    lines = [line.rstrip() for line in text.splitlines() if line.strip()]
+    while lines and _line_shape(lines[0]) in boilerplate:
+        lines.pop(0)
+    while lines and _line_shape(lines[-1]) in boilerplate:
+        lines.pop()
+    return lines
+
+
+def is_table_row(line):
+    """
+    @return: bool - True for rows of financial tables (a label followed by two or more figures).
+    """
+    return len(NUMBER_PATTERN.findall(line)) >= 2 and not line.rstrip().endswith(".")
+
+
+def is_header_row(line):
+    """
+    @return: bool - True for column header rows: years only ("2023 2022 2023 2022") or
+             periods ("Three Months Ended September 30, ...").
+    """
+    return bool(HEADER_ROW_PATTERN.search(line) or re.fullmatch(r"(?:(?:19|20)\d\d\s*)+", line.strip()))
+
+
+# -------------------------------------------------------------------------
+# Near-duplicate Detection
+# -------------------------------------------------------------------------
+
+def simhash(text):
+    """
+    @brief 64-bit SimHash of a text over its word 3-shingles.
+
+    @details Texts differing by a few words have fingerprints differing by a few bits.
+
+    @param text: Text to fingerprint.
+    @return: int - The fingerprint.
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+class NearDuplicateFilter:
+    """
+    @brief Detects texts whose SimHash is within `max_distance` bits of one already seen.
+
+    @details Fingerprints are split into `max_distance + 1` bands: two fingerprints
+             within that distance agree on at least one band (pigeonhole principle),
+             so only texts sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=DEDUP_MAX_DISTANCE):
+        """
+        @param max_distance: Maximum Hamming distance of near-duplicates (negative disables).
+        """
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.width = SIMHASH_BITS // max(self.bands, 1)
+        self._buckets = {}  # (band, value) -> fingerprints
+
+    def _keys(self, fingerprint):
+        mask = (1 << self.width) - 1
+        return [(band, fingerprint >> (band * self.width) & mask) for band in range(self.bands)]
+
+    def seen(self, text):
+        """
+        @brief Records a text.
+
+        @return: bool - True if a near-duplicate of it was recorded before.
+        """
+        if self.max_distance < 0:
+            return False
+        fingerprint = simhash(text)
+        keys = self._keys(fingerprint)
+        for key in keys:
+            for other in self._buckets.get(key, ()):
+                if bin(fingerprint ^ other).count("1") <= self.max_distance:
+                    return True
+        for key in keys:
+            self._buckets.setdefault(key, []).append(fingerprint)
+        return False
+
+
+# -------------------------------------------------------------------------
+# Filing Splitter
+# -------------------------------------------------------------------------
+
+class FilingSplitter:
+    """
+    @brief Splits 10-Q/10-K pages into chunks following the filing structure.
+
+    @details - Page headers and footers repeated across the filing are removed.
+             - Chunks never cross a page or a Part/Item heading, and carry the
+               `part`, `item` and `section` they belong to.
+             - Paragraphs and table rows are packed whole into chunks of up to
+               `chunk_size` characters, so neighbouring chunks do not need to overlap.
+               Longer paragraphs fall back to a recursive split with `chunk_overlap`,
+               and every piece of a long table repeats the table's heading lines.
+             - Chunks that nearly duplicate an earlier chunk of the filing are dropped.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, max_distance=DEDUP_MAX_DISTANCE):
+        """
+        @param chunk_size: Maximum chunk length in characters.
+        @param chunk_overlap: Overlap of the pieces of a paragraph longer than `chunk_size`.
+        @param max_distance: SimHash distance of near-duplicate chunks (negative disables).
+        """
+        self.chunk_size = chunk_size
+        self.max_distance = max_distance
+        self._fallback = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.dropped = Counter()  # Reason -> number of dropped lines or chunks
+
+    def split_pages(self, page_texts):
+        """
+        @brief Splits the pages of one filing.
+
+        @param page_texts: Text of every page, in order.
+        @return: List[Tuple[str, dict]] - Chunk text and metadata (page, part, item, section).
+        """
+        boilerplate = boilerplate_lines(page_texts)
+        duplicates = NearDuplicateFilter(self.max_distance)
+        section = {"part": "", "item": "", "section": ""}
+        chunks = []
+
+        for page, text in enumerate(page_texts):
+            lines = clean_page(text, boilerplate)
+            self.dropped["boilerplate_lines"] += len([l for l in text.splitlines() if l.strip()]) - len(lines)
+            for block_section, block in self._blocks(lines, section):
+                for chunk in self._pack(block):
+                    if len(chunk) < MIN_CHUNK_CHARS:
+                        self.dropped["short_chunks"] += 1
+                    elif duplicates.seen(chunk):
+                        self.dropped["duplicate_chunks"] += 1
+                    else:
+                        chunks.append((chunk, {"page": page, **block_section}))
+        return chunks
+
+    def _blocks(self, lines, section):
+        """
+        @brief Groups the lines of a page into paragraphs and tables, by section.
+
+        @details `section` is updated in place, so it carries over to the next page.
+
+        @return: Iterator[Tuple[dict, List[List[str]]]] - Section metadata and its blocks.
+        """
+        blocks, block = [], []
+
+        def close_block():
+            if block:
+                blocks.append(list(block))
+                block.clear()
+
+        for line in lines:
+            stripped = line.strip()
+            part, item = PART_PATTERN.match(stripped), ITEM_PATTERN.match(stripped)
+            if part or item:
+                close_block()
+                if blocks:
+                    yield dict(section), blocks
+                    blocks = []
+                if part:
+                    section.update(part=part.group(1), item="", section=f"Part {part.group(1)}")
+                else:
+                    title = " ".join(word.capitalize() for word in item.group(2).split())
+                    title = f"Item {item.group(1)}. {title}"
+                    section.update(item=item.group(1), section=title)
+            block.append(stripped)
+            # A short line closing a sentence ends its paragraph; tables end where rows stop
+            if stripped.endswith((".", ":")) and not is_table_row(stripped):
+                close_block()
+        close_block()
+        if blocks:
+            yield dict(section), blocks
+
+    def _pack(self, blocks):
+        """
+        @brief Packs whole blocks into chunks of up to `chunk_size` characters.
+
+        @return: List[str] - Chunks.
+        """
+        chunks, current = [], ""
+        for block in blocks:
+            for piece in self._split_block(block):
+                if current and len(current) + 1 + len(piece) > self.chunk_size:
+                    chunks.append(current)
+                    current = ""
+                current = f"{current}\n{piece}" if current else piece
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _split_block(self, block):
+        """
+        @brief Splits a block longer than `chunk_size`.
+
+        @details Tables are cut between rows and every piece starts with the table's
+                 heading lines (title, column headers); paragraphs are split recursively.
+
+        @return: List[str] - Pieces of at most (about) `chunk_size` characters.
+        """
+        text = "\n".join(block)
+        if len(text) <= self.chunk_size:
+            return [text]
+        rows = [i for i, line in enumerate(block) if is_table_row(line) and not is_header_row(line)]
+        if len(rows) < len(block) / 2:
+            return self._fallback.split_text(text)
+
+        # The heading ends with the column headers; row group labels ("Revenues") belong to the body
+        headers = [i for i in range(rows[0]) if is_header_row(block[i])]
+        body = headers[-1] + 1 if headers else rows[0]
+        heading = "\n".join(block[:body])[:self.chunk_size // 2]
+        pieces, current = [], heading
+        for line in block[body:]:
+            if current != heading and len(current) + 1 + len(line) > self.chunk_size:
+                pieces.append(current)
+                current = heading
+            current = f"{current}\n{line}" if current else line
+        pieces.append(current)
+        return pieces
+
+
+def split_filing(page_texts, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, splitter="filing"):
+    """
+    @brief Splits the pages of one filing with the configured splitter.
+
+    @param page_texts: Text of every page, in order.
+    @param chunk_size: Maximum chunk length in characters.
+    @param chunk_overlap: Overlap between chunks ("recursive") or pieces of long paragraphs ("filing").
+    @param splitter: "filing" (see FilingSplitter) or "recursive" (plain RecursiveCharacterTextSplitter).
+    @return: List[Tuple[str, dict]] - Chunk text and metadata (at least the page).
+    """
+    if splitter == "recursive":
+        recursive = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        return [
+            (chunk, {"page": page})
+            for page, text in enumerate(page_texts)
+            for chunk in recursive.split_text(text)
+        ]
+    return FilingSplitter(chunk_size, chunk_overlap).split_pages(page_texts)
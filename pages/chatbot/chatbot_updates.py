@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from pages.chatbot.chatbot_metrics import Counter
+
+# Update states reported by `CorpusUpdater.status`
+UPDATE_IDLE = "idle"
+UPDATE_RUNNING = "running"
+UPDATE_DONE = "done"
+UPDATE_FAILED = "failed"
+
+CORPUS_UPDATES = Counter("rag_corpus_updates_total", "Live corpus updates, by outcome.", ["result"])
+
+
+class ReadWriteLock:
+    """
+    @brief Lets many readers, or a single writer, hold the lock.
+
+    @details Writer-preferring: once a writer waits, new readers queue behind it, so
+             a steady stream of questions cannot postpone a corpus update forever.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+# Held for reading while a question reads the corpus (filings, facts, chunks), and for
+# writing while a live update changes it
+corpus_lock = ReadWriteLock()
+
+
+def refresh_corpus(sources=None):
+    """
+    @brief Applies new, changed and deleted filings to the running server.
+
+    @details Executes the following steps:
+             1. Parses the changed filings and embeds their new chunks while questions
+                are still answered from the current corpus.
+             2. Under the write side of `corpus_lock`, waits for the questions reading
+                the corpus, writes every FilingUpdate to Chroma, saves the manifest and
+                rebuilds the in-process indexes (BM25, quantized vectors, filing
+                catalog, facts) and the answer cache of the new corpus version.
+             Questions therefore see either the old or the new corpus, never a mix.
+
+    @param sources: Paths of the files to update, None to synchronise the whole corpus.
+    @return: IngestStats - Counters and throughput of the update.
+    """
+    from pages.chatbot.chatbot_config import FACTS_DIRECTORY, PERSIST_DIRECTORY, index_settings
+    from pages.chatbot.chatbot_index import IngestManifest
+    from pages.chatbot.chatbot_ingest import ingest_corpus
+    from pages.chatbot.chatbot_registry import registry
+
+    vectordb = registry.get("vectordb")
+    embeddings = registry.get("embeddings")
+    manifest = IngestManifest(PERSIST_DIRECTORY, index_settings())
+    updates = []
+    stats = ingest_corpus(vectordb, embeddings, manifest, sources=sources, deferred=updates)
+    if updates:
+        with corpus_lock.write():
+            start = time.perf_counter()
+            for update in updates:
+                update.apply(vectordb, embeddings, manifest, FACTS_DIRECTORY, stats)
+            manifest.save()
+            registry.rebuild(["retriever", "facts", "answer_cache"])
+            print(f"Corpus updated in {time.perf_counter() - start:.3f}s with the questions on hold")
+    stats.finished = time.perf_counter()
+    return stats
+
+
+class CorpusUpdater:
+    """
+    @brief Runs `refresh_corpus` in a background thread, one update at a time, and
+           reports its progress (see the /admin/ingest route).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = UPDATE_IDLE
+        self.started = None
+        self.finished = None
+        self.report = None
+        self.error = None
+
+    def start(self, sources=None):
+        """
+        @brief Starts an update unless one is already running.
+
+        @param sources: Paths of the files to update, None for the whole corpus.
+        @return: bool - True if the update was started.
+        """
+        with self._lock:
+            if self.state == UPDATE_RUNNING:
+                return False
+            self.state = UPDATE_RUNNING
+            self.started, self.finished, self.report, self.error = time.time(), None, None, None
+        threading.Thread(target=self._run, args=(sources,), name="corpus-update", daemon=True).start()
+        return True
+
+    def _run(self, sources):
+        try:
+            stats = refresh_corpus(sources)
+            print(stats.report())
+            self.report, self.state = stats.as_dict(), UPDATE_DONE
+        except Exception as e:
+            # Keep the server up with the previous corpus and report the failure
+            print(f"Error while updating the corpus: {e}")
+            self.error, self.state = str(e), UPDATE_FAILED
+        finally:
+            self.finished = time.time()
+            CORPUS_UPDATES.inc(result=self.state)
+
+    def status(self):
+        """
+        @return: dict - State, start and end times, report or error of the last update.
+        """
+        return {"state": self.state, "started": self.started, "finished": self.finished,
+                "report": self.report, "error": self.error}
+
+
+updater = CorpusUpdater()
@@ -8,6 +8,15 @@ from dash import html
 
 from components.navbar import render_navbar  # Navigation bar component
 from components.input import render_chat_input  # Chat input component
+from pages.chatbot.chatbot_config import JOB_POLL_INTERVAL, CHAIN_STRATEGY, MODEL_NAME, MODELS
+from pages.chatbot.chatbot_filters import FILING_AUTO, FILING_ALL
+
+# Names of the models shown in the model selector
+MODEL_LABELS = {
+    "GPT": "GPT-3.5 (OpenAI)",
+    "LLAMA2": "Llama 2 7B chat (local)",
+    "FLANT5": "Flan-T5 large (local)",
+}
 
 # -------------------------------------------------------------------------
 # Define Chatbot Layout
@@ -15,7 +24,12 @@ from components.input import render_chat_input  # Chat input component
 
 # Layout to display the conversation history
 chatbot_layout = html.Div(
-    html.Div(id="display-conversation"),  # Placeholder for conversation updates
+    html.Div([
+        # Loads the messages preceding the rendered window
+        dbc.Button("Show earlier messages", id="load-earlier", color="link", size="sm", style={"display": "none"}),
+        html.Div(id="display-conversation", children=[]),  # Rendered messages, appended incrementally
+        html.Div(id="pending-answer"),  # Answer being generated
+    ]),
     style={
         "overflow-y": "auto",  # Enable vertical scrolling for long conversations
         "display": "flex",  # Flexible layout
@@ -24,6 +38,54 @@ chatbot_layout = html.Div(
     },
 )
 
+# Selector of the model answering the questions (loaded on first use)
+model_selector = dbc.InputGroup(
+    [
+        dbc.InputGroupText("Model"),
+        dbc.Select(
+            id="model-select",
+            options=[{"label": MODEL_LABELS.get(name, name), "value": name} for name in MODELS],
+            value=MODEL_NAME,
+        ),
+    ],
+    size="sm",
+    style={"max-width": "320px"},
+)
+
+# Options of the filing selector always offered (the corpus filings are added once loaded)
+FILING_OPTIONS = [
+    {"label": "Detect from the question", "value": FILING_AUTO},
+    {"label": "All filings", "value": FILING_ALL},
+]
+
+# Selector of the filings searched for the answer
+filing_selector = dbc.InputGroup(
+    [
+        dbc.InputGroupText("Filing"),
+        dbc.Select(id="filing-select", options=FILING_OPTIONS, value=FILING_AUTO),
+    ],
+    size="sm",
+    style={"max-width": "360px"},
+)
+
+# Selector of the strategy local models use to combine the retrieved chunks
+strategy_selector = dbc.InputGroup(
+    [
+        dbc.InputGroupText("Answer strategy (local models)"),
+        dbc.Select(
+            id="chain-strategy",
+            options=[
+                {"label": "Single pass (stuff)", "value": "stuff"},
+                {"label": "Refine", "value": "refine"},
+                {"label": "Map-reduce", "value": "map_reduce"},
+            ],
+            value=CHAIN_STRATEGY,
+        ),
+    ],
+    size="sm",
+    style={"max-width": "420px"},
+)
+
 # -------------------------------------------------------------------------
 # Render Chatbot Layout
 # -------------------------------------------------------------------------
@@ -35,7 +97,7 @@ def render_chatbot():
     @details This function sets up the chatbot interface with the following components:
              - A navigation bar for branding.
              - A conversation display area.
-             - An input field for user queries.
+             - An input field for user queries, with the model, filing and answer strategy selectors.
              - A loading spinner to indicate processing.
 
     @return: html.Div - The chatbot interface layout.
@@ -46,8 +108,19 @@ def render_chatbot():
             render_navbar(brand_name="AI Chatbot for Financial Reports (10Q, 10K)"),
             html.Br(),  # Add spacing below the navbar
             
-            # Store to hold the conversation data
-            dcc.Store(id="store-conversation", data=""),
+            # The conversation is stored on the server; the client only tracks which
+            # turns are rendered and the latest turn stored on the server
+            dcc.Store(id="store-first-turn", data=None),
+            dcc.Store(id="store-last-turn", data=None),
+            dcc.Store(id="store-server-turn", data=None),
+
+            # Polls the model warm-up state until the models are ready
+            dcc.Interval(id="warmup-interval", interval=1000),
+
+            # Id of the job answering the last question, polled until it finishes
+            dcc.Store(id="store-job", data=None),
+            dcc.Store(id="store-partial", data=None),  # Answer streamed so far
+            dcc.Interval(id="job-poller", interval=JOB_POLL_INTERVAL, disabled=True),
 
             # Main container for the chatbot
             dbc.Container(
@@ -64,12 +137,22 @@ def render_chatbot():
                                 children=dbc.Card(
                                     [
                                         dbc.CardBody([
+                                            # Warm-up / failure banner
+                                            html.Div(id="model-status"),
+
                                             # Display conversation history
                                             chatbot_layout,
 
                                             # Chat input field with styling
                                             html.Div(
-                                                render_chat_input(),
+                                                [
+                                                    html.Div(
+                                                        [model_selector, filing_selector, strategy_selector],
+                                                        style={'display': 'flex', 'gap': '12px'}
+                                                    ),
+                                                    html.Br(),
+                                                    render_chat_input(),
+                                                ],
                                                 style={
                                                     'margin-left': '70px',
                                                     'margin-right': '70px',
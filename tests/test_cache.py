@@ -0,0 +1,118 @@
+"""
+Semantic answer cache: which questions may share an answer, and when cached answers
+must be dropped.
+"""
+import pytest
+from langchain_core.documents import Document
+
+from pages.chatbot import chatbot_cache
+from pages.chatbot.chatbot_cache import SemanticCache, context_fingerprint
+from pages.chatbot.chatbot_index import IngestManifest
+
+QUESTION = [1.0, 0.0, 0.0]
+PARAPHRASE = [0.99, 0.14, 0.0]  # Cosine similarity ~0.99
+OTHER = [0.0, 1.0, 0.0]
+DOCS = [Document(page_content="Total revenues were $23,350 million.", metadata={"source": "a.pdf", "page": 3})]
+
+
+@pytest.fixture
+def cache():
+    cache = SemanticCache(threshold=0.95, max_entries=10, ttl=60, persist_path="", corpus_version="v1")
+    cache.store("What were revenues?", QUESTION, "context", "$23,350 million")
+    return cache
+
+
+# -------------------------------------------------------------------------
+# Lookup
+# -------------------------------------------------------------------------
+
+def test_returns_the_answer_of_an_equivalent_question(cache):
+    assert cache.lookup(PARAPHRASE, "context") == "$23,350 million"
+    assert cache.lookup(OTHER, "context") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_never_shares_answers_across_contexts(cache):
+    assert cache.lookup(QUESTION, "other context") is None
+
+
+def test_context_fingerprint_covers_chunks_model_and_strategy():
+    fingerprint = context_fingerprint(DOCS, "FLANT5", "stuff")
+    assert context_fingerprint(DOCS, "FLANT5", "stuff") == fingerprint
+    assert context_fingerprint(DOCS, "LLAMA2", "stuff") != fingerprint
+    assert context_fingerprint(DOCS, "FLANT5", "map_reduce") != fingerprint
+    restated = [Document(page_content="Total revenues were $23,351 million.", metadata=DOCS[0].metadata)]
+    assert context_fingerprint(restated, "FLANT5", "stuff") != fingerprint
+    moved = [Document(page_content=DOCS[0].page_content, metadata={"source": "b.pdf", "page": 3})]
+    assert context_fingerprint(moved, "FLANT5", "stuff") != fingerprint
+
+
+# -------------------------------------------------------------------------
+# Invalidation
+# -------------------------------------------------------------------------
+
+def test_answers_expire_after_their_ttl(cache, monkeypatch):
+    now = chatbot_cache.time.time()
+    monkeypatch.setattr(chatbot_cache.time, "time", lambda: now + 61)
+    assert cache.lookup(QUESTION, "context") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_evicts_the_least_recently_used_answer():
+    cache = SemanticCache(threshold=0.95, max_entries=2, ttl=60, persist_path="")
+    cache.store("first", QUESTION, "a", "1")
+    cache.store("second", QUESTION, "b", "2")
+    cache.lookup(QUESTION, "a")
+    cache.store("third", QUESTION, "c", "3")
+    assert cache.lookup(QUESTION, "b") is None
+    assert (cache.lookup(QUESTION, "a"), cache.lookup(QUESTION, "c")) == ("1", "3")
+    assert cache.evictions == 1
+
+
+def test_corpus_change_drops_every_answer(cache):
+    cache.set_corpus_version("v1")
+    assert cache.lookup(QUESTION, "context") is not None
+    cache.set_corpus_version("v2")
+    assert cache.lookup(QUESTION, "context") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_persisted_answers_of_another_corpus_are_not_loaded(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = SemanticCache(threshold=0.95, ttl=60, persist_path=path, corpus_version="v1")
+    cache.store("What were revenues?", QUESTION, "context", "$23,350 million")
+    cache.save()
+
+    assert SemanticCache(threshold=0.95, ttl=60, persist_path=path, corpus_version="v1") \
+        .lookup(QUESTION, "context") == "$23,350 million"
+    assert SemanticCache(threshold=0.95, ttl=60, persist_path=path, corpus_version="v2") \
+        .lookup(QUESTION, "context") is None
+
+
+def test_persisted_answers_past_their_ttl_are_not_loaded(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    cache = SemanticCache(threshold=0.95, ttl=60, persist_path=path, corpus_version="v1")
+    cache.store("What were revenues?", QUESTION, "context", "$23,350 million")
+    cache.save()
+
+    now = chatbot_cache.time.time()
+    monkeypatch.setattr(chatbot_cache.time, "time", lambda: now + 61)
+    assert SemanticCache(threshold=0.95, ttl=60, persist_path=path, corpus_version="v1").stats()["size"] == 0
+
+
+def test_corpus_version_follows_every_ingested_change(tmp_path):
+    # The cache is versioned by the manifest fingerprint, which must change whenever a
+    # filing is added, replaced, superseded or removed
+    manifest = IngestManifest(str(tmp_path), {"embedding_model": "fake"})
+    versions = [manifest.fingerprint()]
+    manifest.record("a.pdf", "key-1", ["id-1"], "TSLA|2023-09-30|10-Q", "10-Q")
+    versions.append(manifest.fingerprint())
+    manifest.record("a.pdf", "key-2", ["id-1", "id-2"], "TSLA|2023-09-30|10-Q", "10-Q")
+    versions.append(manifest.fingerprint())
+    manifest.record("b.pdf", "key-3", ["id-1"], "TSLA|2023-09-30|10-Q", "10-Q/A")
+    manifest.supersede("a.pdf", "key-2", "b.pdf")
+    versions.append(manifest.fingerprint())
+    manifest.forget("b.pdf")
+    versions.append(manifest.fingerprint())
+    assert len(set(versions[:-1])) == 4
+    assert versions[-1] == versions[0]  # Empty again
@@ -0,0 +1,110 @@
+"""
+Numeric answers from the extracted statement line items, and the questions they must
+leave to retrieval.
+"""
+import pytest
+
+from pages.chatbot.chatbot_facts import Fact, FactStore
+
+OPERATIONS = "Consolidated Statements of Operations"
+BALANCE_SHEET = "Consolidated Balance Sheets"
+FILING = {"source": "data/tsla-20230930.pdf", "ticker": "TSLA", "form": "10-Q", "period": "2023-09-30",
+          "company": "Tesla, Inc."}
+
+
+def _revenue(item, q3, nine_months):
+    return [
+        Fact(OPERATIONS, "Revenues", item, "2023-09-30", 3, q3, "USD millions", 3),
+        Fact(OPERATIONS, "Revenues", item, "2023-09-30", 9, nine_months, "USD millions", 3),
+    ]
+
+
+@pytest.fixture(scope="module")
+def store():
+    facts = (
+        _revenue("Automotive sales", 18582, 57879)
+        + _revenue("Automotive regulatory credits", 554, 1357)
+        + _revenue("Automotive leasing", 489, 1620)
+        + _revenue("Total automotive revenues", 19625, 60856)
+        + _revenue("Energy generation and storage", 1559, 4597)
+        + _revenue("Services and other", 2166, 6153)
+        + _revenue("Total revenues", 23350, 71606)
+        + [Fact(BALANCE_SHEET, "Current assets", "Cash and cash equivalents", "2023-09-30", 0, 15932,
+                "USD millions", 2)]
+    )
+    return FactStore.from_facts(facts, FILING)
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("What were Tesla's total revenues for the three months ended September 30, 2023?",
+     "Total revenues: $23,350 million for the three months ended September 30, 2023"),
+    ("What were total revenues in the nine months ended September 30, 2023?", "$71,606 million"),
+    ("How much revenue came from regulatory credits in Q3 2023?", "Automotive regulatory credits: $554 million"),
+    ("How much cash and cash equivalents did Tesla hold as of September 30, 2023?",
+     "Cash and cash equivalents: $15,932 million as of September 30, 2023"),
+])
+def test_answers_direct_questions(store, question, expected):
+    answer = store.answer(question)
+    assert answer is not None and expected in answer
+    assert "(TSLA 10-Q 2023-09-30, Consolidated" in answer
+
+
+@pytest.mark.parametrize("question", [
+    "What was revenue in Q3 2023 excluding regulatory credits?",
+    "What was revenue not from automotive in Q3 2023?",
+    "What were total revenues without regulatory credits in Q3 2023?",
+    "What was revenue other than automotive sales in Q3 2023?",
+    "What were total revenues net of regulatory credits in Q3 2023?",
+    "What were all revenues except automotive leasing in Q3 2023?",
+    "What was non-automotive revenue in Q3 2023?",
+])
+def test_exclusions_fall_back(store, question):
+    assert store.answer(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "What were automotive revenues in China in Q3 2023?",
+    "What was automotive revenue per vehicle delivered in Q3 2023?",
+    "What were total revenues of the Cybertruck program in Q3 2023?",
+])
+def test_words_the_item_does_not_cover_fall_back(store, question):
+    assert store.answer(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "What were Tesla's total revenues?",  # No period
+    "Why did total revenues change in Q3 2023?",  # An explanation, not a value
+    "What were total revenues in Q3 2021?",  # A period the filing does not report
+])
+def test_unanswerable_questions_fall_back(store, question):
+    assert store.answer(question) is None
+
+
+def test_different_values_of_two_filings_fall_back(store):
+    other = {"source": "data/rivn-20230930.pdf", "ticker": "RIVN", "form": "10-Q", "period": "2023-09-30",
+             "company": "Rivian Automotive, Inc."}
+    both = FactStore.concat([store, FactStore.from_facts(_revenue("Total revenues", 1337, 3439), other)])
+    assert both.answer("What were total revenues in Q3 2023?") is None
+    assert "$1,337 million" in both.answer("What were total revenues in Q3 2023?", sources=[other["source"]])
+
+
+def test_restricts_to_the_selected_filings(store):
+    question = "What were total revenues in Q3 2023?"
+    assert store.answer(question, sources=[FILING["source"]]) is not None
+    assert store.answer(question, sources=["data/other-20230930.pdf"]) is None
+
+
+def test_counts_hits_and_misses():
+    store = FactStore.from_facts(_revenue("Total revenues", 23350, 71606), FILING)
+    store.answer("What were total revenues in Q3 2023?")
+    store.answer("What was revenue in Q3 2023 excluding regulatory credits?")
+    assert (store.hits, store.misses) == (1, 1)
+
+
+def test_save_and_load_round_trip(store, tmp_path):
+    path = str(tmp_path / "facts.npz")
+    store.save(path)
+    loaded = FactStore.load(path)
+    question = "How much revenue came from regulatory credits in Q3 2023?"
+    assert len(loaded) == len(store)
+    assert loaded.answer(question) == store.answer(question)
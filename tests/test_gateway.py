@@ -0,0 +1,196 @@
+"""
+Hosted LLM gateway against the mock OpenAI server: retries of failed requests, and
+identical prompts in flight sharing one request.
+"""
+import asyncio
+import email.utils
+import threading
+import time
+
+import openai
+import pytest
+
+from benchmarks.mock_openai import MockState, mock_answer, serve
+from pages.chatbot.chatbot_gateway import LLMGateway, retry_after_seconds
+
+MESSAGES = [{"role": "user", "content": "Question: What were total revenues? Answer:"}]
+ANSWER = " ".join(mock_answer(MESSAGES))
+
+
+class ScriptedState(MockState):
+    """
+    @brief Mock server answering its first requests with the given statuses (429 or
+           500), then 200.
+    """
+
+    def __init__(self, statuses=(), latency=0.0):
+        super().__init__(latency=latency, token_delay=0.0)
+        self.statuses = list(statuses)  # Tuple[int, float] - Status and Retry-After seconds
+
+    def admit(self, prompt):
+        with self._lock:
+            self.requests += 1
+            self.prompts.add(prompt)
+            if not self.statuses:
+                return 200, 0.0
+            status, retry_after = self.statuses.pop(0)
+            if status == 429:
+                self.rate_limited += 1
+            else:
+                self.errors += 1
+            return status, retry_after
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(state):
+        server, _, base_url = serve(state=state)
+        servers.append(server)
+        return base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _gateway(base_url, **options):
+    options = {"requests_per_minute": 0, "tokens_per_minute": 0, "max_retries": 2, "backoff_base": 0.01,
+               "backoff_max": 1.0, "timeout": 10, **options}
+    return LLMGateway(model="gpt-3.5-turbo", base_url=base_url, api_key="mock", **options)
+
+
+# -------------------------------------------------------------------------
+# Retries
+# -------------------------------------------------------------------------
+
+def test_retries_server_errors(mock_server):
+    state = ScriptedState([(500, 0.0), (500, 0.0)])
+    gateway = _gateway(mock_server(state))
+    assert gateway.complete(MESSAGES) == ANSWER
+    assert state.requests == 3
+    assert (gateway.retries, gateway.failed) == (2, 0)
+
+
+def test_waits_for_the_retry_after_of_a_rate_limit(mock_server):
+    state = ScriptedState([(429, 0.3)])
+    gateway = _gateway(mock_server(state), requests_per_minute=600)
+    start = time.monotonic()
+    assert gateway.complete(MESSAGES) == ANSWER
+    assert time.monotonic() - start >= 0.3
+    assert (state.requests, gateway.rate_limited, gateway.retries) == (2, 1, 1)
+    assert gateway.requests.rate < gateway.requests.max_rate  # Slowed down, then partly restored
+
+
+def test_fails_after_the_last_retry(mock_server):
+    state = ScriptedState([(500, 0.0)] * 5)
+    gateway = _gateway(mock_server(state))
+    with pytest.raises(openai.InternalServerError):
+        gateway.complete(MESSAGES)
+    assert state.requests == 3
+    assert (gateway.retries, gateway.failed) == (2, 1)
+
+
+def test_fails_when_the_retry_after_exceeds_the_maximum_backoff(mock_server):
+    state = ScriptedState([(429, 5.0)])
+    gateway = _gateway(mock_server(state), backoff_max=0.5)
+    with pytest.raises(openai.RateLimitError):
+        gateway.complete(MESSAGES)
+    assert state.requests == 1
+    assert (gateway.retries, gateway.failed) == (0, 1)
+
+
+def test_retries_asynchronous_requests(mock_server):
+    state = ScriptedState([(500, 0.0)])
+    gateway = _gateway(mock_server(state))
+    assert asyncio.run(gateway.acomplete(MESSAGES)) == ANSWER
+    assert (state.requests, gateway.retries) == (2, 1)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500", "retry-after": "2"}, 1.5),
+    ({"retry-after": "2"}, 2.0),
+    ({"retry-after": email.utils.formatdate(time.time() - 60, usegmt=True)}, 0.0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_reads_retry_after_headers(headers, expected):
+    assert retry_after_seconds(headers) == expected
+
+
+# -------------------------------------------------------------------------
+# Request Coalescing
+# -------------------------------------------------------------------------
+
+def _complete_concurrently(gateway, prompts):
+    answers = [None] * len(prompts)
+    barrier = threading.Barrier(len(prompts))
+
+    def ask(i):
+        barrier.wait()
+        answers[i] = gateway.complete(prompts[i])
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return answers
+
+
+def test_identical_prompts_in_flight_share_one_request(mock_server):
+    state = ScriptedState(latency=0.3)
+    gateway = _gateway(mock_server(state))
+    assert _complete_concurrently(gateway, [MESSAGES] * 5) == [ANSWER] * 5
+    assert state.requests == 1
+    assert gateway.coalesced == 4
+
+
+def test_distinct_prompts_are_not_coalesced(mock_server):
+    state = ScriptedState(latency=0.3)
+    gateway = _gateway(mock_server(state))
+    prompts = [[{"role": "user", "content": f"Question: {i}? Answer:"}] for i in range(3)]
+    assert _complete_concurrently(gateway, prompts) == [" ".join(mock_answer(prompt)) for prompt in prompts]
+    assert (state.requests, gateway.coalesced) == (3, 0)
+
+
+def test_coalescing_can_be_disabled(mock_server):
+    state = ScriptedState(latency=0.3)
+    gateway = _gateway(mock_server(state), coalesce=False)
+    assert _complete_concurrently(gateway, [MESSAGES] * 3) == [ANSWER] * 3
+    assert (state.requests, gateway.coalesced) == (3, 0)
+
+
+def test_a_caller_leaving_early_does_not_cut_the_others(mock_server):
+    state = ScriptedState(latency=0.3)
+    gateway = _gateway(mock_server(state))
+    first = gateway.stream(MESSAGES)
+    second = gateway.stream(MESSAGES)
+    next(first)
+    first.close()
+    assert "".join(second) == ANSWER
+    assert state.requests == 1
+
+
+def test_shared_request_errors_reach_every_caller(mock_server):
+    state = ScriptedState([(500, 0.0)] * 3, latency=0.3)
+    gateway = _gateway(mock_server(state), max_retries=0)
+    streams = [gateway.stream(MESSAGES) for _ in range(3)]
+    for stream in streams:
+        with pytest.raises(openai.InternalServerError):
+            "".join(stream)
+    assert (state.requests, gateway.failed) == (1, 1)
+
+
+def test_identical_asynchronous_prompts_share_one_request(mock_server):
+    state = ScriptedState(latency=0.3)
+    gateway = _gateway(mock_server(state))
+
+    async def ask():
+        return await asyncio.gather(*(gateway.acomplete(MESSAGES) for _ in range(5)))
+
+    assert asyncio.run(ask()) == [ANSWER] * 5
+    assert (state.requests, gateway.coalesced) == (1, 4)
+    assert gateway.stats()["in_flight"] == 0
@@ -0,0 +1,179 @@
+"""
+Incremental ingestion: stable chunk ids, and the vector store and manifest changes
+applied for changed filings, amendments and removed files.
+"""
+import os
+
+import pytest
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from pages.chatbot.chatbot_facts import FactStore, facts_path
+from pages.chatbot.chatbot_index import IngestManifest, chunk_ids, filing_identity
+from pages.chatbot.chatbot_ingest import FilingUpdate, IngestStats, ingest_corpus
+
+SETTINGS = {"embedding_model": "fake", "chunk_size": 100, "chunk_overlap": 0}
+ORIGINAL = "data/tsla-20230930.pdf"
+AMENDMENT = "data/tsla-20230930-amendment.pdf"
+DATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "data")
+
+
+def _metadata(source, form):
+    return {"source": source, "ticker": "TSLA", "form": form, "period": "2023-09-30", "company": "Tesla, Inc."}
+
+
+@pytest.fixture
+def index(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    vectordb = Chroma(persist_directory=str(tmp_path / "chroma"), embedding_function=embeddings)
+    manifest = IngestManifest(str(tmp_path / "chroma"), SETTINGS)
+    return vectordb, embeddings, manifest, str(tmp_path / "facts")
+
+
+def _apply(index, source, key, texts, form="10-Q"):
+    """
+    @brief Prepares and applies the update of `source` to a version made of `texts`,
+           embedding its chunks the way `ingest_corpus` does.
+
+    @return: Tuple[FilingUpdate, IngestStats]
+    """
+    vectordb, embeddings, manifest, facts_directory = index
+    metadata = _metadata(source, form)
+    identity = filing_identity(source, metadata)
+    ids = chunk_ids(identity, texts)
+    known = {chunk_id for s in manifest.versions(source, identity) for chunk_id in manifest.documents[s]["ids"]}
+    update = FilingUpdate(source, key, form, identity, ids, [(text, metadata) for text in texts],
+                          FactStore.from_facts([], metadata), known)
+    stats = IngestStats()
+    if update.missing:
+        texts_by_id = dict(zip(ids, texts))
+        update.vectors.update(zip(update.missing, embeddings.embed_documents([texts_by_id[i] for i in update.missing])))
+        stats.embedded += len(update.missing)
+    update.apply(vectordb, embeddings, manifest, facts_directory, stats)
+    return update, stats
+
+
+def _stored(vectordb):
+    stored = vectordb.get(include=["metadatas"])
+    return dict(zip(stored["ids"], stored["metadatas"]))
+
+
+# -------------------------------------------------------------------------
+# Chunk Ids
+# -------------------------------------------------------------------------
+
+def test_chunk_ids_are_stable_and_only_change_with_their_text():
+    identity = "TSLA|2023-09-30|10-Q"
+    first = chunk_ids(identity, ["a", "b", "c"])
+    assert chunk_ids(identity, ["a", "b", "c"]) == first
+    # Inserting or editing a chunk leaves the ids of the others unchanged
+    assert chunk_ids(identity, ["a", "new", "b", "c"]) == [first[0], chunk_ids(identity, ["new"])[0]] + first[1:]
+    assert chunk_ids(identity, ["a", "b2", "c"])[::2] == first[::2]
+    # Another filing never shares ids
+    assert not set(chunk_ids("TSLA|2023-06-30|10-Q", ["a", "b", "c"])) & set(first)
+
+
+def test_repeated_chunks_get_distinct_ids():
+    ids = chunk_ids("TSLA|2023-09-30|10-Q", ["same", "same", "other", "same"])
+    assert len(set(ids)) == 4
+    assert [chunk_id.rsplit("-", 1)[1] for chunk_id in ids] == ["0", "1", "0", "2"]
+
+
+def test_amendments_share_the_identity_of_their_filing():
+    assert filing_identity(ORIGINAL, _metadata(ORIGINAL, "10-Q")) == "TSLA|2023-09-30|10-Q"
+    assert filing_identity(AMENDMENT, _metadata(AMENDMENT, "10-Q/A")) == "TSLA|2023-09-30|10-Q"
+    assert filing_identity(ORIGINAL, {"ticker": "TSLA"}) == ORIGINAL
+
+
+# -------------------------------------------------------------------------
+# Filing Updates
+# -------------------------------------------------------------------------
+
+def test_changed_filing_only_embeds_and_deletes_the_difference(index):
+    vectordb, _, manifest, facts_directory = index
+    first, _ = _apply(index, ORIGINAL, "key-1", ["alpha", "beta", "gamma"])
+    assert set(_stored(vectordb)) == set(first.ids)
+    assert os.path.exists(facts_path(facts_directory, "key-1"))
+
+    second, stats = _apply(index, ORIGINAL, "key-2", ["alpha", "beta changed", "gamma", "delta"])
+    assert stats.embedded == 2  # "beta changed" and "delta"
+    assert (stats.reused, stats.deleted) == (2, 1)
+    assert set(_stored(vectordb)) == set(second.ids)
+    assert manifest.documents[ORIGINAL] == {"key": "key-2", "ids": second.ids, "identity": second.identity,
+                                            "form": "10-Q"}
+    assert not os.path.exists(facts_path(facts_directory, "key-1"))
+    assert os.path.exists(facts_path(facts_directory, "key-2"))
+
+
+def test_amendment_replaces_the_original_and_relabels_kept_chunks(index):
+    vectordb, _, manifest, _ = index
+    _apply(index, ORIGINAL, "key-1", ["alpha", "beta", "gamma"])
+    amendment, stats = _apply(index, AMENDMENT, "key-a", ["alpha", "beta", "gamma restated"], form="10-Q/A")
+
+    assert stats.embedded == 1
+    assert (stats.reused, stats.relabelled, stats.deleted, stats.superseded) == (2, 2, 1, 1)
+    stored = _stored(vectordb)
+    assert set(stored) == set(amendment.ids)
+    assert {metadata["source"] for metadata in stored.values()} == {AMENDMENT}
+    assert {metadata["form"] for metadata in stored.values()} == {"10-Q/A"}
+    assert list(manifest.documents) == [AMENDMENT]
+    assert manifest.superseded[ORIGINAL] == {"key": "key-1", "by": AMENDMENT}
+
+
+def test_original_filed_after_its_amendment_is_superseded(index):
+    vectordb, _, manifest, _ = index
+    amendment, _ = _apply(index, AMENDMENT, "key-a", ["alpha", "beta"], form="10-Q/A")
+    _, stats = _apply(index, ORIGINAL, "key-1", ["alpha", "beta", "gamma"])
+
+    assert stats.superseded == 1
+    assert set(_stored(vectordb)) == set(amendment.ids)
+    assert list(manifest.documents) == [AMENDMENT]
+    assert manifest.is_superseded(ORIGINAL, "key-1", present={ORIGINAL, AMENDMENT})
+    # Once the amendment leaves the corpus, the original must be ingested again
+    assert not manifest.is_superseded(ORIGINAL, "key-1", present={ORIGINAL})
+
+
+def test_removed_filing_leaves_no_chunks_facts_or_records(index):
+    vectordb, _, manifest, facts_directory = index
+    _apply(index, ORIGINAL, "key-1", ["alpha", "beta"])
+    _apply(index, AMENDMENT, "key-a", ["alpha", "beta"], form="10-Q/A")
+
+    stats = IngestStats()
+    FilingUpdate(AMENDMENT).apply(vectordb, None, manifest, facts_directory, stats)
+    assert stats.deleted == 2
+    assert _stored(vectordb) == {}
+    assert manifest.documents == {}
+    assert not os.path.exists(facts_path(facts_directory, "key-a"))
+
+
+def test_manifest_survives_a_reload(index, tmp_path):
+    _, _, manifest, _ = index
+    _apply(index, ORIGINAL, "key-1", ["alpha", "beta"])
+    _apply(index, AMENDMENT, "key-a", ["alpha"], form="10-Q/A")
+    manifest.save()
+
+    reloaded = IngestManifest(str(tmp_path / "chroma"), SETTINGS)
+    assert reloaded.documents == manifest.documents
+    assert reloaded.superseded == manifest.superseded
+    assert reloaded.fingerprint() == manifest.fingerprint()
+    assert not IngestManifest(str(tmp_path / "chroma"), {**SETTINGS, "chunk_size": 200}).compatible
+
+
+# -------------------------------------------------------------------------
+# Corpus Ingestion
+# -------------------------------------------------------------------------
+
+@pytest.mark.skipif(not os.path.isdir(DATA_DIR), reason="needs the filings of data/")
+def test_reingesting_an_unchanged_corpus_embeds_nothing(index):
+    vectordb, embeddings, manifest, facts_directory = index
+    first = ingest_corpus(vectordb, embeddings, manifest, data_dir=DATA_DIR, workers=0,
+                          facts_directory=facts_directory)
+    stored = set(_stored(vectordb))
+    assert first.embedded > 0 and first.skipped == 0
+    assert stored == {chunk_id for entry in manifest.documents.values() for chunk_id in entry["ids"]}
+
+    second = ingest_corpus(vectordb, embeddings, manifest, data_dir=DATA_DIR, workers=0,
+                           facts_directory=facts_directory)
+    assert (second.embedded, second.ingested, second.deleted) == (0, 0, 0)
+    assert second.skipped == first.ingested
+    assert set(_stored(vectordb)) == stored
@@ -0,0 +1,92 @@
+"""
+Questions in progress shared by the server processes through the SQLite session store:
+polled, superseded and cancelled from a process other than the one running them.
+"""
+import threading
+import time
+
+import pytest
+
+from pages.chatbot.chatbot_jobs import JOB_CANCELLED, JOB_DONE, JOB_PUBLISH_INTERVAL, JOB_TIMEOUT, JobManager
+from pages.chatbot.chatbot_sessions import SQLiteSessionStore
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two server processes: one runs the jobs, the other only sees the shared store
+    store = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    return JobManager(board=store), JobManager(board=store)
+
+
+def _wait(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def _answer(job, release):
+    job.emit("Total revenues ")
+    release.wait(5)
+    if job.cancelled:
+        return None
+    job.emit("were $23,350 million.")
+    return "Total revenues were $23,350 million."
+
+
+def _until_cancelled(job):
+    job.emit("Thinking")
+    while not job.cancelled:
+        time.sleep(0.01)
+
+
+def test_another_process_polls_partial_and_final_answers(workers):
+    runner, poller = workers
+    release = threading.Event()
+    job = runner.submit("session", _answer, release)
+    assert poller.poll(job.id) is not None  # Published before `submit` returned
+
+    _wait(lambda: poller.poll(job.id).partial == "Total revenues ")
+    release.set()
+    _wait(lambda: poller.poll(job.id).status == JOB_DONE)
+    assert poller.poll(job.id).output == "Total revenues were $23,350 million."
+
+
+def test_new_question_on_another_process_cancels_the_previous_one(workers):
+    runner, poller = workers
+    previous = runner.submit("session", _until_cancelled)
+    _wait(lambda: previous.partial)
+
+    poller.submit("session", lambda job: "Next answer")
+    _wait(lambda: previous.finished is not None, timeout=5 * JOB_PUBLISH_INTERVAL + 1)
+    assert previous.status == JOB_CANCELLED
+    assert poller.poll(previous.id).status == JOB_CANCELLED
+
+
+def test_cancelling_a_session_from_another_process(workers):
+    runner, poller = workers
+    job = runner.submit("session", _until_cancelled)
+    other = runner.submit("other session", _until_cancelled)
+    _wait(lambda: job.partial and other.partial)
+
+    poller.cancel_session("session")
+    assert poller.poll(job.id).status == JOB_CANCELLED  # Reported before the runner notices
+    _wait(lambda: job.finished is not None)
+    assert job.status == JOB_CANCELLED
+    assert other.status != JOB_CANCELLED
+    runner.cancel_session("other session")
+
+
+def test_another_process_times_out_a_stuck_job(workers):
+    runner, poller = workers
+    poller.timeout = 0.1
+    job = runner.submit("session", _until_cancelled)
+    time.sleep(0.2)
+    assert poller.poll(job.id).status == JOB_TIMEOUT
+    _wait(lambda: job.finished is not None)
+    assert job.status == JOB_TIMEOUT
+
+
+def test_unknown_jobs_are_none(workers):
+    _, poller = workers
+    assert poller.poll("unknown") is None
@@ -0,0 +1,74 @@
+"""
+Model pool: loading within the memory budget, and freeing the models it unloads.
+"""
+import gc
+import threading
+import weakref
+from types import SimpleNamespace
+
+import pytest
+
+from pages.chatbot.chatbot_batching import BatchedPipeline
+from pages.chatbot.chatbot_pool import ModelPool
+
+
+class FakeModel:
+    config = SimpleNamespace(is_encoder_decoder=False)
+
+
+class FakePipeline:
+    """
+    @brief Stand-in for a transformers text-generation pipeline, echoing its prompts.
+    """
+
+    task = "text-generation"
+
+    def __init__(self):
+        self.model = FakeModel()
+        self.tokenizer = SimpleNamespace(pad_token=None, eos_token="</s>", padding_side="right")
+
+    def __call__(self, prompts, **kwargs):
+        return [[{"generated_text": prompt}] for prompt in prompts]
+
+
+def _batched_model(models):
+    def load(name):
+        pipeline = FakePipeline()
+        models[name] = weakref.ref(pipeline.model)
+        llm = SimpleNamespace(pipeline=BatchedPipeline(pipeline, max_wait_ms=1))
+        return llm, {"stuff": SimpleNamespace(llm=llm)}
+    return load
+
+
+def _batchers():
+    return [thread for thread in threading.enumerate() if thread.name == "llm-batcher"]
+
+
+def test_unloaded_batched_model_is_freed():
+    models = {}
+    pool = ModelPool(memory_budget_mb=100, idle_ttl=0, default="A", wait_timeout=1)
+    pool.register("A", _batched_model(models), memory_mb=60)
+    pool.register("B", _batched_model(models), memory_mb=60)
+    batchers = len(_batchers())
+
+    with pool.use("A") as model:
+        assert model.llm.pipeline("Question") == [{"generated_text": "Question"}]
+    with pool.use("B"):  # Unloads A to fit the budget
+        pass
+
+    gc.collect()
+    assert models["A"]() is None
+    assert models["B"]() is not None
+    assert pool.evictions == 1
+    assert len(_batchers()) == batchers + 1  # Only B's thread is left
+
+
+def test_closing_fails_the_queued_prompts():
+    batched = BatchedPipeline(FakePipeline(), max_wait_ms=10000, max_batch_size=8)
+    request = batched.submit("Question", {})
+    batched.close()
+    with pytest.raises(RuntimeError):
+        request.future.result(timeout=1)
+    assert not batched._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batched("Another question")
@@ -0,0 +1,60 @@
+"""
+Cross-encoder reranking: ordering, score cache, and the latency budget under which
+questions keep the retrieval order.
+"""
+import time
+
+from langchain_core.documents import Document
+
+from pages.chatbot.chatbot_rerank import REPROBE_AFTER_SKIPS, CrossEncoderReranker
+
+
+class FakeCrossEncoder:
+    """
+    @brief Scores a pair by the chunk's number, after `delays` seconds per call (then none).
+    """
+
+    def __init__(self, delays=()):
+        self.delays = list(delays)
+        self.calls = 0
+
+    def predict(self, pairs, batch_size=None, show_progress_bar=False):
+        self.calls += 1
+        if self.delays:
+            time.sleep(self.delays.pop(0))
+        return [float(chunk.split()[-1]) for _, chunk in pairs]
+
+
+DOCS = [Document(page_content=f"chunk {i}", id=str(i)) for i in range(20)]
+
+
+def test_keeps_the_best_chunks_and_caches_their_scores():
+    model = FakeCrossEncoder()
+    reranker = CrossEncoderReranker(model, top_k=3, latency_budget=0.25)
+    assert [doc.id for doc in reranker.rerank("question", DOCS)] == ["19", "18", "17"]
+    assert [doc.id for doc in reranker.rerank("question", DOCS[:5])] == ["4", "3", "2"]
+    assert model.calls == 1
+    assert (reranker.hits, reranker.misses) == (5, 20)
+
+
+def test_idle_questions_are_reranked_after_a_slow_first_call():
+    # A cold first call puts the estimate far over budget: 0.5s / 20 pairs * 20 > 0.25s
+    model = FakeCrossEncoder(delays=[0.5])
+    reranker = CrossEncoderReranker(model, top_k=3, latency_budget=0.25)
+    reranker.rerank("cold question", DOCS)
+    for i in range(3):
+        assert [doc.id for doc in reranker.rerank(f"question {i}", DOCS)] == ["19", "18", "17"]
+    assert (reranker.reranked, reranker.skipped) == (4, 0)
+    assert reranker.stats()["pair_ms"] < 25 * 0.8 ** 2  # Converging to the fast samples
+
+
+def test_skips_over_budget_while_others_are_in_flight_and_reprobes():
+    model = FakeCrossEncoder(delays=[0.5])
+    reranker = CrossEncoderReranker(model, top_k=3, latency_budget=0.25)
+    reranker.rerank("cold question", DOCS)
+    reranker.in_flight = 1  # Another question is being reranked
+
+    kept = [reranker.rerank(f"question {i}", DOCS) for i in range(REPROBE_AFTER_SKIPS + 1)]
+    assert all([doc.id for doc in docs] == ["0", "1", "2"] for docs in kept[:-1])
+    assert [doc.id for doc in kept[-1]] == ["19", "18", "17"]  # Re-probed
+    assert (reranker.reranked, reranker.skipped) == (2, REPROBE_AFTER_SKIPS)